@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+#===================================================================================
+# FILE: redrive_dead_letters.py
+#
+# USAGE: redrive_dead_letters.py
+#        -q dead-letter queue URL (an EventProcessingStack ...DeadLetterQueueUrl output)
+#        -t queue URL to send the messages back to, or
+#        -b event bus name to put the events back on
+#        [-w number of parallel workers, default 16]
+#        [-m maximum messages redriven per second, default no limit]
+#        [-n stop after this many messages, default all]
+#        [-i seconds between progress reports, default 5]
+#        [-r AWS region, default from the AWS configuration]
+#
+# DESCRIPTION: Replays the messages of one of the dead-letter queues of the event
+# processing stack, after the cause of the failures has been fixed. Messages of the
+# file upload event (or buffer) dead-letter queue are sent back to the queue they
+# came from. Events of the event target dead-letter queue, which EventBridge could
+# not deliver to a target of the custom event bus, are put back on the bus. Many
+# workers each receive 10 messages per call, send them on 10 per call, and delete
+# the ones sent, optionally limited to a rate shared by every worker, so a backlog
+# of millions of messages is replayed in minutes. Messages that could not be sent
+# stay in the dead-letter queue, hidden until their visibility timeout expires, and
+# are counted as failed. Progress (messages redriven, failed, rate, and an estimate
+# of the time left from the messages still in the queue) is printed while running.
+# Messages are not replayed in order. Every function of the pipeline drops file
+# upload events it has already recorded, and a manifest event starts at most one
+# reconcile execution, so events replayed more than once are harmless. Requires
+# boto3.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import argparse
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+
+# SQS and EventBridge service limits - maximum messages per receive, send and delete
+# call, and entries per PutEvents call
+batchMaxMessages = 10
+
+# Seconds each receive waits for messages, and the number of empty receives in a row
+# after which a worker decides the queue is drained
+receiveWaitSeconds = 2
+emptyReceivesToStop = 3
+
+# Seconds messages being redriven stay hidden from other workers. Messages that could
+# not be sent reappear in the queue after this time
+redriveVisibilitySeconds = 300
+
+# Retry settings for entries rejected by a send - exponential backoff with full jitter
+sendMaxAttempts = 5
+sendBaseDelaySeconds = 0.1
+sendMaxDelaySeconds = 5.0
+
+class RateLimiter:
+    # Token bucket shared by every worker, allowing at most a number of messages per
+    # second (no limit if None) with bursts of up to one second of messages, or one
+    # batch at lower rates
+
+    def __init__(self, messagesPerSecond):
+        self.rate = messagesPerSecond
+        self.capacity = max(messagesPerSecond or 0, batchMaxMessages)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count):
+        # Wait until count messages may be sent
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                delay = (count - self.tokens) / self.rate
+            time.sleep(delay)
+
+class DeadLetterRedrive:
+    # Redrive of the messages of a dead-letter queue to a queue or an event bus. Counts
+    # are updated by every worker, and read by the progress reports
+
+    def __init__(self, deadLetterQueueUrl, targetQueueUrl=None, eventBusName=None, messagesPerSecond=None, maxMessages=None, workers=16, region=None):
+        if (targetQueueUrl is None) == (eventBusName is None):
+            raise ValueError("Exactly one of a target queue URL and an event bus name must be given")
+        session = boto3.session.Session(region_name=region)
+        # One connection per worker, with the SDK retrying throttled calls
+        clientConfig = Config(max_pool_connections=workers, retries={'max_attempts': 10, 'mode': 'adaptive'})
+        self.sqsClient = session.client('sqs', config=clientConfig)
+        self.eventsClient = session.client('events', config=clientConfig) if eventBusName else None
+        self.deadLetterQueueUrl = deadLetterQueueUrl
+        self.targetQueueUrl = targetQueueUrl
+        self.eventBusName = eventBusName
+        self.limiter = RateLimiter(messagesPerSecond)
+        self.maxMessages = maxMessages
+        self.workers = workers
+        self.redriven = 0
+        self.failed = 0
+        self.received = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def queueDepth(self):
+        # Approximate number of messages in the dead-letter queue, visible and in flight
+        attributes = self.sqsClient.get_queue_attributes(
+            QueueUrl=self.deadLetterQueueUrl,
+            AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible']
+        )['Attributes']
+        return int(attributes['ApproximateNumberOfMessages']), int(attributes['ApproximateNumberOfMessagesNotVisible'])
+
+    def claim(self, count):
+        # Number of messages, up to count, a worker may still receive
+        with self.lock:
+            if self.maxMessages is not None:
+                count = min(count, self.maxMessages - self.received)
+            self.received += max(count, 0)
+            return max(count, 0)
+
+    def worker(self):
+        # Receive, send and delete batches of messages until the queue is drained, the
+        # message limit is reached or the redrive is stopped
+        emptyReceives = 0
+        while not self.stopped.is_set() and emptyReceives < emptyReceivesToStop:
+            count = self.claim(batchMaxMessages)
+            if not count:
+                return
+            messages = self.sqsClient.receive_message(
+                QueueUrl=self.deadLetterQueueUrl,
+                MaxNumberOfMessages=count,
+                WaitTimeSeconds=receiveWaitSeconds,
+                VisibilityTimeout=redriveVisibilitySeconds
+            ).get('Messages', [])
+            with self.lock:
+                self.received -= count - len(messages)
+            if not messages:
+                emptyReceives += 1
+                continue
+            emptyReceives = 0
+            self.limiter.acquire(len(messages))
+            sentMessages = self.send(messages)
+            if sentMessages:
+                self.delete(sentMessages)
+            with self.lock:
+                self.redriven += len(sentMessages)
+                self.failed += len(messages) - len(sentMessages)
+
+    def send(self, messages):
+        # Send a batch of messages on, retrying rejected entries with backoff. Returns the
+        # messages sent
+        entries = {}
+        for index, message in enumerate(messages):
+            entry = self.buildEntry(str(index), message)
+            if entry is not None:
+                entries[str(index)] = (entry, message)
+        sent = []
+        attempt = 0
+        while entries:
+            attempt += 1
+            failedIds = self.sendEntries([entry for entry, message in entries.values()])
+            sent.extend(message for entryId, (entry, message) in entries.items() if entryId not in failedIds)
+            entries = {entryId: entries[entryId] for entryId in failedIds}
+            if entries and attempt < sendMaxAttempts:
+                time.sleep(random.uniform(0, min(sendMaxDelaySeconds, sendBaseDelaySeconds * (2 ** attempt))))
+            elif entries:
+                print("WARNING: Unable to redrive " + str(len(entries)) + " messages after " + str(attempt) + " attempts")
+                break
+        return sent
+
+    def buildEntry(self, entryId, message):
+        # Send message batch or PutEvents entry for a message, None if the message body
+        # is not an event that can be put back on the bus
+        if self.targetQueueUrl:
+            return {'Id': entryId, 'MessageBody': message['Body']}
+        try:
+            event = json.loads(message['Body'])
+            return {
+                'Id': entryId,
+                'Source': event['source'],
+                'DetailType': event['detail-type'],
+                'Detail': json.dumps(event['detail']),
+                'Resources': event.get('resources', []),
+                'EventBusName': self.eventBusName,
+            }
+        except (ValueError, KeyError, TypeError) as error:
+            print("WARNING: Message " + message['MessageId'] + " is not an event and was left in the queue: " + repr(error))
+            return None
+
+    def sendEntries(self, entries):
+        # Send a batch of entries. Returns the IDs of the entries to retry
+        if self.targetQueueUrl:
+            response = self.sqsClient.send_message_batch(QueueUrl=self.targetQueueUrl, Entries=entries)
+            for failure in response.get('Failed', []):
+                if failure.get('SenderFault'):
+                    print("WARNING: Message rejected by " + self.targetQueueUrl + ": " + failure.get('Message', failure['Code']))
+            return set(failure['Id'] for failure in response.get('Failed', []) if not failure.get('SenderFault'))
+        response = self.eventsClient.put_events(Entries=[{key: value for key, value in entry.items() if key != 'Id'} for entry in entries])
+        # PutEvents results are in the order of the entries, the IDs are the positions
+        return set(entry['Id'] for entry, result in zip(entries, response['Entries']) if 'ErrorCode' in result)
+
+    def delete(self, messages):
+        # Delete redriven messages from the dead-letter queue. A message that could not be
+        # deleted is redriven again once it reappears, which the pipeline tolerates
+        response = self.sqsClient.delete_message_batch(
+            QueueUrl=self.deadLetterQueueUrl,
+            Entries=[{'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']} for index, message in enumerate(messages)]
+        )
+        if response.get('Failed'):
+            print("WARNING: Unable to delete " + str(len(response['Failed'])) + " redriven messages from the dead-letter queue")
+
+    def run(self, reportSeconds=5):
+        # Redrive with every worker, printing progress every reportSeconds. Returns the
+        # number of messages redriven and failed
+        startTime = time.time()
+        nextReportTime = startTime + reportSeconds
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.worker) for worker in range(self.workers)]
+            try:
+                while not all(future.done() for future in futures):
+                    time.sleep(0.5)
+                    if time.time() >= nextReportTime:
+                        print(time.strftime('%H:%M:%S') + '  ' + self.formatProgress(time.time() - startTime))
+                        nextReportTime += reportSeconds
+            except KeyboardInterrupt:
+                print("Stopping after the batches in progress")
+                self.stopped.set()
+            for future in futures:
+                future.result()
+        print(time.strftime('%H:%M:%S') + '  ' + self.formatProgress(time.time() - startTime, final=True))
+        return self.redriven, self.failed
+
+    def formatProgress(self, elapsedSeconds, final=False):
+        # One line summary of the progress of the redrive
+        rate = self.redriven / elapsedSeconds if elapsedSeconds else 0
+        fields = [str(self.redriven) + ' redriven', str(self.failed) + ' failed', str(round(rate, 1)) + ' msg/s']
+        visible, inFlight = self.queueDepth()
+        fields.append(str(visible) + ' left (' + str(inFlight) + ' in flight)')
+        if not final and rate and visible:
+            fields.append('ETA ' + str(int(visible / rate)) + ' s')
+        return '  '.join(fields)
+
+def main():
+    argParser = argparse.ArgumentParser(description='Replay the messages of a dead-letter queue of the event processing stack.')
+    argParser.add_argument('-q', '--queue-url', required=True, help='dead-letter queue URL')
+    target = argParser.add_mutually_exclusive_group(required=True)
+    target.add_argument('-t', '--target-queue-url', help='queue URL to send the messages back to')
+    target.add_argument('-b', '--event-bus-name', help='event bus name to put the events back on')
+    argParser.add_argument('-w', '--workers', type=int, default=16, help='number of parallel workers')
+    argParser.add_argument('-m', '--max-rate', type=float, help='maximum messages redriven per second')
+    argParser.add_argument('-n', '--max-messages', type=int, help='stop after this many messages')
+    argParser.add_argument('-i', '--report-seconds', type=int, default=5, help='seconds between progress reports')
+    argParser.add_argument('-r', '--region', help='AWS region')
+    args = argParser.parse_args()
+
+    redrive = DeadLetterRedrive(args.queue_url, args.target_queue_url, args.event_bus_name, args.max_rate, args.max_messages, args.workers, args.region)
+    redriven, failed = redrive.run(args.report_seconds)
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#===================================================================================
+# FILE: set_progress_client.py
+#
+# USAGE: set_progress_client.py
+#        -u set progress function URL (the EventProcessingStack.setProgressUrl output)
+#        -s logical dataset ID, may be repeated
+#        [-w poll every this many seconds until every dataset is reconciled]
+#        [-r AWS region, default from the AWS configuration]
+#
+# DESCRIPTION: Small client library, and command line script, for the "set progress"
+# AWS Lambda function URL. Requests are signed with the AWS credentials of the
+# caller (Signature Version 4, as the function URL uses AWS_IAM authentication),
+# many logical datasets are requested at once, and the progress of each dataset is
+# kept for a few seconds (the max-age of the response), so a dashboard polling
+# hundreds of datasets makes few requests. Requires boto3.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import argparse
+import json
+import re
+import time
+import urllib.parse
+import urllib.request
+import boto3
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+
+# Maximum number of logical datasets per request, see lambda-code/set-progress.py
+requestMaxSets = 50
+
+# Reconcile status of datasets that will make no further progress
+finalStatuses = ('successful', 'timeout', 'compacted')
+
+class SetProgressClient:
+    # Client for the set progress function URL, with a cache of the progress of each
+    # logical dataset for the max-age of the response it was read in
+
+    def __init__(self, functionUrl, region=None, session=None):
+        self.functionUrl = functionUrl.rstrip('/') + '/'
+        self.session = session or boto3.session.Session()
+        self.region = region or self.session.region_name
+        self.cache = {}
+
+    def getProgress(self, setIds):
+        # Progress of logical datasets, by ID. Datasets read within their max-age are
+        # served from the cache, the rest are requested in as few requests as possible
+        now = time.time()
+        misses = [setId for setId in dict.fromkeys(setIds) if self.cache.get(setId, (0, None))[0] <= now]
+        for start in range(0, len(misses), requestMaxSets):
+            progressList, maxAge = self.request(misses[start:start + requestMaxSets])
+            for progress in progressList:
+                self.cache[progress['setId']] = (now + maxAge, progress)
+        return {setId: self.cache[setId][1] for setId in setIds}
+
+    def request(self, setIds):
+        # Signed request for the progress of up to requestMaxSets logical datasets.
+        # Returns the progress of each and the max-age of the response
+        url = self.functionUrl + '?' + urllib.parse.urlencode({'setId': ','.join(setIds)})
+        credentials = self.session.get_credentials().get_frozen_credentials()
+        awsRequest = AWSRequest(method='GET', url=url)
+        SigV4Auth(credentials, 'lambda', self.region).add_auth(awsRequest)
+        with urllib.request.urlopen(urllib.request.Request(url, headers=dict(awsRequest.headers.items()))) as response:
+            body = json.loads(response.read())
+            maxAge = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        return body['sets'], int(maxAge.group(1)) if maxAge else 0
+
+def formatProgress(progress):
+    # One line summary of the progress of a logical dataset
+    fields = [progress['setId'], progress['status']]
+    if progress.get('files') is not None:
+        fields.append(str(progress['files']) + ' of ' + str(progress.get('manifestFiles') or '?') + ' files')
+    if progress.get('percentComplete') is not None:
+        fields.append(str(progress['percentComplete']) + '%')
+    if progress.get('filesPerSecond'):
+        fields.append(str(progress['filesPerSecond']) + ' files/s')
+    if progress.get('etaSeconds') is not None:
+        fields.append('ETA ' + str(progress['etaSeconds']) + ' s')
+    if progress.get('unexpectedFiles'):
+        fields.append(str(progress['unexpectedFiles']) + ' unexpected')
+    return '  '.join(fields)
+
+def main():
+    argParser = argparse.ArgumentParser(description='Print the progress of logical datasets from the set progress function URL.')
+    argParser.add_argument('-u', '--url', required=True, help='set progress function URL')
+    argParser.add_argument('-s', '--set-id', action='append', required=True, help='logical dataset ID, may be repeated')
+    argParser.add_argument('-w', '--watch', type=float, help='poll every this many seconds until every dataset is reconciled')
+    argParser.add_argument('-r', '--region', help='AWS region')
+    args = argParser.parse_args()
+
+    client = SetProgressClient(args.url, args.region)
+    while True:
+        progressBySet = client.getProgress(args.set_id)
+        for setId in args.set_id:
+            print(time.strftime('%H:%M:%S') + '  ' + formatProgress(progressBySet[setId]))
+        if not args.watch or all(progress['status'] in finalStatuses for progress in progressBySet.values()):
+            break
+        time.sleep(args.watch)
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,15 @@
 # USAGE: vault-data-example.sh
 #        -s source directory
 #        -t target directory
+#        [-x write the manifest file in the extended format, listing file sizes]
+#        [-z compress the manifest file with gzip or zstd]
 #        [-h print usage syntax]
 #
 # DESCRIPTION: Simple script that copies files and directories from a source
 # directory to a target directory and generates a "manifest" file that lists the
-# directories and files copied, including the manifest file.
+# directories and files copied, including the manifest file. The extended format
+# lists the size of each file after a tab, so the sizes are also reconciled, and
+# compressed manifest files are smaller to upload and read for large datasets.
 #
 # NOTES: Part of an AWS CDK application. View the README.md file in this repository 
 # for further information on the application architecture. 
@@ -21,6 +25,9 @@ srcDirSet=0
 tgtDirSet=0
 vaultJobSuffix="-vaultjob"
 manifestSuffix=".manifest"
+manifestExtended=0
+manifestCompression=""
+compressionSuffix=""
 copyMonitorSleep=1
 spinnerArray=("-", "\\", "|", "/")
 dateFormat="+%H:%M:%S"
@@ -29,11 +36,13 @@ function printUsage {
 	echo -e "Usage: $0
 	-s source directory
 	-t target directory
+	[-x write the manifest file in the extended format, listing file sizes]
+	[-z compress the manifest file with gzip or zstd]
 	[-h print usage syntax]
 	"
 }
 
-while getopts ":s:t:h" scriptOptions; do
+while getopts ":s:t:xz:h" scriptOptions; do
 case ${scriptOptions} in
 	s  )
 		srcDir=$OPTARG
@@ -44,6 +53,12 @@ case ${scriptOptions} in
 		tgtDir="${tgtDirRoot}/${vaultSetId}${vaultJobSuffix}"
 		tgtDirSet=1
 		;;
+	x  )
+		manifestExtended=1
+		;;
+	z  )
+		manifestCompression=$OPTARG
+		;;
 	h  )
 		printUsage
 		exit 0
@@ -75,6 +90,17 @@ function checkArgs {
 		timeLog "ERROR: Source directory $srcDir does not exist"
 		exit 1
 	fi
+	if [ -n "${manifestCompression}" -a "${manifestCompression}" != "gzip" -a "${manifestCompression}" != "zstd" ]
+	then
+		timeLog "ERROR: Manifest compression must be gzip or zstd"
+		printUsage
+		exit 1
+	fi
+	if [ -n "${manifestCompression}" ] && ! command -v ${manifestCompression} > /dev/null
+	then
+		timeLog "ERROR: ${manifestCompression} is not installed"
+		exit 1
+	fi
 	if [ `echo "${tgtDirRoot: -1}" | grep "/"` ]
 	then
 		tgtDirRoot="${tgtDirRoot%?}"
@@ -126,15 +152,45 @@ function vaultData {
 
 function generateManifest {
 	# Define manifest file location
-	manifestFile="${tgtDir}/${vaultSetId}${manifestSuffix}"
+	case ${manifestCompression} in
+		gzip ) compressionSuffix=".gz" ;;
+		zstd ) compressionSuffix=".zst" ;;
+	esac
+	manifestName="${vaultSetId}${manifestSuffix}${compressionSuffix}"
+	manifestFile="${tgtDir}/${manifestName}"
+	manifestList=`mktemp`
 	
-	timeLog "INFO: Manifest file is ${vaultSetId}${manifestSuffix}"
+	timeLog "INFO: Manifest file is ${manifestName}"
 	timeLog "INFO: Generating list of directories and files"
 
-	# Generate manifest file in expected format
+	# Generate manifest file in expected format. In the extended format each line is
+	# followed by a tab and the file size, left empty for directories and the manifest
+	# file itself. The list is written outside the target directory, then copied (and
+	# compressed) into it
 	cd ${tgtDirRoot}
-	find ${vaultSetId}${vaultJobSuffix} -type d >> ${manifestFile}
-	find ${vaultSetId}${vaultJobSuffix} -type f >> ${manifestFile}
+	if [ $manifestExtended -eq 1 ]
+	then
+		if stat -c %s . > /dev/null 2>&1
+		then
+			statArgs=(-c "%n"$'\t'"%s")
+		else
+			statArgs=(-f "%N"$'\t'"%z")
+		fi
+		echo "#manifest-format:extended" > ${manifestList}
+		find ${vaultSetId}${vaultJobSuffix} -type d | awk '{print $0 "\t"}' >> ${manifestList}
+		find ${vaultSetId}${vaultJobSuffix} -type f -exec stat "${statArgs[@]}" {} + >> ${manifestList}
+		printf '%s\t\n' "${vaultSetId}${vaultJobSuffix}/${manifestName}" >> ${manifestList}
+	else
+		find ${vaultSetId}${vaultJobSuffix} -type d >> ${manifestList}
+		find ${vaultSetId}${vaultJobSuffix} -type f >> ${manifestList}
+		printf '%s\n' "${vaultSetId}${vaultJobSuffix}/${manifestName}" >> ${manifestList}
+	fi
+	case ${manifestCompression} in
+		gzip ) gzip -c ${manifestList} > ${manifestFile} ;;
+		zstd ) zstd -q -c ${manifestList} > ${manifestFile} ;;
+		*    ) cat ${manifestList} > ${manifestFile} ;;
+	esac
+	rm -f ${manifestList}
 	timeLog "INFO: Created manifest file"
 }
 
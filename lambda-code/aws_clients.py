@@ -0,0 +1,60 @@
+#===================================================================================
+# FILE: aws_clients.py
+#
+# DESCRIPTION: Lazily created boto3 clients shared by the modules of a function. A
+# client is only created when it is first used, then reused for the life of the
+# execution environment, and the calls made through it are recorded as metrics.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import threading
+import time
+import boto3
+from botocore.exceptions import ClientError
+from embedded_metrics import recordCall
+
+# Clients created so far, by service name
+clients = {}
+clientsLock = threading.Lock()
+
+def getClient(serviceName):
+    # Return the shared client for a service, creating it on first use. Creation is
+    # serialised as boto3 sessions are not thread safe
+    client = clients.get(serviceName)
+    if client is None:
+        with clientsLock:
+            client = clients.get(serviceName)
+            if client is None:
+                client = clients[serviceName] = boto3.client(serviceName)
+    return client
+
+def operationName(methodName):
+    # API operation name of a client method, e.g. PutItem for put_item
+    return ''.join(part.capitalize() for part in methodName.split('_'))
+
+def measuredCall(method, methodName):
+    # Wrap a client method so that the latency and outcome of each call are recorded
+    def call(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = method(*args, **kwargs)
+        except ClientError as error:
+            recordCall(operationName(methodName), time.perf_counter() - started, errorCode=error.response['Error']['Code'])
+            raise
+        recordCall(operationName(methodName), time.perf_counter() - started, response)
+        return response
+    return call
+
+class LazyClient:
+    # Stands in for a boto3 client held in a module variable, creating the shared
+    # client when one of its methods is first used. Calls are measured
+    def __init__(self, serviceName):
+        self.serviceName = serviceName
+
+    def __getattr__(self, name):
+        attribute = getattr(getClient(self.serviceName), name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+        return measuredCall(attribute, name)
@@ -3,52 +3,203 @@
 #
 # DESCRIPTION: Processes SQS message event payload to determine if a "data" or
 # "manifest" file upload event was recieved. Sends an event to EventBridge specifying
-# the type of file upload along with relevant metadata.
+# the type of file upload along with relevant metadata. Messages that could not be
+# sent are reported back to SQS as batch item failures.
 #
-# NOTES: Part of an AWS CDK application. View the README.md file in this repository 
-# for further information on the application architecture. 
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
 #===================================================================================
 
+import calendar
+import datetime
 import json
-import boto3
 import os
-from dateutil import parser
+import random
+import time
+from botocore.exceptions import ClientError
+from aws_clients import LazyClient
+from embedded_metrics import emitsMetrics, addCount, putMetric
+from upload_dedup import dedupKey, isRecentDuplicate, rememberEvent
+from upload_trace import tracingEnabled, startTrace, addStamp, nowMs, recordHops
+from vault_job_matcher import compileMatcher
+from vault_event_codec import VaultEvent, buildEntry, stampEntry, entrySize, putEventsMaxBytes, dataFileUploadDetailType, manifestFileUploadDetailType
 
-eventBusClient = boto3.client('events')
+eventBusClient = LazyClient('events')
 
+# Configuration from the function environment, read once per execution environment.
+# The vault job routing rules are compiled into a matcher
+eventBusName = os.environ.get('eventBusName')
+classifyObjectKey = compileMatcher(json.loads(os.environ.get('vaultJobRules')))
+
+# PutEvents service limit - maximum entries per request. The maximum total request
+# size is the same as the maximum entry size, see vault_event_codec.py
+putEventsMaxEntries = 10
+
+# Stamps added to the trace of each entry as it is published, which entries and
+# batches leave room for
+publishStamps = ('published',)
+
+# Retry settings for failed PutEvents entries - exponential backoff with full jitter
+putEventsMaxAttempts = 4
+putEventsBaseDelaySeconds = 0.05
+putEventsMaxDelaySeconds = 1.0
+retryableErrorCodes = ('ThrottlingException', 'InternalException', 'InternalFailure', 'ServiceUnavailable')
+
+@emitsMetrics
 def lambda_handler(event, context):
-    
-    # Set variables based on values recieved from SQS message
+
+    # Classify each SQS message, building the EventBridge entry to send for it. Messages
+    # that cannot be parsed, or whose event would be too large to send, are reported as
+    # failures, messages that are not part of a vault job, or that repeat an upload
+    # notification already sent, are simply acknowledged
+    pendingEntries = []
+    pendingKeys = {}
+    pendingTraces = {}
+    batchKeys = set()
+    failedMessageIds = []
+    duplicateCount = 0
+    receivedMs = nowMs()
+    putMetric('BatchSize', len(event['Records']))
     for record in event['Records']:
-        payLoad = json.loads(record["body"])
-        objectKey = payLoad['detail']["object-key"]
-        objectSize = int(payLoad['detail']["object-size"])
-        bucketName = payLoad['detail']["bucket-name"]
-        epochTime = int((parser.isoparse(payLoad['time'])).timestamp())
-        setIdStr = objectKey.split('/', 1)[0]
-        
-        # Parse object key for required directory suffix name and determine if object 
-        # is a "data" or "manifest" file
-        if setIdStr.endswith(os.environ.get('jobDirSuffixName')):
-            setId = setIdStr.split('-', 1)[0]
-            if objectKey.endswith(setId + os.environ.get('manifestSuffixName')):
-                putUploadEvent("Manifest", setId, epochTime, bucketName, objectKey, objectSize)
-            else:
-                putUploadEvent("Data", setId, epochTime, bucketName, objectKey, objectSize)
+        try:
+            classified = classifyRecord(record, receivedMs)
+        except (KeyError, TypeError, ValueError) as error:
+            print("ERROR: Unable to process message " + record['messageId'] + ": " + repr(error))
+            failedMessageIds.append(record['messageId'])
+            continue
+        if classified is None:
+            addCount('IgnoredObjects')
+            continue
+        key, entry, trace = classified
+        if isRecentDuplicate(key) or key in batchKeys:
+            print("Duplicate upload notification dropped: " + record['messageId'])
+            duplicateCount += 1
+            continue
+        pendingEntries.append((record['messageId'], entry))
+        pendingKeys[record['messageId']] = key
+        pendingTraces[record['messageId']] = trace
+        batchKeys.add(key)
+
+    # Send the entries in size-limited batches and collect messages that failed. The
+    # traces of each batch are stamped as it is published. The upload notifications
+    # sent are remembered, and the latency of each hop of their traces published
+    for batch in batchEntries(pendingEntries):
+        publishedMs = nowMs()
+        for messageId, entry in batch:
+            if pendingTraces[messageId] is not None:
+                stampEntry(entry, 'published', addStamp(pendingTraces[messageId], 'published', publishedMs))
+        failedMessageIds.extend(putUploadEvents(batch))
+    sentMessageIds = set(pendingKeys) - set(failedMessageIds)
+    for messageId in sentMessageIds:
+        rememberEvent(pendingKeys[messageId])
+        if pendingTraces[messageId] is not None:
+            recordHops(pendingTraces[messageId], ('queued', 'received', 'classified', 'published'))
+    addCount('EventsSent', len(sentMessageIds))
+    addCount('EventBytes', sum(entrySize(entry) for messageId, entry in pendingEntries), 'Bytes')
+    addCount('DuplicatesDropped', duplicateCount)
+    addCount('FailedMessages', len(failedMessageIds))
 
-def putUploadEvent(uploadType, setId, epochTime, bucketName, objectKey, objectSize):
-    # Create EventBridge event payload for either a "data" or "manifest" file notification
-    # event and put to the custom EventBridge bus
-    Entries=[
-        {
-            "DetailType": ""+ uploadType +" File Upload Event",
-            "Source":"vault.application",
-            "Detail":"{\"set-id\":\""+ setId +"\",\"event-time\":"+ str(epochTime) +",\"bucket-name\":\""+ bucketName +"\",\"object-key\":\""+ objectKey +"\",\"object-size\":"+ str(objectSize) +"}",
-            "EventBusName" : os.environ.get('eventBusName')
-        }
-        ]
-    eventBusClient.put_events(Entries=[Entries[0]])
-                
     return {
-        'statusCode': 200
-    }
\ No newline at end of file
+        'batchItemFailures': [{'itemIdentifier': messageId} for messageId in failedMessageIds]
+    }
+
+def classifyRecord(record, receivedMs):
+    # Set variables based on values recieved from SQS message
+    payLoad = json.loads(record["body"])
+    objectKey = payLoad['detail']["object-key"]
+
+    # Match the object key against the vault job routing rules to determine if the
+    # object is a "data" or "manifest" file of a logical dataset, or neither
+    match = classifyObjectKey(objectKey)
+    if match is None:
+        return None
+    setId, isManifest = match
+    objectSize = int(payLoad['detail']["object-size"])
+    bucketName = payLoad['detail']["bucket-name"]
+    epochTime = parseEventTime(payLoad['time'])
+
+    # Start the trace of the upload notification, identified by the ID of the Storage
+    # Gateway event, from the time SQS received the message
+    trace = None
+    if tracingEnabled:
+        sentTimestamp = record.get('attributes', {}).get('SentTimestamp')
+        trace = startTrace(payLoad.get('id') or record['messageId'], epochTime, int(sentTimestamp) if sentTimestamp else None, receivedMs)
+        addStamp(trace, 'classified')
+
+    # Create EventBridge event payload for either a "data" or "manifest" file notification
+    # event destined for the custom EventBridge bus, returned with the identity of the
+    # upload event and its trace
+    uploadEvent = VaultEvent(setId, epochTime, bucketName, objectKey, objectSize)
+    key = dedupKey(setId, objectKey, epochTime)
+    if isManifest:
+        return key, buildEntry(manifestFileUploadDetailType, uploadEvent, eventBusName, trace, laterStamps=publishStamps), trace
+    else:
+        return key, buildEntry(dataFileUploadDetailType, uploadEvent, eventBusName, trace, laterStamps=publishStamps), trace
+
+def parseEventTime(timestamp):
+    # Epoch seconds of an EventBridge event time. These are UTC with second precision
+    # (e.g. 2021-06-01T12:00:00Z) and are parsed directly, any other ISO 8601 form is
+    # parsed by datetime, or by dateutil if datetime cannot
+    if len(timestamp) == 20 and timestamp[19] == 'Z':
+        return calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+            int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19])))
+    try:
+        return int(datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp())
+    except ValueError:
+        from dateutil import parser
+        return int(parser.isoparse(timestamp).timestamp())
+
+def batchEntries(pendingEntries):
+    # Pack (messageId, entry) pairs into batches that respect both the entry count and
+    # the total request size limits of a single PutEvents call, once their entries have
+    # been stamped as published
+    batch = []
+    batchSize = 0
+    for messageId, entry in pendingEntries:
+        size = entrySize(entry, publishStamps)
+        if batch and (len(batch) == putEventsMaxEntries or batchSize + size > putEventsMaxBytes):
+            yield batch
+            batch = []
+            batchSize = 0
+        batch.append((messageId, entry))
+        batchSize += size
+    if batch:
+        yield batch
+
+def putUploadEvents(batch):
+    # Put a batch of entries to the custom EventBridge bus. Only the entries that failed
+    # with a retryable error are sent again, with backoff between attempts. Returns the
+    # message IDs of entries that could not be sent
+    failedMessageIds = []
+    attempt = 0
+    while batch:
+        attempt += 1
+        try:
+            response = eventBusClient.put_events(Entries=[entry for messageId, entry in batch])
+        except ClientError as error:
+            if attempt < putEventsMaxAttempts and error.response['Error']['Code'] in retryableErrorCodes:
+                backoff(attempt)
+                continue
+            print("ERROR: PutEvents call failed: " + repr(error))
+            return failedMessageIds + [messageId for messageId, entry in batch]
+
+        # Result entries are returned in the same order as the request entries
+        retryBatch = []
+        for (messageId, entry), result in zip(batch, response['Entries']):
+            if 'ErrorCode' not in result:
+                continue
+            if attempt < putEventsMaxAttempts and result['ErrorCode'] in retryableErrorCodes:
+                retryBatch.append((messageId, entry))
+            else:
+                print("ERROR: Unable to put event for message " + messageId + ": " + result['ErrorCode'] + " " + result.get('ErrorMessage', ''))
+                failedMessageIds.append(messageId)
+        batch = retryBatch
+        if batch:
+            backoff(attempt)
+
+    return failedMessageIds
+
+def backoff(attempt):
+    # Exponential backoff with full jitter
+    addCount('Retries')
+    time.sleep(random.uniform(0, min(putEventsMaxDelaySeconds, putEventsBaseDelaySeconds * (2 ** attempt))))
@@ -0,0 +1,123 @@
+#===================================================================================
+# FILE: embedded_metrics.py
+#
+# DESCRIPTION: Shared helpers used by every function to publish CloudWatch metrics
+# in the Embedded Metric Format (EMF). Values are buffered during an invocation and
+# written to the function log once, when the handler returns.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import functools
+import json
+import os
+import threading
+import time
+
+# Configuration from the function environment, read once per execution environment
+namespace = os.environ.get('metricsNamespace', 'FileUploadNotifications')
+functionName = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+
+# EMF limits - metrics per document and values per metric
+documentMaxMetrics = 100
+metricMaxValues = 100
+
+# Error codes counted as throttling of an AWS API call
+throttlingErrorCodes = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded', 'Throttling', 'SlowDown')
+
+# DynamoDB operations that consume read capacity, all others consume write capacity
+readOperations = ('GetItem', 'BatchGetItem', 'Query', 'Scan')
+
+# Metrics buffered during the current invocation. Functions record metrics from worker
+# threads too, so the buffers are guarded by a lock
+counts = {}
+samples = {}
+units = {}
+properties = {}
+metricsLock = threading.Lock()
+
+def addCount(name, count=1, unit='Count'):
+    # Add to a metric summed over the invocation
+    with metricsLock:
+        counts[name] = counts.get(name, 0) + count
+        units[name] = unit
+
+def putMetric(name, value, unit='Count'):
+    # Record a sample of a metric, every sample recorded in the invocation is published
+    with metricsLock:
+        samples.setdefault(name, []).append(value)
+        units[name] = unit
+
+def setProperty(name, value):
+    # Add a property, searchable in CloudWatch Logs Insights but not a dimension, to the
+    # documents of the invocation
+    with metricsLock:
+        properties[name] = value
+
+def recordCall(operationName, seconds, response=None, errorCode=None):
+    # Record the latency of an AWS API call, the DynamoDB capacity it consumed (if it was
+    # asked to return it) and whether it was throttled
+    putMetric(operationName + 'Latency', round(seconds * 1000, 3), 'Milliseconds')
+    if errorCode is not None:
+        addCount('ApiErrors')
+        if errorCode in throttlingErrorCodes:
+            addCount('Throttles')
+    consumed = (response or {}).get('ConsumedCapacity') if isinstance(response, dict) else None
+    if consumed:
+        capacityUnits = sum(capacity.get('CapacityUnits', 0) for capacity in (consumed if isinstance(consumed, list) else [consumed]))
+        addCount('ReadCapacityUnits' if operationName in readOperations else 'WriteCapacityUnits', capacityUnits, 'None')
+
+def documents():
+    # EMF documents holding the buffered metrics, each within the limits of a document.
+    # Metrics with more samples than a document allows are split over several
+    with metricsLock:
+        entries = [(name, [value]) for name, value in counts.items()]
+        for name, values in samples.items():
+            entries.extend((name, values[start:start + metricMaxValues]) for start in range(0, len(values), metricMaxValues))
+        metricUnits = dict(units)
+        metricProperties = dict(properties)
+    batches = []
+    for name, values in entries:
+        batch = next((batch for batch in batches if name not in batch and len(batch) < documentMaxMetrics), None)
+        if batch is None:
+            batch = {}
+            batches.append(batch)
+        batch[name] = values
+    timestamp = int(time.time() * 1000)
+    for batch in batches:
+        document = dict(metricProperties, **{
+            '_aws': {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [['FunctionName']],
+                    'Metrics': [{'Name': name, 'Unit': metricUnits[name]} for name in batch],
+                }],
+            },
+            'FunctionName': functionName,
+        })
+        for name, values in batch.items():
+            document[name] = values[0] if len(values) == 1 else values
+        yield document
+
+def flushMetrics():
+    # Write the buffered metrics to the function log and clear the buffers
+    for document in documents():
+        print(json.dumps(document, separators=(',', ':')))
+    with metricsLock:
+        counts.clear()
+        samples.clear()
+        units.clear()
+        properties.clear()
+
+def emitsMetrics(handler):
+    # Decorator for a Lambda handler that publishes the metrics recorded during each
+    # invocation when it returns or raises
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            flushMetrics()
+    return wrapper
@@ -0,0 +1,224 @@
+#===================================================================================
+# FILE: expected_key_index.py
+#
+# DESCRIPTION: Shared helpers for the index reconcile mode. Builds, stores and loads
+# the expected key index of a logical dataset - a Bloom filter of the key hashes of
+# the files listed in its manifest file, followed by the sorted key hashes - and
+# checks files against it as they arrive.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import collections
+import math
+import os
+import time
+from embedded_metrics import addCount
+from file_upload_event_table import setItemPartitionSuffix, compactAttributeNames, itemObjectKeys, keyHash
+from hashed_key_set import keyDigests, hashArray, hashArrayBytes, hashArrayFromBytes, countContained
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Configuration from the function environment, read once per execution environment.
+# The index reconcile mode is enabled when the bucket is set
+indexBucketName = os.environ.get('expectedKeyIndexBucketName')
+indexCacheSeconds = int(os.environ.get('expectedKeyIndexCacheSeconds', '10'))
+
+indexSortKey = 'keyindex'
+
+# Bloom filter sizing - the share of keys not in the index that the filter still
+# reports as present, and the smallest filter built
+bloomFalsePositiveRate = 0.01
+bloomMinBits = 64
+
+# Suffix of the key name of the index object of a logical dataset
+indexKeySuffix = '.idx'
+
+# A loaded index. objectKey identifies the index object, bits and hashes size the
+# Bloom filter held in bloom
+Index = collections.namedtuple('Index', ['objectKey', 'bits', 'hashes', 'bloom'])
+
+# Indexes of recently seen logical datasets, by ID - the time the entry expires and
+# the index (None if the dataset has no index yet). Expired entries are kept, so an
+# unchanged index is not downloaded again, until unused for the idle time
+indexCache = {}
+indexCacheIdleSeconds = 300
+
+def indexKey(setId):
+    # Primary key of the index item for a logical dataset
+    return {
+        'setId': {
+            'S':setId + setItemPartitionSuffix,
+        },
+        'objectKey': {
+            'S':indexSortKey,
+        },
+    }
+
+def bloomSize(count):
+    # Number of bits and of hash functions of a Bloom filter of count keys with the
+    # configured false positive rate
+    bits = max(bloomMinBits, int(math.ceil(-count * math.log(bloomFalsePositiveRate) / math.log(2) ** 2)))
+    hashes = max(1, int(round(bits / count * math.log(2)))) if count else 1
+    return bits, hashes
+
+def bloomPositions(hashValue, bits, hashes):
+    # Bits of a Bloom filter set for a key hash. The positions are derived from the two
+    # halves of the 64-bit key hash (double hashing), so keys are hashed only once
+    low = hashValue & 0xffffffff
+    high = (hashValue >> 32) | 1
+    return [(low + index * high) % bits for index in range(hashes)]
+
+def buildBloomFilter(keyHashes, bits, hashes):
+    # Bloom filter of an array of key hashes, as bytes - bit N is bit N % 8 of byte N // 8
+    if numpy is not None:
+        low = keyHashes & numpy.uint64(0xffffffff)
+        high = (keyHashes >> numpy.uint64(32)) | numpy.uint64(1)
+        bitArray = numpy.zeros(bits, dtype=bool)
+        for index in range(hashes):
+            bitArray[(low + numpy.uint64(index) * high) % numpy.uint64(bits)] = True
+        return numpy.packbits(bitArray, bitorder='little').tobytes()
+    bloom = bytearray((bits + 7) // 8)
+    for hashValue in keyHashes:
+        for position in bloomPositions(hashValue, bits, hashes):
+            bloom[position >> 3] |= 1 << (position & 7)
+    return bytes(bloom)
+
+def mayContain(index, objectKey):
+    # False if an object key is certainly not in an index, True if it probably is
+    bloom = index.bloom
+    return all(bloom[position >> 3] & (1 << (position & 7)) for position in bloomPositions(keyHash(objectKey), index.bits, index.hashes))
+
+def writeIndex(s3Client, dynamoDbClient, tableName, setId, epochTime, keyHashes):
+    # Store the expected key index of a logical dataset from the sorted key hashes of
+    # its manifest file - the index object, then the index item pointing to it. Returns
+    # the size of the index object
+    bits, hashes = bloomSize(len(keyHashes))
+    bloom = buildBloomFilter(keyHashes, bits, hashes)
+    objectKey = setId + '/' + str(epochTime) + indexKeySuffix
+    body = bloom + hashArrayBytes(keyHashes)
+    s3Client.put_object(
+        Bucket=indexBucketName,
+        Key=objectKey,
+        Body=body,
+        ContentType='application/octet-stream',
+        )
+    dynamoDbClient.put_item(
+        TableName=tableName,
+        Item=dict(indexKey(setId), **{
+            'indexObjectKey': {
+                'S':objectKey,
+            },
+            'keyCount': {
+                'N':str(len(keyHashes)),
+            },
+            'bloomBits': {
+                'N':str(bits),
+            },
+            'bloomHashes': {
+                'N':str(hashes),
+            },
+            'bloomBytes': {
+                'N':str(len(bloom)),
+            },
+        }),
+        )
+    return len(body)
+
+def readIndexItem(dynamoDbClient, tableName, setId):
+    # The index item of a logical dataset, None if it has no index
+    return dynamoDbClient.get_item(
+        TableName=tableName,
+        Key=indexKey(setId),
+        ConsistentRead=True,
+        ).get('Item')
+
+def setIndex(dynamoDbClient, s3Client, tableName, setId):
+    # The Bloom filter of the expected key index of a logical dataset, None if it has
+    # none yet or the index reconcile mode is disabled. Indexes are cached for the
+    # cache time, then the index item is read again and the filter only downloaded
+    # again if the index was rebuilt
+    if not indexBucketName:
+        return None
+    now = time.time()
+    expires, index = indexCache.get(setId, (0, None))
+    if expires > now:
+        return index
+    for cachedSetId in [cachedSetId for cachedSetId, (expires, cached) in indexCache.items() if expires + indexCacheIdleSeconds <= now]:
+        del indexCache[cachedSetId]
+    item = readIndexItem(dynamoDbClient, tableName, setId)
+    if item is not None and (index is None or index.objectKey != item['indexObjectKey']['S']):
+        response = s3Client.get_object(Bucket=indexBucketName, Key=item['indexObjectKey']['S'], Range='bytes=0-' + str(int(item['bloomBytes']['N']) - 1))
+        index = Index(item['indexObjectKey']['S'], int(item['bloomBits']['N']), int(item['bloomHashes']['N']), response['Body'].read())
+        addCount('IndexLoads')
+    elif item is None:
+        index = None
+    indexCache[setId] = (now + indexCacheSeconds, index)
+    return index
+
+def indexVerdict(index, objectKey):
+    # 1 if an object key is probably listed in the manifest, 0 if it certainly is not,
+    # None without an index - stored on the item of the file
+    if index is None:
+        return None
+    return 1 if mayContain(index, objectKey) else 0
+
+def hasVerdict(item):
+    # True if an item of either format holds an index verdict
+    return 'indexMatch' in item or compactAttributeNames['indexMatch'] in item
+
+def indexCounts(verdict, oldItem):
+    # Change in the matched and unexpected file counts caused by writing the item of an
+    # upload event with a verdict over the previous version of the same item (None if
+    # the object had not been seen). Files are only counted the first time they are
+    # checked
+    if verdict is None or (oldItem is not None and hasVerdict(oldItem)):
+        return 0, 0
+    return verdict, 1 - verdict
+
+def flagUnexpected(uploadEvent):
+    # Report a file that is not listed in the manifest of its logical dataset as it
+    # arrives
+    print("WARNING: Set " + uploadEvent.setId + ": unexpected file " + uploadEvent.objectKey)
+    addCount('UnexpectedFiles')
+
+def readIndexHashes(dynamoDbClient, s3Client, tableName, setId):
+    # The sorted key hashes of the expected key index of a logical dataset
+    item = readIndexItem(dynamoDbClient, tableName, setId)
+    if item is None:
+        raise RuntimeError("No expected key index for set " + setId)
+    response = s3Client.get_object(Bucket=indexBucketName, Key=item['indexObjectKey']['S'], Range='bytes=' + item['bloomBytes']['N'] + '-')
+    return hashArrayFromBytes(response['Body'].read())
+
+def uncheckedCounts(dynamoDbClient, tableName, partitionKey, setDir, keyHashes):
+    # Number of files recorded in a partition of a logical dataset without an index
+    # verdict (recorded before its index was loaded) that are, and are not, in the
+    # sorted key hashes of its index. Returns the counts and the read capacity consumed
+    queryArgs = {
+        'TableName': tableName,
+        'KeyConditionExpression': 'setId = :setId',
+        'FilterExpression': 'attribute_not_exists(indexMatch) AND attribute_not_exists(' + compactAttributeNames['indexMatch'] + ')',
+        'ExpressionAttributeValues': {
+            ':setId': {
+                'S':partitionKey,
+            },
+        },
+        'ProjectionExpression': 'objectKey, bucketName',
+        'ReturnConsumedCapacity': 'TOTAL',
+    }
+    matched = unexpected = 0
+    capacityUnits = 0
+    while True:
+        response = dynamoDbClient.query(**queryArgs)
+        capacityUnits += response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+        keyNames, otherKeyNames = itemObjectKeys(response['Items'], setDir)
+        found = countContained(keyHashes, hashArray(keyDigests(keyNames + otherKeyNames)))
+        matched += found
+        unexpected += len(keyNames) + len(otherKeyNames) - found
+        if 'LastEvaluatedKey' not in response:
+            return matched, unexpected, capacityUnits
+        queryArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
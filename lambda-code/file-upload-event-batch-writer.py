@@ -0,0 +1,147 @@
+#===================================================================================
+# FILE: file-upload-event-batch-writer.py
+#
+# DESCRIPTION: Processes batches of file upload events, buffered in an SQS queue by
+# the custom EventBridge bus, and writes their metadata to a DynamoDB table. Used
+# instead of the "file upload notification writer" function when the buffered ingest
+# mode is enabled.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import os
+from botocore.exceptions import BotoCoreError, ClientError
+from aws_clients import LazyClient
+from embedded_metrics import emitsMetrics, addCount, putMetric
+from expected_key_index import setIndex, indexVerdict
+from file_upload_event_table import buildEventItem, itemKey, partitionShard
+from reconcile_callback import resumeShardIfComplete
+from upload_dedup import dedupKey, isRecentDuplicate, rememberEvent
+from upload_event_recorder import UploadRecord, recordUploadEvents, transactMaxEvents
+from upload_trace import addStamp, nowMs, recordHops
+from vault_event_codec import parseTracedEnvelope
+
+dynamoDbClient = LazyClient('dynamodb')
+sfnClient = LazyClient('stepfunctions')
+s3Client = LazyClient('s3')
+
+# Configuration from the function environment, read once per execution environment
+tableName = os.environ.get('dynamoDbTableName')
+
+@emitsMetrics
+def lambda_handler(event, context):
+
+    # Build an item for each buffered EventBridge event, dropping events this execution
+    # environment has already recorded before anything is read for them. A batch may
+    # contain the same object more than once (a transaction cannot write the same key
+    # twice), so only the latest event for each key is written and every message for
+    # that key shares the outcome of the write. Each object is checked against the
+    # expected key index of its logical dataset, if it has one
+    recordsByKey = {}
+    messageIdsByKey = {}
+    tracesByKey = {}
+    failedMessageIds = []
+    duplicateCount = 0
+    receivedMs = nowMs()
+    putMetric('BatchSize', len(event['Records']))
+    for record in event['Records']:
+        try:
+            uploadEvent, trace = parseTracedEnvelope(record['body'])
+        except ValueError as error:
+            print("ERROR: Unable to process message " + record['messageId'] + ": " + repr(error))
+            failedMessageIds.append(record['messageId'])
+            continue
+        if isRecentDuplicate(dedupKey(uploadEvent.setId, uploadEvent.objectKey, uploadEvent.eventTime)):
+            duplicateCount += 1
+            continue
+        try:
+            verdict = indexVerdict(setIndex(dynamoDbClient, s3Client, tableName, uploadEvent.setId), uploadEvent.objectKey)
+            item = buildEventItem(uploadEvent, verdict)
+        except (BotoCoreError, ClientError, ValueError) as error:
+            print("ERROR: Unable to process message " + record['messageId'] + ": " + repr(error))
+            failedMessageIds.append(record['messageId'])
+            continue
+        key = itemKey(item)
+        if key not in recordsByKey or uploadEvent.eventTime >= recordsByKey[key].uploadEvent.eventTime:
+            recordsByKey[key] = UploadRecord(uploadEvent, item, verdict)
+        messageIdsByKey.setdefault(key, []).append(record['messageId'])
+        if trace is not None:
+            sentTimestamp = record.get('attributes', {}).get('SentTimestamp')
+            if sentTimestamp:
+                addStamp(trace, 'buffered', int(sentTimestamp))
+            addStamp(trace, 'delivered', receivedMs)
+            tracesByKey.setdefault(key, []).append(trace)
+
+    # Record the events of each shard of each logical dataset, items are grouped by
+    # partition key, which identifies the shard. Each transaction writes the items and
+    # the change to the running aggregates of the shard, or nothing, in which case the
+    # messages of its events are returned to the queue
+    recordsByPartition = {}
+    for key, uploadRecord in recordsByKey.items():
+        recordsByPartition.setdefault(key[0], []).append(uploadRecord)
+    keysByShard = {}
+    lateKeys = []
+    writtenCount = 0
+    uploadBytes = 0
+    fileCount = 0
+    for partitionKey, records in recordsByPartition.items():
+        setId, shard = partitionShard(partitionKey)
+        for start in range(0, len(records), transactMaxEvents):
+            chunk = records[start:start + transactMaxEvents]
+            chunkKeys = [itemKey(uploadRecord.item) for uploadRecord in chunk]
+            try:
+                outcome = recordUploadEvents(dynamoDbClient, tableName, shard, chunk)
+            except (BotoCoreError, ClientError) as error:
+                print("ERROR: Unable to record " + str(len(chunk)) + " upload events for " + partitionKey + ": " + repr(error))
+                for key in chunkKeys:
+                    failedMessageIds.extend(messageIdsByKey[key])
+                continue
+            if outcome.compacted:
+                print("Upload events for compacted set " + setId + " dropped: " + str(len(chunk)))
+                lateKeys.extend(chunkKeys)
+                continue
+            writtenMs = nowMs()
+            for uploadRecord in outcome.written:
+                for trace in tracesByKey.get(itemKey(uploadRecord.item), []):
+                    addStamp(trace, 'written', writtenMs)
+                    recordHops(trace, ('buffered', 'delivered', 'written'))
+                uploadBytes += uploadRecord.uploadEvent.objectSize
+            writtenCount += len(outcome.written)
+            duplicateCount += len(outcome.dropped)
+            fileCount += outcome.fileCount
+            keysByShard.setdefault((setId, shard), []).extend(chunkKeys)
+    if duplicateCount:
+        print("Duplicate upload events dropped: " + str(duplicateCount))
+    addCount('ItemsWritten', writtenCount)
+    addCount('UploadBytes', uploadBytes, 'Bytes')
+    addCount('DuplicatesDropped', duplicateCount)
+    addCount('FilesRecorded', fileCount)
+    addCount('LateEventsDropped', len(lateKeys))
+
+    # Resume the waiting reconcile execution of each shard that is now complete, also
+    # for events already recorded, in case their first delivery failed before resuming
+    # it. Events are only remembered as recorded once this is done, and the messages of
+    # a shard that could not be checked are returned to the queue, so the check is
+    # repeated when they are redelivered. Events of compacted sets need no check
+    for key in lateKeys:
+        uploadEvent = recordsByKey[key].uploadEvent
+        rememberEvent(dedupKey(uploadEvent.setId, uploadEvent.objectKey, uploadEvent.eventTime))
+    for (setId, shard), keys in keysByShard.items():
+        try:
+            resumeShardIfComplete(dynamoDbClient, sfnClient, tableName, setId, shard)
+        except (BotoCoreError, ClientError) as error:
+            print("ERROR: Unable to check shard " + str(shard) + " of set " + setId + " for completion: " + repr(error))
+            addCount('FailedResumes')
+            for key in keys:
+                failedMessageIds.extend(messageIdsByKey[key])
+            continue
+        for key in keys:
+            uploadEvent = recordsByKey[key].uploadEvent
+            rememberEvent(dedupKey(uploadEvent.setId, uploadEvent.objectKey, uploadEvent.eventTime))
+
+    addCount('FailedMessages', len(failedMessageIds))
+
+    return {
+        'batchItemFailures': [{'itemIdentifier': messageId} for messageId in failedMessageIds]
+    }
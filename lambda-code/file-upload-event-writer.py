@@ -2,48 +2,87 @@
 # FILE: file-upload-event-writer.py
 #
 # DESCRIPTION: Processes EventBridge event payload to write metadata for file upload
-# notifications to a DynamoDB table.
+# notifications to a DynamoDB table, and update the running aggregates kept for the
+# logical dataset.
 #
 # NOTES: Part of an AWS CDK application. View the README.md file in this repository 
 # for further information on the application architecture. 
 #===================================================================================
 
-import json
-import boto3
 import os
+from botocore.exceptions import BotoCoreError, ClientError
+from aws_clients import LazyClient
+from embedded_metrics import emitsMetrics, addCount
+from expected_key_index import setIndex, indexVerdict
+from file_upload_event_table import buildEventItem, shardOf
+from reconcile_callback import resumeShardIfComplete
+from upload_dedup import dedupKey, isRecentDuplicate, rememberEvent
+from upload_event_recorder import UploadRecord, recordUploadEvents
+from upload_trace import addStamp, recordHops, traceProperty
+from vault_event_codec import parseDetail, parseTrace
 
-dynamoDbClient = boto3.client('dynamodb')
+dynamoDbClient = LazyClient('dynamodb')
+sfnClient = LazyClient('stepfunctions')
+s3Client = LazyClient('s3')
 
+# Configuration from the function environment, read once per execution environment
+tableName = os.environ.get('dynamoDbTableName')
+
+@emitsMetrics
 def lambda_handler(event, context):
 
-    # Set variables based on values recieved from EventBridge event
-    setId=event['detail']['set-id']
-    eventTime=event['detail']['event-time']
-    bucketName=event['detail']['bucket-name']
-    objectKey=event['detail']['object-key']
-    objectSize=event['detail']['object-size']
-    
-    # Write metadata to the DynamoDB table
-    dynamoDbClient.put_item(
-        TableName=os.environ.get('dynamoDbTableName'),
-        Item={
-            'setId': {
-                'S':setId,
-            },
-            'objectKey': {
-                'S':objectKey,
-            },
-            'bucketName': {
-                'S':bucketName,
-            },
-            'objectSize': {
-                'N':str(objectSize),
-            },
-            'eventTime': {
-                'N':str(eventTime),
-            },
-        },
-        )
+    # Drop upload events this execution environment has already recorded
+    uploadEvent = parseDetail(event['detail'])
+    trace = parseTrace(event['detail'])
+    if trace is not None:
+        addStamp(trace, 'delivered')
+        traceProperty(trace)
+    key = dedupKey(uploadEvent.setId, uploadEvent.objectKey, uploadEvent.eventTime)
+    if isRecentDuplicate(key):
+        print("Duplicate upload event dropped: " + uploadEvent.objectKey)
+        addCount('DuplicatesDropped')
+        return {
+            'statusCode': 200
+        }
+
+    # Write metadata recieved from the EventBridge event to the DynamoDB table, and the
+    # change to the running aggregates of the shard of the logical dataset the object
+    # is stored in, unless the same or a later upload of the object is already
+    # recorded or the logical dataset has been compacted. The object is checked
+    # against the expected key index of the logical dataset, if it has one
+    try:
+        verdict = indexVerdict(setIndex(dynamoDbClient, s3Client, tableName, uploadEvent.setId), uploadEvent.objectKey)
+    except (BotoCoreError, ClientError) as error:
+        # The invocation fails, and is retried by EventBridge
+        print("ERROR: Unable to read the expected key index of set " + uploadEvent.setId + " for " + uploadEvent.objectKey + ": " + repr(error))
+        addCount('FailedMessages')
+        raise
+    shard = shardOf(uploadEvent.objectKey)
+    outcome = recordUploadEvents(dynamoDbClient, tableName, shard, [UploadRecord(uploadEvent, buildEventItem(uploadEvent, verdict), verdict)])
+    if outcome.compacted:
+        print("Upload event for compacted set " + uploadEvent.setId + " dropped: " + uploadEvent.objectKey)
+        addCount('LateEventsDropped')
+        rememberEvent(key)
+        return {
+            'statusCode': 200
+        }
+    if trace is not None and outcome.written:
+        addStamp(trace, 'written')
+        recordHops(trace, ('delivered', 'written'))
+
+    # Resume the waiting reconcile execution if the shard is now complete. This is also
+    # done for an event already recorded, in case its first delivery failed before
+    # resuming the execution
+    resumeShardIfComplete(dynamoDbClient, sfnClient, tableName, uploadEvent.setId, shard)
+    rememberEvent(key)
+    if outcome.dropped:
+        print("Duplicate upload event dropped: " + uploadEvent.objectKey)
+        addCount('DuplicatesDropped')
+        return {
+            'statusCode': 200
+        }
+    addCount('FilesRecorded', outcome.fileCount)
+    addCount('UploadBytes', uploadEvent.objectSize, 'Bytes')
     
     return {
         'statusCode': 200
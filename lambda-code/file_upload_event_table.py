@@ -0,0 +1,287 @@
+#===================================================================================
+# FILE: file_upload_event_table.py
+#
+# DESCRIPTION: Shared helpers used by the file upload event writer and reconcile
+# functions to build and read the items stored in the DynamoDB file upload event
+# table, including the running aggregates kept for each shard of a logical dataset.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository 
+# for further information on the application architecture. 
+#===================================================================================
+
+import hashlib
+import os
+import time
+
+# Number of shards the items of each logical dataset are spread over, read once per
+# execution environment. Must not change while any logical dataset is in progress
+shardCount = int(os.environ.get('fileUploadTableShardCount', '1'))
+shardPartitionSeparator = '#shard'
+
+# Format of the items written for file upload events, read once per execution
+# environment. "compact" items store the object key relative to the job directory of
+# the logical dataset, and short attribute names. "full" items store the object key,
+# the bucket name and full attribute names. Objects with no name below the job
+# directory (the directory object itself) are always stored in full items
+itemFormat = os.environ.get('fileUploadTableItemFormat', 'compact')
+
+# Attribute names of compact items, by the attribute names of full items. The bucket
+# name and job directory, the same for every object of a logical dataset, are kept in
+# the running aggregates items of the dataset instead
+compactAttributeNames = {
+    'objectSize': 's',
+    'eventTime': 't',
+    'indexMatch': 'm',
+}
+
+def shardOf(objectKey):
+    # Shard of an object, derived from the hash of its key name
+    return keyHash(objectKey) % shardCount
+
+def shardPartitionKey(setId, shard):
+    # Partition key value of a shard of a logical dataset. Without sharding every item
+    # of the dataset is stored under its ID, otherwise under "[ID]#shard[N]" so the
+    # writes for a large dataset are not limited by the throughput of one partition
+    if shardCount == 1:
+        return setId
+    return setId + shardPartitionSeparator + str(shard)
+
+def partitionShard(partitionKey):
+    # Logical dataset ID and shard of a partition key value
+    if shardCount == 1:
+        return partitionKey, 0
+    setId, separator, shard = partitionKey.rpartition(shardPartitionSeparator)
+    return setId, int(shard)
+
+def setDirectory(objectKey):
+    # Job directory of an object of a logical dataset, the first component of its key
+    return objectKey.split('/', 1)[0]
+
+def compactObjectKey(objectKey):
+    # Object key relative to the job directory of its logical dataset, as stored in
+    # compact items. None if the object has no name below the directory
+    return objectKey.partition('/')[2] or None
+
+def storedObjectKey(objectKey):
+    # Sort key value an object is stored under, in the configured item format
+    if itemFormat == 'compact':
+        return compactObjectKey(objectKey) or objectKey
+    return objectKey
+
+def buildEventItem(uploadEvent, indexMatch=None):
+    # Build the DynamoDB item for a "data" or "manifest" file upload event from the
+    # event sent by the "check file upload type" function, as parsed by
+    # vault_event_codec.py, in the configured item format. The verdict of the expected
+    # key index of the logical dataset, if it was checked (see expected_key_index.py),
+    # is stored with the item
+    relativeKey = compactObjectKey(uploadEvent.objectKey) if itemFormat == 'compact' else None
+    if relativeKey is not None:
+        item = {
+            'setId': {
+                'S':shardPartitionKey(uploadEvent.setId, shardOf(uploadEvent.objectKey)),
+            },
+            'objectKey': {
+                'S':relativeKey,
+            },
+            compactAttributeNames['objectSize']: {
+                'N':str(uploadEvent.objectSize),
+            },
+            compactAttributeNames['eventTime']: {
+                'N':str(uploadEvent.eventTime),
+            },
+        }
+        if indexMatch is not None:
+            item[compactAttributeNames['indexMatch']] = {
+                'N':str(indexMatch),
+            }
+        return item
+    item = {
+        'setId': {
+            'S':shardPartitionKey(uploadEvent.setId, shardOf(uploadEvent.objectKey)),
+        },
+        'objectKey': {
+            'S':uploadEvent.objectKey,
+        },
+        'bucketName': {
+            'S':uploadEvent.bucketName,
+        },
+        'objectSize': {
+            'N':str(uploadEvent.objectSize),
+        },
+        'eventTime': {
+            'N':str(uploadEvent.eventTime),
+        },
+    }
+    if indexMatch is not None:
+        item['indexMatch'] = {
+            'N':str(indexMatch),
+        }
+    return item
+
+def itemKey(item):
+    # Primary key values of an item, used to match items between requests and responses
+    return (item['setId']['S'], item['objectKey']['S'])
+
+def isFullItem(item):
+    # True if an item is in the full format. Only full items hold the bucket name
+    return 'bucketName' in item
+
+def itemObjectKey(item, setDir):
+    # Object key of an item of either format, given the job directory of its logical
+    # dataset
+    if isFullItem(item):
+        return item['objectKey']['S']
+    return setDir + '/' + item['objectKey']['S']
+
+def itemObjectKeys(items, setDir):
+    # Object keys of a list of items, given the job directory of their logical
+    # dataset, as two lists - the keys of the items in the configured format, and of
+    # the items in the other format (written before the format was changed, or objects
+    # that cannot be stored in compact items)
+    prefix = setDir + '/'
+    compactKeys = [prefix + item['objectKey']['S'] for item in items if 'bucketName' not in item]
+    fullKeys = [item['objectKey']['S'] for item in items if 'bucketName' in item]
+    if itemFormat == 'compact':
+        return compactKeys, fullKeys
+    return fullKeys, compactKeys
+
+def itemObjectSizes(items):
+    # Object sizes of a list of items, as two lists in the same order as the object keys
+    # returned by itemObjectKeys
+    compactSizes = [itemNumber(item, 'objectSize') for item in items if 'bucketName' not in item]
+    fullSizes = [itemNumber(item, 'objectSize') for item in items if 'bucketName' in item]
+    if itemFormat == 'compact':
+        return compactSizes, fullSizes
+    return fullSizes, compactSizes
+
+def itemNumber(item, attributeName):
+    # Value of a number attribute of an item of either format, by its full name
+    if attributeName in item:
+        return int(item[attributeName]['N'])
+    return int(item[compactAttributeNames[attributeName]]['N'])
+
+def isNewerEvent(uploadEvent, oldItem):
+    # True if an upload event is newer than the stored item of its object (None if the
+    # object has not been seen). A redelivered event, or one delivered after a later
+    # upload of the same object, is not
+    return oldItem is None or itemNumber(oldItem, 'eventTime') < uploadEvent.eventTime
+
+def storedVersionCondition(oldItem):
+    # Condition expression, and its attribute values (None if it has none), for writing
+    # the item of an upload event only if the stored item of the object is still
+    # oldItem - the object has not been seen (None), or was last seen in the same
+    # upload event (the item may be in either format). Fails if another upload event
+    # of the object has been recorded since oldItem was read
+    if oldItem is None:
+        return 'attribute_not_exists(objectKey)', None
+    attributeName = 'eventTime' if 'eventTime' in oldItem else compactAttributeNames['eventTime']
+    return attributeName + ' = :storedEventTime', {
+        ':storedEventTime': oldItem[attributeName],
+    }
+
+# Running aggregates for each shard of a logical dataset are kept in a single item
+# stored in a separate partition of the same table, so they never appear in the
+# results of a query for the file upload events of the dataset. The aggregates of the
+# dataset are the sums of those of its shards. Once the dataset has been compacted
+# the aggregates are kept, marked with the time it was compacted, and no upload event
+# can be recorded for it any more
+setItemPartitionSuffix = '#set'
+aggregateSortKey = 'aggregate'
+compactedAttributeName = 'compactedTime'
+
+def keyHash(objectKey):
+    # 64-bit hash of an object key. Summing the hashes of a set of keys gives an order
+    # independent digest of the set that stays well within the precision of a DynamoDB
+    # number attribute (38 digits) for datasets of any realistic size, which a sum of
+    # 128-bit hashes would not. The digest is only used to decide when to compare the
+    # key names in full, see reconcile-check.py
+    return int.from_bytes(hashlib.blake2b(objectKey.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def aggregateKey(setId, shard):
+    # Primary key of the running aggregates item for a shard of a logical dataset
+    return {
+        'setId': {
+            'S':shardPartitionKey(setId, shard) + setItemPartitionSuffix,
+        },
+        'objectKey': {
+            'S':aggregateSortKey,
+        },
+    }
+
+def aggregateDelta(uploadEvent, oldItem):
+    # Change in file count, total bytes and key digest caused by writing the item for an
+    # upload event over the previous version of the same item (None if the object had
+    # not been seen)
+    if oldItem is None:
+        return 1, uploadEvent.objectSize, keyHash(uploadEvent.objectKey)
+    return 0, uploadEvent.objectSize - itemNumber(oldItem, 'objectSize'), 0
+
+def aggregateUpdate(tableName, uploadEvent, shard, fileCount, totalBytes, keyDigest, eventTime, matchedCount=0, unexpectedCount=0):
+    # Update request applying a change to the running aggregates of a shard of the
+    # logical dataset of an upload event, also storing the bucket name and job
+    # directory of the dataset, the event time of the first upload event recorded for
+    # the shard (used with the last to estimate the arrival rate, see set_progress.py)
+    # and the time (epoch milliseconds) of the write, used to trace how long the
+    # dataset took to reconcile after its last file was recorded. Files checked against
+    # the expected key index of the dataset are also counted as matched or unexpected
+    # (see expected_key_index.py). Written in the same transaction as the items of the
+    # upload events, see upload_event_recorder.py, which fails if the logical dataset
+    # has been compacted
+    indexValues = {}
+    if matchedCount or unexpectedCount:
+        indexValues = {
+            ':matchedFileCount': {
+                'N':str(matchedCount),
+            },
+            ':unexpectedFileCount': {
+                'N':str(unexpectedCount),
+            },
+        }
+    return {
+        'TableName': tableName,
+        'Key': aggregateKey(uploadEvent.setId, shard),
+        'ConditionExpression': 'attribute_not_exists(' + compactedAttributeName + ')',
+        'UpdateExpression': 'ADD fileCount :fileCount, totalBytes :totalBytes, keyDigest :keyDigest' + (', matchedFileCount :matchedFileCount, unexpectedFileCount :unexpectedFileCount' if indexValues else '') + ' SET firstEventTime = if_not_exists(firstEventTime, :firstEventTime), lastEventTime = :eventTime, lastWriteTime = :writeTime, bucketName = :bucketName, setDirectory = :setDirectory',
+        'ExpressionAttributeValues': dict({
+            ':fileCount': {
+                'N':str(fileCount),
+            },
+            ':totalBytes': {
+                'N':str(totalBytes),
+            },
+            ':keyDigest': {
+                'N':str(keyDigest),
+            },
+            ':firstEventTime': {
+                'N':str(uploadEvent.eventTime),
+            },
+            ':eventTime': {
+                'N':str(eventTime),
+            },
+            ':writeTime': {
+                'N':str(int(time.time() * 1000)),
+            },
+            ':bucketName': {
+                'S':uploadEvent.bucketName,
+            },
+            ':setDirectory': {
+                'S':setDirectory(uploadEvent.objectKey),
+            },
+        }, **indexValues),
+    }
+
+def markCompacted(dynamoDbClient, tableName, setId, shard, compactedTime):
+    # Mark the running aggregates of a shard of a logical dataset as compacted, keeping
+    # the time it was first marked. Creates the item of a shard no upload event was
+    # recorded for, so that none can be
+    dynamoDbClient.update_item(
+        TableName=tableName,
+        Key=aggregateKey(setId, shard),
+        UpdateExpression='SET ' + compactedAttributeName + ' = if_not_exists(' + compactedAttributeName + ', :compactedTime)',
+        ExpressionAttributeValues={
+            ':compactedTime': {
+                'N':str(compactedTime),
+            },
+        },
+        ReturnConsumedCapacity='TOTAL',
+        )
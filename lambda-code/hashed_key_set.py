@@ -0,0 +1,267 @@
+#===================================================================================
+# FILE: hashed_key_set.py
+#
+# DESCRIPTION: Memory-compact comparison of large sets of S3 key names, used by the
+# reconcile functions. A set of key names is held as a sorted array of their 64-bit
+# key hashes, using NumPy when it is available to the function.
+#
+# A 64-bit hash can only hide a difference if a key missing from one set and a key
+# unexpected in it have the same hash - for sets of millions of keys the chance of
+# this is in the order of one in a trillion.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import array
+import bisect
+import collections
+import hashlib
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Size of the chunks a file body is split into lines in, see rangeLineDigests
+lineChunkBytes = 1024 * 1024
+
+def keyDigests(keyNames):
+    # Key hashes of key names (str, or UTF-8 encoded bytes) as concatenated 8-byte big
+    # endian digests - a compact form to accumulate, e.g. page by page, before sorting
+    blake2b = hashlib.blake2b
+    return b''.join([blake2b(keyName.encode('utf-8') if isinstance(keyName, str) else keyName, digest_size=8).digest()
+        for keyName in keyNames])
+
+def lineDigests(body):
+    # Key hashes of the lines of a file body (bytes), as keyDigests
+    return rangeLineDigests(body, [])[0]
+
+def bodyLines(body, start=0):
+    # Lines of a file body (bytes) from an offset, split a chunk at a time so the lines
+    # of a large file are never all held
+    while start < len(body):
+        end = body.find(b'\n', start + lineChunkBytes)
+        end = len(body) if end < 0 else end + 1
+        yield body[start:end].splitlines()
+        start = end
+
+def rangeLineDigests(body, boundaries, start=0):
+    # Key hashes of the lines of a file body (bytes) from an offset, as keyDigests, for
+    # each key range between sorted, UTF-8 encoded boundaries (see key_ranges.py)
+    rangeDigests = [[] for index in range(len(boundaries) + 1)]
+    for lines in bodyLines(body, start):
+        if not boundaries:
+            rangeDigests[0].append(keyDigests(lines))
+            continue
+        rangeLines = [[] for index in range(len(boundaries) + 1)]
+        for line in lines:
+            rangeLines[bisect.bisect_right(boundaries, line)].append(line)
+        for index, lines in enumerate(rangeLines):
+            rangeDigests[index].append(keyDigests(lines))
+    return [b''.join(digests) for digests in rangeDigests]
+
+def rangeSizedLineDigests(body, boundaries, parseLine, start=0):
+    # Key hashes of the key names, and the sizes, listed in the lines of a file body
+    # (bytes) from an offset, for each key range between sorted, UTF-8 encoded
+    # boundaries. parseLine maps a line to its key name (bytes) and size. Returns the
+    # key hashes of each range as keyDigests and the sizes in the same order, as
+    # serialised size arrays
+    rangeDigests = [[] for index in range(len(boundaries) + 1)]
+    rangeSizes = [array.array('q') for index in range(len(boundaries) + 1)]
+    for lines in bodyLines(body, start):
+        rangeKeys = [[] for index in range(len(boundaries) + 1)]
+        for line in lines:
+            keyName, size = parseLine(line)
+            index = bisect.bisect_right(boundaries, keyName) if boundaries else 0
+            rangeKeys[index].append(keyName)
+            rangeSizes[index].append(size)
+        for index, keyNames in enumerate(rangeKeys):
+            rangeDigests[index].append(keyDigests(keyNames))
+    return [b''.join(digests) for digests in rangeDigests], [sizes.tobytes() for sizes in rangeSizes]
+
+def hashArray(digests):
+    # Array of the key hashes in concatenated digests, in the same order
+    if numpy is not None:
+        return numpy.frombuffer(digests, dtype='>u8').astype(numpy.uint64)
+    hashes = array.array('Q')
+    hashes.frombytes(digests)
+    if sys.byteorder == 'little':
+        hashes.byteswap()
+    return hashes
+
+def sortedHashArray(digests):
+    # Sorted array of the key hashes in concatenated digests
+    hashes = hashArray(digests)
+    if numpy is not None:
+        hashes.sort()
+        return hashes
+    return array.array('Q', sorted(hashes))
+
+def rangeSortedHashArray(rangeDigests):
+    # A single array of the key hashes in the concatenated digests of each key range,
+    # each range sorted separately, and the offsets in the array where each range
+    # starts (followed by the length of the array)
+    offsets = [0]
+    for digests in rangeDigests:
+        offsets.append(offsets[-1] + len(digests) // 8)
+    if numpy is not None:
+        hashes = numpy.frombuffer(b''.join(rangeDigests), dtype='>u8').astype(numpy.uint64)
+        for index in range(len(rangeDigests)):
+            hashes[offsets[index]:offsets[index + 1]].sort()
+        return hashes, offsets
+    hashes = array.array('Q')
+    for digests in rangeDigests:
+        hashes.extend(sortedHashArray(digests))
+    return hashes, offsets
+
+def rangeSortedSizedHashArray(rangeDigests, rangeSizes):
+    # As rangeSortedHashArray, for key hashes with sizes - also returns an array of the
+    # sizes (serialised size arrays for each range, see rangeSizedLineDigests) in the
+    # same order as the key hashes
+    offsets = [0]
+    for digests in rangeDigests:
+        offsets.append(offsets[-1] + len(digests) // 8)
+    if numpy is not None:
+        hashes = hashArray(b''.join(rangeDigests))
+        sizes = numpy.frombuffer(b''.join(rangeSizes), dtype=numpy.int64).copy()
+        for index in range(len(rangeDigests)):
+            order = numpy.argsort(hashes[offsets[index]:offsets[index + 1]], kind='stable')
+            hashes[offsets[index]:offsets[index + 1]] = hashes[offsets[index]:offsets[index + 1]][order]
+            sizes[offsets[index]:offsets[index + 1]] = sizes[offsets[index]:offsets[index + 1]][order]
+        return hashes, sizes, offsets
+    hashes = array.array('Q')
+    sizes = array.array('q')
+    for digests, sizeBytes in zip(rangeDigests, rangeSizes):
+        pairs = sorted(zip(hashArray(digests), sizeArrayFromBytes(sizeBytes)))
+        hashes.extend(keyHash for keyHash, size in pairs)
+        sizes.extend(size for keyHash, size in pairs)
+    return hashes, sizes, offsets
+
+def sortedSizedHashArray(digests, sizeBytes):
+    # Sorted array of the key hashes in concatenated digests, and an array of their
+    # sizes in the same order
+    hashes, sizes, offsets = rangeSortedSizedHashArray([digests], [sizeBytes])
+    return hashes, sizes
+
+def hashArrayBytes(hashes):
+    # Serialise a hash (or size) array (native byte order), e.g. to cache it in /tmp
+    return hashes.tobytes()
+
+def hashArrayFromBytes(data):
+    # Hash array from the output of hashArrayBytes
+    if numpy is not None:
+        return numpy.frombuffer(data, dtype=numpy.uint64)
+    hashes = array.array('Q')
+    hashes.frombytes(data)
+    return hashes
+
+def sizeArrayFromBytes(data):
+    # Size array from the output of hashArrayBytes
+    if numpy is not None:
+        return numpy.frombuffer(data, dtype=numpy.int64)
+    sizes = array.array('q')
+    sizes.frombytes(data)
+    return sizes
+
+def hashSum(hashes):
+    # Exact sum of the hashes in an array - the key digest of the set. With NumPy the
+    # high and low 32 bits are summed separately so neither sum can overflow
+    if numpy is not None:
+        high = (hashes >> numpy.uint64(32)).sum(dtype=numpy.uint64)
+        low = (hashes & numpy.uint64(0xffffffff)).sum(dtype=numpy.uint64)
+        return (int(high) << 32) + int(low)
+    return sum(hashes)
+
+def countByShard(hashes, shardCount):
+    # Number of hashes in each shard (see file_upload_event_table.shardOf)
+    if numpy is not None:
+        return [int(count) for count in numpy.bincount((hashes % numpy.uint64(shardCount)).astype(numpy.intp), minlength=shardCount)]
+    counts = collections.Counter(keyHash % shardCount for keyHash in hashes)
+    return [counts[shard] for shard in range(shardCount)]
+
+def countContained(sortedHashes, hashes):
+    # Number of the hashes in an array that are in a sorted hash array
+    if numpy is not None:
+        if not len(sortedHashes) or not len(hashes):
+            return 0
+        positions = numpy.minimum(numpy.searchsorted(sortedHashes, hashes), len(sortedHashes) - 1)
+        return int(numpy.count_nonzero(sortedHashes[positions] == hashes))
+    found = 0
+    for keyHash in hashes:
+        position = bisect.bisect_left(sortedHashes, keyHash)
+        if position < len(sortedHashes) and sortedHashes[position] == keyHash:
+            found += 1
+    return found
+
+def hashArraysEqual(expectedHashes, actualHashes):
+    # True if two sorted hash arrays hold the same hashes
+    if len(expectedHashes) != len(actualHashes):
+        return False
+    if numpy is not None:
+        return bool(numpy.array_equal(expectedHashes, actualHashes))
+    return expectedHashes == actualHashes
+
+def differingHashes(expectedHashes, actualHashes):
+    # Hashes in the expected sorted array but not in the actual one (missing), and in
+    # the actual array but not in the expected one (unexpected), as sets
+    if numpy is not None:
+        return (set(numpy.setdiff1d(expectedHashes, actualHashes, assume_unique=False).tolist()),
+            set(numpy.setdiff1d(actualHashes, expectedHashes, assume_unique=False).tolist()))
+
+    # Merge walk over the two sorted arrays
+    missing = set()
+    unexpected = set()
+    expectedIndex = actualIndex = 0
+    while expectedIndex < len(expectedHashes) and actualIndex < len(actualHashes):
+        expected = expectedHashes[expectedIndex]
+        actual = actualHashes[actualIndex]
+        if expected == actual:
+            expectedIndex += 1
+            actualIndex += 1
+        elif expected < actual:
+            missing.add(expected)
+            expectedIndex += 1
+        else:
+            unexpected.add(actual)
+            actualIndex += 1
+    missing.update(expectedHashes[expectedIndex:])
+    unexpected.update(actualHashes[actualIndex:])
+    return missing, unexpected
+
+def differingSizes(expectedHashes, expectedSizes, actualHashes, actualSizes):
+    # Hashes in both sorted arrays whose sizes differ, as a set. Expected sizes below
+    # zero are not known, and never differ
+    if numpy is not None:
+        if hashArraysEqual(expectedHashes, actualHashes):
+            return set(expectedHashes[(expectedSizes >= 0) & (expectedSizes != actualSizes)].tolist())
+        common, expectedIndexes, actualIndexes = numpy.intersect1d(expectedHashes, actualHashes, return_indices=True)
+        expectedSizes = expectedSizes[expectedIndexes]
+        return set(common[(expectedSizes >= 0) & (expectedSizes != actualSizes[actualIndexes])].tolist())
+
+    # Merge walk over the two sorted arrays
+    differing = set()
+    expectedIndex = actualIndex = 0
+    while expectedIndex < len(expectedHashes) and actualIndex < len(actualHashes):
+        expected = expectedHashes[expectedIndex]
+        actual = actualHashes[actualIndex]
+        if expected == actual:
+            if 0 <= expectedSizes[expectedIndex] != actualSizes[actualIndex]:
+                differing.add(expected)
+            expectedIndex += 1
+            actualIndex += 1
+        elif expected < actual:
+            expectedIndex += 1
+        else:
+            actualIndex += 1
+    return differing
+
+def matchingKeyNames(keyNames, hashes):
+    # The key names, from an iterable of key names, whose key hashes are in a set of
+    # hashes. Used to name the keys behind differing hashes, yielded in the order of the
+    # iterable so that any number of them can be streamed without holding them all
+    blake2b = hashlib.blake2b
+    for keyName in keyNames:
+        if int.from_bytes(blake2b(keyName.encode('utf-8'), digest_size=8).digest(), 'big') in hashes:
+            yield keyName
@@ -0,0 +1,65 @@
+#===================================================================================
+# FILE: key_ranges.py
+#
+# DESCRIPTION: Splits the key names of a logical dataset into key ranges, chosen
+# from a sample of the manifest file, so that the reconcile check function can read
+# and compare each range separately and in parallel.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import os
+
+# Maximum number of key ranges a manifest file is split into, read once per execution
+# environment. Manifests are never split into ranges of fewer than rangeMinFiles files
+rangeCount = int(os.environ.get('reconcileRangeCount', '1'))
+rangeMinFiles = 10000
+
+# Number of manifest lines sampled for each range to choose the boundaries
+rangeSampleLines = 64
+
+def rangeBoundaries(body, setDir):
+    # Boundaries between the key ranges of a manifest file body (bytes), as sorted,
+    # distinct key names. Lines are sampled at evenly spaced offsets in the body, so
+    # the manifest does not need to be sorted, or split into lines, first. Only key
+    # names below the job directory of the logical dataset are used, so the boundaries
+    # keep their order when stored relative to it (see file_upload_event_table.py).
+    # Lines of manifests in the extended format (see manifest_format.py) are sampled
+    # up to the first tab, their key name
+    prefix = setDir.encode('utf-8') + b'/'
+    ranges = min(rangeCount, body.count(b'\n') // rangeMinFiles)
+    if ranges <= 1:
+        return []
+    sampleCount = ranges * rangeSampleLines
+    sample = set()
+    for index in range(sampleCount):
+        offset = len(body) * index // sampleCount
+        start = body.rfind(b'\n', 0, offset) + 1
+        end = body.find(b'\n', offset)
+        line = body[start:len(body) if end < 0 else end].rstrip(b'\r').partition(b'\t')[0]
+        try:
+            if line.startswith(prefix) and len(line) > len(prefix):
+                sample.add(line.decode('utf-8'))
+        except UnicodeDecodeError:
+            continue
+    sample = sorted(sample)
+    if not sample:
+        return []
+    return sorted(set(sample[len(sample) * index // ranges] for index in range(1, ranges)))
+
+def rangeKeyCondition(boundaries, rangeIndex):
+    # Sort key condition of the DynamoDB query for a key range, to add to the partition
+    # key condition, and its attribute values. A query condition on the sort key has no
+    # exclusive upper bound, so the key name at the end of the range is also returned -
+    # the query returns it, if it exists, but it belongs to the next range
+    if not boundaries:
+        return '', {}, None
+    if rangeIndex == 0:
+        return ' AND objectKey < :rangeEnd', {':rangeEnd': {'S':boundaries[0]}}, None
+    if rangeIndex == len(boundaries):
+        return ' AND objectKey >= :rangeStart', {':rangeStart': {'S':boundaries[-1]}}, None
+    return ' AND objectKey BETWEEN :rangeStart AND :rangeEnd', {
+        ':rangeStart': {'S':boundaries[rangeIndex - 1]},
+        ':rangeEnd': {'S':boundaries[rangeIndex]},
+    }, boundaries[rangeIndex]
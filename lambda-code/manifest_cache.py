@@ -0,0 +1,199 @@
+#===================================================================================
+# FILE: manifest_cache.py
+#
+# DESCRIPTION: Downloads and parses "manifest" files for the reconcile functions,
+# and caches the parsed result across invocations of a warm function, in memory and
+# in /tmp.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import collections
+import hashlib
+import json
+import os
+from botocore.exceptions import ClientError
+from hashed_key_set import rangeLineDigests, rangeSizedLineDigests, rangeSortedHashArray, rangeSortedSizedHashArray, hashArrayBytes, hashArrayFromBytes, sizeArrayFromBytes, hashSum
+from file_upload_event_table import setDirectory
+from key_ranges import rangeBoundaries
+from manifest_format import decompressManifest, linesStart, parseLine, manifestKeyNames
+
+# Manifest files larger than a single range are downloaded with parallel ranged GETs
+manifestRangeBytes = 8 * 1024 * 1024
+
+# Cache limits - total size of the parsed manifests held in memory (a quarter of the
+# memory configured for the function) and spilled to /tmp
+memoryCacheMaxBytes = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '1024')) * 1024 * 1024 // 4
+diskCacheMaxBytes = 384 * 1024 * 1024
+diskCacheDir = '/tmp/manifest-cache'
+
+# Format of the files in the disk cache. Files in any other format are ignored
+diskCacheFormat = 'sizedKeyHashRanges'
+
+# A parsed manifest. keyHashes holds the key hashes of the key names, sorted within
+# each key range, count is the number of key names and keyDigest the sum of their key
+# hashes (see file_upload_event_table.keyHash). rangeBoundaries holds the key names
+# between the key ranges and rangeOffsets where each range starts in keyHashes.
+# keySizes holds the object size of each key, in the same order as keyHashes, for
+# manifests in the extended format (None otherwise)
+Manifest = collections.namedtuple('Manifest', ['etag', 'keyHashes', 'count', 'keyDigest', 'rangeBoundaries', 'rangeOffsets', 'keySizes'])
+
+memoryCache = collections.OrderedDict()
+memoryCacheBytes = 0
+
+def getManifest(s3Client, executor, bucketName, objectKey, stats):
+    # Return the parsed manifest file, using the cached copy if the object has not
+    # changed since it was cached. Records where the manifest came from, and how much
+    # was downloaded, in the stats dict
+    cacheKey = (bucketName, objectKey)
+    manifest = memoryCache.get(cacheKey)
+    stats['manifestCache'] = 'memory'
+    if manifest is None:
+        manifest = readDiskCache(cacheKey)
+        stats['manifestCache'] = 'disk'
+    stats['manifestBytes'] = 0
+    stats['manifestRanges'] = 0
+
+    # Revalidate the cached copy, or download the manifest if there is none
+    body, etag, ranges = downloadManifest(s3Client, executor, bucketName, objectKey, manifest.etag if manifest else None)
+    if body is None:
+        putMemoryCache(cacheKey, manifest)
+        return manifest
+
+    stats['manifestCache'] = 'miss'
+    stats['manifestBytes'] = len(body)
+    stats['manifestRanges'] = ranges
+    body, stats['manifestCompression'] = decompressManifest(body)
+    manifest = parseManifest(etag, body, setDirectory(objectKey))
+    stats['manifestFormat'] = 'plain' if manifest.keySizes is None else 'extended'
+    putMemoryCache(cacheKey, manifest)
+    writeDiskCache(cacheKey, manifest)
+    return manifest
+
+def parseManifest(etag, body, setDir):
+    # Parse the decompressed contents of a manifest file, in the job directory setDir,
+    # into the compact cached form. The key names are hashed as UTF-8 bytes, so they
+    # are never decoded
+    boundaries = rangeBoundaries(body, setDir)
+    encodedBoundaries = [boundary.encode('utf-8') for boundary in boundaries]
+    start, extended = linesStart(body)
+    if not extended:
+        keyHashes, offsets = rangeSortedHashArray(rangeLineDigests(body, encodedBoundaries, start))
+        return Manifest(etag, keyHashes, len(keyHashes), hashSum(keyHashes), boundaries, offsets, None)
+    keyHashes, keySizes, offsets = rangeSortedSizedHashArray(*rangeSizedLineDigests(body, encodedBoundaries, parseLine, start))
+    return Manifest(etag, keyHashes, len(keyHashes), hashSum(keyHashes), boundaries, offsets, keySizes)
+
+def manifestKeys(s3Client, executor, bucketName, objectKey):
+    # Key names listed in the manifest file, downloaded again as parsed manifests do not
+    # hold them
+    body, etag, ranges = downloadManifest(s3Client, executor, bucketName, objectKey, None)
+    return manifestKeyNames(decompressManifest(body)[0])
+
+def manifestRange(manifest, rangeIndex):
+    # Sorted key hashes of the key names in a key range of a parsed manifest
+    return manifest.keyHashes[manifest.rangeOffsets[rangeIndex]:manifest.rangeOffsets[rangeIndex + 1]]
+
+def manifestRangeSizes(manifest, rangeIndex):
+    # Object sizes of the keys in a key range of a parsed manifest in the extended
+    # format, in the same order as manifestRange
+    return manifest.keySizes[manifest.rangeOffsets[rangeIndex]:manifest.rangeOffsets[rangeIndex + 1]]
+
+def manifestMemoryBytes(manifest):
+    # Memory held by the arrays of a parsed manifest
+    return sum(len(values) * values.itemsize for values in (manifest.keyHashes, manifest.keySizes) if values is not None)
+
+def downloadManifest(s3Client, executor, bucketName, objectKey, etag):
+    # Download the manifest file. The first range also returns the total object size,
+    # any remaining ranges are then downloaded in parallel. If an ETag is given the
+    # first request is conditional and (None, etag, 0) is returned if the object is
+    # unchanged. Otherwise returns the file contents, ETag and number of ranges
+    conditionArgs = {'IfNoneMatch': etag} if etag else {}
+    try:
+        try:
+            response = s3Client.get_object(Bucket=bucketName, Key=objectKey, Range='bytes=0-' + str(manifestRangeBytes - 1), **conditionArgs)
+        except ClientError as error:
+            # An empty manifest file has no satisfiable range
+            if error.response['Error']['Code'] != 'InvalidRange':
+                raise
+            response = s3Client.get_object(Bucket=bucketName, Key=objectKey, **conditionArgs)
+    except ClientError as error:
+        if error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304:
+            return None, etag, 0
+        raise
+
+    firstRange = response['Body'].read()
+    etag = response['ETag']
+    totalBytes = int(response['ContentRange'].rsplit('/', 1)[1]) if 'ContentRange' in response else len(firstRange)
+    if totalBytes <= len(firstRange):
+        return firstRange, etag, 1
+
+    # The remaining ranges must come from the same version of the object
+    rangeStarts = range(len(firstRange), totalBytes, manifestRangeBytes)
+    ranges = executor.map(
+        lambda start: downloadManifestRange(s3Client, bucketName, objectKey, etag, start, min(start + manifestRangeBytes, totalBytes) - 1),
+        rangeStarts)
+    return firstRange + b''.join(ranges), etag, len(rangeStarts) + 1
+
+def downloadManifestRange(s3Client, bucketName, objectKey, etag, start, end):
+    # Download a single byte range of the manifest file
+    response = s3Client.get_object(Bucket=bucketName, Key=objectKey, Range='bytes=' + str(start) + '-' + str(end), IfMatch=etag)
+    return response['Body'].read()
+
+def putMemoryCache(cacheKey, manifest):
+    # Add a parsed manifest to the in memory cache as the most recently used entry,
+    # evicting the least recently used entries if the cache is over its size limit
+    global memoryCacheBytes
+    previous = memoryCache.pop(cacheKey, None)
+    if previous is not None:
+        memoryCacheBytes -= manifestMemoryBytes(previous)
+    memoryCache[cacheKey] = manifest
+    memoryCacheBytes += manifestMemoryBytes(manifest)
+    while memoryCacheBytes > memoryCacheMaxBytes and len(memoryCache) > 1:
+        evictedKey, evicted = memoryCache.popitem(last=False)
+        memoryCacheBytes -= manifestMemoryBytes(evicted)
+
+def diskCachePath(cacheKey):
+    return os.path.join(diskCacheDir, hashlib.sha256(json.dumps(cacheKey).encode('utf-8')).hexdigest())
+
+def readDiskCache(cacheKey):
+    # Read a parsed manifest spilled to /tmp. The file holds a JSON header line followed
+    # by the key hashes and, for manifests in the extended format, the object sizes
+    try:
+        with open(diskCachePath(cacheKey), 'rb') as cacheFile:
+            header = json.loads(cacheFile.readline())
+            if header.get('format') != diskCacheFormat:
+                return None
+            keyHashes = hashArrayFromBytes(cacheFile.read(header['count'] * 8))
+            keySizes = sizeArrayFromBytes(cacheFile.read()) if header['sized'] else None
+            return Manifest(header['etag'], keyHashes, header['count'], header['keyDigest'],
+                header['rangeBoundaries'], header['rangeOffsets'], keySizes)
+    except (OSError, ValueError, KeyError):
+        return None
+
+def writeDiskCache(cacheKey, manifest):
+    # Spill a parsed manifest to /tmp, removing the oldest cached files if the cache
+    # directory is over its size limit. Failures only mean the manifest is not cached
+    keyHashesBytes = hashArrayBytes(manifest.keyHashes)
+    keySizesBytes = hashArrayBytes(manifest.keySizes) if manifest.keySizes is not None else b''
+    if len(keyHashesBytes) + len(keySizesBytes) > diskCacheMaxBytes:
+        return
+    try:
+        os.makedirs(diskCacheDir, exist_ok=True)
+        path = diskCachePath(cacheKey)
+        with open(path + '.tmp', 'wb') as cacheFile:
+            cacheFile.write(json.dumps({'format': diskCacheFormat, 'etag': manifest.etag, 'count': manifest.count, 'keyDigest': manifest.keyDigest,
+                'rangeBoundaries': manifest.rangeBoundaries, 'rangeOffsets': manifest.rangeOffsets, 'sized': manifest.keySizes is not None}).encode('utf-8') + b'\n')
+            cacheFile.write(keyHashesBytes)
+            cacheFile.write(keySizesBytes)
+        os.replace(path + '.tmp', path)
+
+        cachedFiles = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in os.scandir(diskCacheDir))
+        cachedBytes = sum(size for mtime, size, cachedPath in cachedFiles)
+        for mtime, size, cachedPath in cachedFiles:
+            if cachedBytes <= diskCacheMaxBytes or cachedPath == path:
+                break
+            os.remove(cachedPath)
+            cachedBytes -= size
+    except OSError as error:
+        print("WARNING: Unable to write manifest cache file: " + repr(error))
@@ -0,0 +1,77 @@
+#===================================================================================
+# FILE: manifest_format.py
+#
+# DESCRIPTION: Shared helpers used by the reconcile functions to read "manifest"
+# files in the plain format (one key name per line) or the extended format (key
+# name, object size and optional checksum per line), either optionally compressed
+# with gzip or Zstandard.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Leading bytes of gzip and Zstandard compressed objects
+gzipMagic = b'\x1f\x8b'
+zstdMagic = b'\x28\xb5\x2f\xfd'
+
+# Suffixes of compressed manifest files, following the manifest suffix of the vault
+# job routing rule (see vault_job_matcher.py)
+compressedSuffixes = ('.gz', '.zst')
+
+# First line of a manifest file in the extended format, and the separator between
+# the fields of each line
+extendedHeader = b'#manifest-format:extended'
+fieldSeparator = b'\t'
+
+# Size stored for files listed without a size
+unknownSize = -1
+
+def manifestCompression(body):
+    # Compression of a manifest file body (bytes) - "gzip", "zstd", or None
+    if body.startswith(gzipMagic):
+        return 'gzip'
+    if body.startswith(zstdMagic):
+        return 'zstd'
+    return None
+
+def decompressManifest(body):
+    # Contents of a manifest file body (bytes), decompressed if it is compressed.
+    # Returns the contents and the compression found
+    compression = manifestCompression(body)
+    if compression == 'gzip':
+        return gzip.decompress(body), compression
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Manifest file is Zstandard compressed but the zstandard module is not available")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body), compression
+    return body, compression
+
+def linesStart(text):
+    # Offset of the first line listing a file in the contents of a manifest file, and
+    # whether it is in the extended format (after its header line)
+    if not text.startswith(extendedHeader):
+        return 0, False
+    end = text.find(b'\n')
+    return len(text) if end < 0 else end + 1, True
+
+def parseLine(line):
+    # Key name (bytes) and object size of a line of a manifest file in the extended
+    # format. The checksum, if any, is not used
+    keyName, separator, fields = line.partition(fieldSeparator)
+    size = fields.partition(fieldSeparator)[0].strip()
+    return keyName, int(size) if size else unknownSize
+
+def manifestKeyNames(text):
+    # Key names listed in the contents of a manifest file of either format
+    start, extended = linesStart(text)
+    lines = text[start:].decode('utf-8').splitlines()
+    if not extended:
+        return lines
+    return [line.partition('\t')[0] for line in lines]
@@ -0,0 +1,57 @@
+#===================================================================================
+# FILE: reconcile-build-index.py
+#
+# DESCRIPTION: Used by the Step Functions state machine in the index reconcile mode.
+# Builds the expected key index of a logical dataset from its "manifest" file, and
+# stores it in the expected key index S3 bucket.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from aws_clients import LazyClient
+from embedded_metrics import emitsMetrics, addCount, putMetric, setProperty
+from expected_key_index import writeIndex
+from manifest_cache import getManifest
+from vault_event_codec import parseDetail
+
+dynamoDbClient = LazyClient('dynamodb')
+s3Client = LazyClient('s3')
+
+# Configuration from the function environment, read once per execution environment
+tableName = os.environ.get('dynamoDbTableName')
+
+# Maximum number of parallel ranged GETs used to download a manifest file
+manifestMaxWorkers = 8
+
+@emitsMetrics
+def lambda_handler(event, context):
+
+    # Set variables based on values recieved from input payload into the Step
+    # Functions state
+    setId, epochTime, bucketName, objectKey, objectSize = parseDetail(event['detail'])
+
+    # Read the key hashes of the files listed in the manifest file. The function is not
+    # configured with key ranges, so the manifest is parsed as a single sorted range
+    stats = {}
+    startTime = time.time()
+    with ThreadPoolExecutor(max_workers=manifestMaxWorkers) as executor:
+        manifest = getManifest(s3Client, executor, bucketName, objectKey, stats)
+
+    # Store the index, then the index item pointing to it
+    indexBytes = writeIndex(s3Client, dynamoDbClient, tableName, setId, epochTime, manifest.keyHashes)
+    stats['indexBytes'] = indexBytes
+    stats['buildSeconds'] = round(time.time() - startTime, 3)
+    print("Set " + setId + ": expected key index of " + str(manifest.count) + " files built " + json.dumps(stats))
+    setProperty('setId', setId)
+    putMetric('ManifestFiles', manifest.count)
+    addCount('ManifestBytes', stats.get('manifestBytes', 0), 'Bytes')
+    addCount('IndexBytes', indexBytes, 'Bytes')
+
+    return {
+        'statusCode': 200
+    }
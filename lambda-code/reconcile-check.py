@@ -3,60 +3,312 @@
 #
 # DESCRIPTION: Reconciles the contents of a DynamoDB table, for a specific logical
 # dataset, with the contents of a "manifest" file on S3 for the same logical dataset.
-# Returns boolean variable if both these sources of data are identical, or not.
+# Returns boolean variable if both these sources of data are identical, or not, and
+# the wait before the next iteration.
 #
-# NOTES: Part of an AWS CDK application. View the README.md file in this repository 
-# for further information on the application architecture. 
+# The key digest is a sum of 64-bit key hashes rather than 128-bit ones, as a sum of
+# 128-bit hashes would not fit the 38 digits of a DynamoDB number. The digest only
+# decides when the full key names are compared: the same keys always give the same
+# digest, and two sets of keys with the same digest are still compared in full
+# before the dataset is reconciled, so a collision can only cost one comparison.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
 #===================================================================================
 
+import array
+import bisect
 import json
-import boto3
 import collections
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from aws_clients import LazyClient
+from embedded_metrics import emitsMetrics, addCount, putMetric, setProperty
+from file_upload_event_table import shardCount, shardPartitionKey, aggregateKey, setDirectory, storedObjectKey, itemObjectKeys, itemObjectSizes, compactAttributeNames
+from hashed_key_set import keyDigests, sortedHashArray, sortedSizedHashArray, hashArraysEqual, differingHashes, differingSizes, matchingKeyNames
+from key_ranges import rangeCount, rangeKeyCondition
+from manifest_cache import getManifest, manifestKeys, manifestRange, manifestRangeSizes
+from reconcile_diff import diffDigest, writeReport
+from reconcile_schedule import nextSchedule
+from set_progress import recordManifest
+from vault_event_codec import parseDetail
+
+dynamoDbClient = LazyClient('dynamodb')
+s3Client = LazyClient('s3')
+
+# Configuration from the function environment, read once per execution environment
+tableName = os.environ.get('dynamoDbTableName')
 
-dynamoDbClient = boto3.client('dynamodb')
-s3 = boto3.resource('s3')
+# Maximum number of parallel ranged GETs used to download a manifest file, and of
+# parallel queries reading the key ranges of every shard
+manifestMaxWorkers = 8
+queryMaxWorkers = 64
 
+# Retry settings for reading the aggregates of every shard, as BatchGetItem may leave
+# some keys unprocessed - exponential backoff
+aggregateReadMaxAttempts = 5
+aggregateReadBaseDelaySeconds = 0.05
+
+@emitsMetrics
 def lambda_handler(event, context):
 
     # Set variables based on values recieved from input payload into the Step
     # Functions state
-    setId=event['detail']['set-id']
-    objectKey=event['detail']['object-key']
-    bucketName=event['detail']['bucket-name']
-
-    # Get the S3 key names stored in DynamoDB for the logical dataset
-    response = dynamoDbClient.query(
-        TableName=os.environ.get('dynamoDbTableName'),
-        ExpressionAttributeValues={
+    setId, epochTime, bucketName, objectKey, objectSize = parseDetail(event['detail'])
+    schedule=event['reconcilecheck']['Payload']['schedule']
+    previousDiff=event['reconcilecheck']['Payload'].get('diff')
+
+    with ThreadPoolExecutor(max_workers=manifestMaxWorkers + 1 + min(queryMaxWorkers, shardCount * rangeCount)) as executor:
+
+        # Start getting the manifest file for the logical dataset from S3 (or the cache)
+        # while the running aggregates are read from DynamoDB
+        stats = {
+            'queryPages': 0,
+            'queryCapacityUnits': 0
+        }
+        manifestFuture = executor.submit(getManifest, s3Client, executor, bucketName, objectKey, stats)
+        aggregates = getAggregates(tableName, setId)
+        manifest = manifestFuture.result()
+        stats['keyRanges'] = len(manifest.rangeOffsets) - 1
+
+        # Store the file count of the manifest on the first iteration, so the progress of
+        # the logical dataset can be served without reading the manifest file
+        if 'lastFileCount' not in schedule:
+            recordManifest(dynamoDbClient, tableName, setId, manifest.count, epochTime)
+
+        # Compare the running aggregates for the logical dataset, summed over its shards,
+        # with the count and digest of the manifest. If they differ the dataset cannot
+        # be complete yet, unless the time budget is used up - the key names are then
+        # compared to report the files that are missing. If no aggregates exist (events
+        # written before aggregates were introduced) the full comparison is always
+        # performed
+        if aggregates:
+            fileCount = sum(int(aggregate.get('fileCount', {'N': '0'})['N']) for aggregate in aggregates)
+            keyDigest = sum(int(aggregate.get('keyDigest', {'N': '0'})['N']) for aggregate in aggregates)
+            if fileCount != manifest.count or keyDigest != manifest.keyDigest:
+                print("Set " + setId + ": " + str(fileCount) + " of " + str(manifest.count) + " files recorded " + json.dumps(stats))
+                nextIteration = nextSchedule(schedule, fileCount, manifest.count)
+                if not nextIteration['timedOut']:
+                    recordProgress(setId, stats, fileCount, manifest.count, min(fileCount, manifest.count), None)
+                    return dict(stats, **{
+                        'reconcileDone': False,
+                        'fileCount': fileCount,
+                        'manifestCount': manifest.count,
+                        'schedule': nextIteration,
+                        'statusCode': 200
+                    })
+
+        # Read the key hashes of the S3 key names stored in DynamoDB for each key range
+        # of the manifest, from every shard, in parallel. The range boundaries are
+        # converted to the form the object keys are stored in
+        setDir = setDirectory(objectKey)
+        storedBoundaries = [storedObjectKey(boundary) for boundary in manifest.rangeBoundaries]
+        queryFutures = {}
+        for rangeIndex in range(stats['keyRanges']):
+            for shard in range(shardCount):
+                queryFutures[(rangeIndex, shard)] = executor.submit(getKeyDigests, tableName, shardPartitionKey(setId, shard), setDir, storedBoundaries, rangeIndex)
+
+        # Merge the results of every shard for each key range. Items not in the
+        # configured item format are stored under a different form of their key, so
+        # they may have been read in another range - they are moved to the range their
+        # object key belongs to
+        rangeDigests = [[] for rangeIndex in range(stats['keyRanges'])]
+        rangeSizes = [[] for rangeIndex in range(stats['keyRanges'])]
+        for (rangeIndex, shard), queryFuture in queryFutures.items():
+            shardDigests, shardSizes, otherFormatKeys, pages, capacityUnits = queryFuture.result()
+            rangeDigests[rangeIndex].append(shardDigests)
+            rangeSizes[rangeIndex].append(shardSizes)
+            for keyName, size in otherFormatKeys:
+                otherRangeIndex = bisect.bisect_right(manifest.rangeBoundaries, keyName)
+                rangeDigests[otherRangeIndex].append(keyDigests([keyName]))
+                rangeSizes[otherRangeIndex].append(array.array('q', [size]).tobytes())
+            stats['queryPages'] += pages
+            stats['queryCapacityUnits'] += capacityUnits
+        del queryFutures
+
+        # Compare each key range of the S3 key names in DynamoDB with the same range of the
+        # file names in the manifest file, and the object sizes of the keys in both if
+        # the manifest lists sizes. The dataset is reconciled if every range is
+        # identical. The hashes that differ are kept to name the keys that differ
+        fileCount = 0
+        missingHashes = set()
+        unexpectedHashes = set()
+        resizedHashes = set()
+        differingRanges = []
+        for rangeIndex in range(stats['keyRanges']):
+            if manifest.keySizes is None:
+                keyHashes = sortedHashArray(b''.join(rangeDigests[rangeIndex]))
+                resized = ()
+            else:
+                keyHashes, keySizes = sortedSizedHashArray(b''.join(rangeDigests[rangeIndex]), b''.join(rangeSizes[rangeIndex]))
+                resized = differingSizes(manifestRange(manifest, rangeIndex), manifestRangeSizes(manifest, rangeIndex), keyHashes, keySizes)
+            rangeDigests[rangeIndex] = rangeSizes[rangeIndex] = None
+            fileCount += len(keyHashes)
+            if not hashArraysEqual(manifestRange(manifest, rangeIndex), keyHashes):
+                missing, unexpected = differingHashes(manifestRange(manifest, rangeIndex), keyHashes)
+                missingHashes.update(missing)
+                unexpectedHashes.update(unexpected)
+                differingRanges.append(rangeIndex)
+            elif resized:
+                differingRanges.append(rangeIndex)
+            resizedHashes.update(resized)
+
+        # Return True if identical, False if not. If not, report the keys that differ
+        reconcileDone = not differingRanges
+        diff = None
+        if not reconcileDone:
+            diff = reportDifferences(executor, previousDiff, setId, epochTime, bucketName, objectKey, manifest, missingHashes, unexpectedHashes, resizedHashes, differingRanges)
+
+    print("Set " + setId + ": " + str(fileCount) + " of " + str(manifest.count) + " files recorded " + json.dumps(stats))
+    recordProgress(setId, stats, fileCount, manifest.count, manifest.count - len(missingHashes) - len(resizedHashes), len(differingRanges))
+
+    return dict(stats, **{
+        'reconcileDone': reconcileDone,
+        'fileCount': fileCount,
+        'manifestCount': manifest.count,
+        'lastWriteTime': max((int(aggregate['lastWriteTime']['N']) for aggregate in aggregates if 'lastWriteTime' in aggregate), default=None),
+        'diff': diff,
+        'schedule': nextSchedule(schedule, fileCount, manifest.count),
+        'statusCode': 200
+    })
+
+def recordProgress(setId, stats, fileCount, manifestCount, matchedCount, differingRangeCount):
+    # Publish the progress of the reconciliation of the logical dataset as metrics. The
+    # number of key ranges that differ is only known when the key names were compared
+    setProperty('setId', setId)
+    putMetric('ReconcileMatchPercent', round(100.0 * matchedCount / manifestCount, 2) if manifestCount else 100.0, 'Percent')
+    putMetric('ManifestFiles', manifestCount)
+    putMetric('RecordedFiles', fileCount)
+    if differingRangeCount is not None:
+        putMetric('DifferingKeyRanges', differingRangeCount)
+    addCount('QueryPages', stats['queryPages'])
+    addCount('ManifestBytes', stats.get('manifestBytes', 0), 'Bytes')
+
+def reportDifferences(executor, previousDiff, setId, epochTime, bucketName, objectKey, manifest, missingHashes, unexpectedHashes, resizedHashes, differingRanges):
+    # Summarise the keys listed in the manifest file but not recorded in DynamoDB
+    # (missing), recorded in DynamoDB but not listed in the manifest file
+    # (unexpected), and recorded with a different size than listed in the manifest
+    # file (resized), as counts and a sample of each, with the location of a report of
+    # every key that differs. If the differences are the same as in the previous
+    # iteration its summary and report are reused. Otherwise the names are read again,
+    # from the manifest file and the differing key ranges in DynamoDB, only for the
+    # side that differs, and streamed to a new report
+    digest = diffDigest(missingHashes, unexpectedHashes, resizedHashes)
+    if previousDiff is not None and previousDiff.get('digest') == digest:
+        diff = previousDiff
+    else:
+        missing = []
+        unexpected = []
+        resized = []
+        if missingHashes or resizedHashes:
+            keyNames = manifestKeys(s3Client, executor, bucketName, objectKey)
+            missing = matchingKeyNames(keyNames, missingHashes)
+            resized = matchingKeyNames(keyNames, resizedHashes)
+        if unexpectedHashes:
+            unexpected = matchingKeyNames(recordedKeyNames(tableName, setId, setDirectory(objectKey),
+                [storedObjectKey(boundary) for boundary in manifest.rangeBoundaries], differingRanges), unexpectedHashes)
+        report, samples = writeReport(s3Client, setId, epochTime, digest, missing, unexpected, resized)
+        diff = {
+            'missing': len(missingHashes),
+            'unexpected': len(unexpectedHashes),
+            'resized': len(resizedHashes),
+            'matched': manifest.count - len(missingHashes) - len(resizedHashes),
+            'differingKeyRanges': len(differingRanges),
+            'digest': digest,
+            'report': report,
+            'missingSample': samples['missing'],
+            'unexpectedSample': samples['unexpected'],
+            'resizedSample': samples['resized']
+        }
+    print("Set " + setId + ": differences " + json.dumps(diff))
+    return diff
+
+def getAggregates(tableName, setId):
+    # Read the running aggregates items of every shard of the logical dataset. Shards
+    # that have no aggregates item yet are left out
+    aggregates = []
+    keys = [aggregateKey(setId, shard) for shard in range(shardCount)]
+    for attempt in range(aggregateReadMaxAttempts):
+        response = dynamoDbClient.batch_get_item(
+            RequestItems={
+                tableName: {
+                    'Keys': keys,
+                    'ProjectionExpression': 'fileCount, keyDigest, lastWriteTime',
+                    'ConsistentRead': True,
+                }
+            },
+            )
+        aggregates.extend(response['Responses'].get(tableName, []))
+        keys = response.get('UnprocessedKeys', {}).get(tableName, {}).get('Keys', [])
+        if not keys:
+            return aggregates
+        time.sleep(aggregateReadBaseDelaySeconds * (2 ** attempt))
+    raise RuntimeError("Unable to read the aggregates of " + str(len(keys)) + " shards of set " + setId)
+
+def getKeyDigests(tableName, setId, setDir, boundaries, rangeIndex):
+    # Read every page of the S3 key names stored in DynamoDB for a key range of a
+    # partition (the logical dataset, or one of its shards), keeping only the key
+    # hashes and object sizes of the items in the configured item format. Returns the
+    # key hashes as concatenated digests, the object sizes in the same order as a
+    # serialised size array, the key names and object sizes of items in the other
+    # format, the number of pages read and the read capacity consumed
+    stats = {
+        'pages': 0,
+        'capacityUnits': 0
+    }
+    digests = []
+    sizes = array.array('q')
+    otherFormatKeys = []
+    for (keyNames, otherKeyNames), (keySizes, otherKeySizes) in queryKeyNames(tableName, setId, setDir, boundaries, rangeIndex, stats):
+        digests.append(keyDigests(keyNames))
+        sizes.extend(keySizes)
+        otherFormatKeys.extend(zip(otherKeyNames, otherKeySizes))
+    return b''.join(digests), sizes.tobytes(), otherFormatKeys, stats['pages'], stats['capacityUnits']
+
+def recordedKeyNames(tableName, setId, setDir, boundaries, rangeIndexes):
+    # Every S3 key name stored in DynamoDB for key ranges of the logical dataset, from
+    # all its shards
+    stats = {
+        'pages': 0,
+        'capacityUnits': 0
+    }
+    for rangeIndex in rangeIndexes:
+        for shard in range(shardCount):
+            for (keyNames, otherKeyNames), sizes in queryKeyNames(tableName, shardPartitionKey(setId, shard), setDir, boundaries, rangeIndex, stats):
+                yield from keyNames
+                yield from otherKeyNames
+
+def queryKeyNames(tableName, setId, setDir, boundaries, rangeIndex, stats):
+    # Read every page of the items stored in DynamoDB for a key range of a partition,
+    # yielding the object keys of the items of each page in the configured item format
+    # and in the other format (see file_upload_event_table.itemObjectKeys), and their
+    # object sizes in the same order. The range
+    # boundaries are in the form the object keys are stored in. Counts the pages read
+    # and read capacity consumed
+    rangeCondition, rangeValues, rangeEndKey = rangeKeyCondition(boundaries, rangeIndex)
+    queryArgs = {
+        'TableName': tableName,
+        'ExpressionAttributeValues': dict(rangeValues, **{
             ':setId': {
                 'S':setId,
             },
-        },
-        KeyConditionExpression='setId = :setId',
-        ProjectionExpression='objectKey',
-        )
-    
-    # Create a list from the key names
-    keyNameList=[]
-    for value in response['Items']:
-        keyNameList.append(value['objectKey']['S'])
-    
-    # Get the manifest file for the logical dataset from S3 and create
-    # a list from the contents
-    manifestFile = s3.Object(bucketName, objectKey)
-    manifestFileStr = manifestFile.get()['Body'].read().decode('utf-8')
-    manifestList = manifestFileStr.splitlines()
-    
-    # Compare the list of S3 key names in DynamoDB with the file names in
-    # the manifest file. Return True if identical, False if not
-    keyNameList.sort()
-    manifestList.sort()
-    
-    print(keyNameList)
-    print(manifestList)
-    
-    return {
-        'reconcileDone': keyNameList == manifestList,
-        'statusCode': 200
-    }
\ No newline at end of file
+        }),
+        'KeyConditionExpression': 'setId = :setId' + rangeCondition,
+        'ProjectionExpression': 'objectKey, bucketName, objectSize, ' + compactAttributeNames['objectSize'],
+        'ReturnConsumedCapacity': 'TOTAL',
+    }
+    while True:
+        response = dynamoDbClient.query(**queryArgs)
+        stats['pages'] += 1
+        stats['capacityUnits'] += response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+
+        # Items are returned in sort key order, so only the last item can be the key at
+        # the end of the range
+        items = response['Items']
+        if items and items[-1]['objectKey']['S'] == rangeEndKey:
+            items = items[:-1]
+        yield itemObjectKeys(items, setDir), itemObjectSizes(items)
+        if 'LastEvaluatedKey' not in response:
+            return
+        queryArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
@@ -3,48 +3,74 @@
 #
 # DESCRIPTION: Sends an event to an EventBridge custom bus based on whether the file
 # upload reconciliation task in the Step Function state machine was successful or
-# timed out (i.e. reached maximum number of iterations). The event sent contains 
+# timed out (i.e. used up its reconciliation time budget). The event sent contains
 # relevant metadata.
 #
 # NOTES: Part of an AWS CDK application. View the README.md file in this repository 
 # for further information on the application architecture. 
 #===================================================================================
 
-import json
-import boto3
 import os
+from aws_clients import LazyClient
+from embedded_metrics import emitsMetrics, addCount, setProperty
+from reconcile_diff import diffSummary
+from set_progress import recordVerdict
+from upload_trace import addStamp, recordHops, traceProperty
+from vault_event_codec import parseDetail, parseTrace, buildEntry, reconcileSuccessfulDetailType, reconcileTimeoutDetailType
 
-eventBusClient = boto3.client('events')
+eventBusClient = LazyClient('events')
+dynamoDbClient = LazyClient('dynamodb')
 
+# Configuration from the function environment, read once per execution environment
+eventBusName = os.environ.get('eventBusName')
+tableName = os.environ.get('dynamoDbTableName')
+
+# Reconcile status stored for each verdict
+successfulStatus = 'successful'
+timeoutStatus = 'timeout'
+
+@emitsMetrics
 def lambda_handler(event, context):
 
-    # Set variables based on values recieved from input payload into the Step
+    # Validate the manifest file upload event recieved as input payload into the Step
     # Functions state
-    setId=event['detail']['set-id']
-    epochTime=event['detail']['event-time']
-    bucketName=event['detail']['bucket-name']
-    objectKey=event['detail']['object-key']
-    objectSize=event['detail']['object-size']
+    uploadEvent = parseDetail(event['detail'])
     reconcileDone=event['reconcilecheck']['Payload']['reconcileDone']
 
     # Check if reconciliation task was successful or timed out, based on
     # boolean variable set by previous task state in state machine
     if reconcileDone == True:
-        notifyStatus='Successful'
+        detailType = reconcileSuccessfulDetailType
+        status = successfulStatus
+        addCount('ReconcileSuccessful')
     else:
-        notifyStatus='Timeout'
+        detailType = reconcileTimeoutDetailType
+        status = timeoutStatus
+        addCount('ReconcileTimeout')
+    setProperty('setId', uploadEvent.setId)
+    recordVerdict(dynamoDbClient, tableName, uploadEvent.setId, status)
+
+    # Stamp the trace with the verdict. The reconcile latency is measured from the time
+    # the last file was recorded, which is only known once reconciliation succeeded
+    trace = parseTrace(event['detail'])
+    if trace is not None:
+        lastWriteTime = event['reconcilecheck']['Payload'].get('lastWriteTime')
+        if reconcileDone == True and lastWriteTime:
+            addStamp(trace, 'written', lastWriteTime)
+            addStamp(trace, 'reconciled')
+            recordHops(trace, ('reconciled',))
+        else:
+            addStamp(trace, 'reconciled')
+        traceProperty(trace)
+
+    # Summarise the keys that differ, if any, as reported by the last reconcile check
+    diff = event['reconcilecheck']['Payload'].get('diff')
+    if diff is not None:
+        diff = diffSummary(diff)
 
     # Create EventBridge event payload stipulating success or timeout and 
     # put to the custom EventBridge bus
-    Entries=[
-        {
-            "DetailType": "File Upload Reconciliation "+ notifyStatus +"",
-            "Source":"vault.application",
-            "Detail":"{\"set-id\":\""+ setId +"\",\"event-time\":"+ str(epochTime) +",\"bucket-name\":\""+ bucketName +"\",\"object-key\":\""+ objectKey +"\",\"object-size\":"+ str(objectSize) +"}",
-            "EventBusName" : os.environ.get('eventBusName')
-        }
-        ]
-    eventBusClient.put_events(Entries=[Entries[0]])
+    eventBusClient.put_events(Entries=[buildEntry(detailType, uploadEvent, eventBusName, trace, diff)])
     
     return {
         'statusCode': 200
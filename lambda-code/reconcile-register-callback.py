@@ -0,0 +1,123 @@
+#===================================================================================
+# FILE: reconcile-register-callback.py
+#
+# DESCRIPTION: Used by the Step Functions state machine in the callback reconcile
+# mode. Stores the task token of the waiting state machine execution with the
+# expected file count of each shard of the logical dataset, or resumes the execution
+# straight away if every shard is already complete.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from aws_clients import LazyClient
+from embedded_metrics import emitsMetrics, addCount, putMetric, setProperty
+from expected_key_index import indexBucketName, readIndexHashes, uncheckedCounts
+from file_upload_event_table import shardCount, aggregateKey, shardPartitionKey, setDirectory
+from hashed_key_set import countByShard
+from manifest_cache import getManifest
+from reconcile_callback import callbackKey, pendingShardsValue, resumeIfComplete
+from vault_event_codec import parseDetail
+
+dynamoDbClient = LazyClient('dynamodb')
+s3Client = LazyClient('s3')
+sfnClient = LazyClient('stepfunctions')
+
+# Configuration from the function environment, read once per execution environment
+tableName = os.environ.get('dynamoDbTableName')
+
+# Maximum number of parallel ranged GETs used to download a manifest file
+manifestMaxWorkers = 8
+
+@emitsMetrics
+def lambda_handler(event, context):
+
+    # Set variables based on values recieved from input payload into the Step
+    # Functions state
+    taskToken=event['taskToken']
+    setId, epochTime, bucketName, objectKey, objectSize = parseDetail(event['detail'])
+
+    # Get the number of files listed in the manifest file (or its expected key index)
+    # for each shard of the logical dataset, then store the task token with every
+    # shard pending, then the expected file count of each shard. A writer that records
+    # the last file of the last pending shard after this point resumes the execution
+    stats = {}
+    with ThreadPoolExecutor(max_workers=max(manifestMaxWorkers, shardCount)) as executor:
+        if indexBucketName:
+            keyHashes = readIndexHashes(dynamoDbClient, s3Client, tableName, setId)
+            uncheckedFileCounts = list(executor.map(
+                lambda shard: uncheckedCounts(dynamoDbClient, tableName, shardPartitionKey(setId, shard), setDirectory(objectKey), keyHashes),
+                range(shardCount)))
+        else:
+            keyHashes = getManifest(s3Client, executor, bucketName, objectKey, stats).keyHashes
+            uncheckedFileCounts = None
+        expectedFileCounts = countByShard(keyHashes, shardCount)
+
+        dynamoDbClient.put_item(
+            TableName=tableName,
+            Item=dict(callbackKey(setId), **{
+                'taskToken': {
+                    'S':taskToken,
+                },
+                'pendingShards': pendingShardsValue(range(shardCount)),
+            }),
+            )
+
+        # If every file of a shard was recorded before its expected file count was
+        # stored, the shard is complete now
+        resumed = any(list(executor.map(
+            lambda shard: registerShard(setId, shard, expectedFileCounts[shard], uncheckedFileCounts[shard] if uncheckedFileCounts else None),
+            range(shardCount))))
+    if uncheckedFileCounts:
+        stats['uncheckedMatched'] = sum(matched for matched, unexpected, capacityUnits in uncheckedFileCounts)
+        stats['uncheckedUnexpected'] = sum(unexpected for matched, unexpected, capacityUnits in uncheckedFileCounts)
+        stats['uncheckedCapacityUnits'] = sum(capacityUnits for matched, unexpected, capacityUnits in uncheckedFileCounts)
+        addCount('UnexpectedFiles', stats['uncheckedUnexpected'])
+    print("Set " + setId + ": waiting for " + str(len(keyHashes)) + " files in " + str(shardCount) + " shards " + json.dumps(stats))
+    setProperty('setId', setId)
+    putMetric('ManifestFiles', len(keyHashes))
+    addCount('ManifestBytes', stats.get('manifestBytes', 0), 'Bytes')
+    addCount('ResumedImmediately', 1 if resumed else 0)
+
+    return {
+        'resumed': resumed,
+        'statusCode': 200
+    }
+
+def registerShard(setId, shard, expectedFileCount, uncheckedFileCounts):
+    # Store the expected file count of a shard of the logical dataset. In the index
+    # reconcile mode the files recorded before the index was loaded (matched,
+    # unexpected and the read capacity used to count them) are added to the counts of
+    # the shard, which is then compared by matched files. Returns True if the shard
+    # was already complete and completing it resumed the execution
+    if uncheckedFileCounts is None:
+        updateExpression = 'SET expectedFileCount = :expectedFileCount'
+        indexValues = {}
+    else:
+        updateExpression = 'ADD matchedFileCount :matchedFileCount, unexpectedFileCount :unexpectedFileCount SET expectedFileCount = :expectedFileCount, indexed = :indexed'
+        indexValues = {
+            ':matchedFileCount': {
+                'N':str(uncheckedFileCounts[0]),
+            },
+            ':unexpectedFileCount': {
+                'N':str(uncheckedFileCounts[1]),
+            },
+            ':indexed': {
+                'BOOL':True,
+            },
+        }
+    response = dynamoDbClient.update_item(
+        TableName=tableName,
+        Key=aggregateKey(setId, shard),
+        UpdateExpression=updateExpression,
+        ExpressionAttributeValues=dict({
+            ':expectedFileCount': {
+                'N':str(expectedFileCount),
+            },
+        }, **indexValues),
+        ReturnValues='ALL_NEW',
+        )
+    return resumeIfComplete(dynamoDbClient, sfnClient, tableName, setId, shard, response['Attributes'])
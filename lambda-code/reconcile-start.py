@@ -0,0 +1,58 @@
+#===================================================================================
+# FILE: reconcile-start.py
+#
+# DESCRIPTION: Starts the "reconcile file uploads" Step Functions state machine for
+# a "manifest" file upload event, with an execution name derived from the event so a
+# duplicate event cannot start a second execution.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import json
+import os
+from botocore.exceptions import ClientError
+from aws_clients import LazyClient
+from embedded_metrics import emitsMetrics, addCount
+from upload_dedup import dedupKey, isRecentDuplicate, rememberEvent, executionName
+from vault_event_codec import parseDetail
+
+sfnClient = LazyClient('stepfunctions')
+
+# Configuration from the function environment, read once per execution environment
+stateMachineArn = os.environ.get('stateMachineArn')
+
+@emitsMetrics
+def lambda_handler(event, context):
+
+    # Drop manifest file upload events this execution environment has already started
+    # an execution for
+    uploadEvent = parseDetail(event['detail'])
+    key = dedupKey(uploadEvent.setId, uploadEvent.objectKey, uploadEvent.eventTime)
+    if isRecentDuplicate(key):
+        print("Duplicate manifest event dropped: " + uploadEvent.objectKey)
+        addCount('DuplicatesDropped')
+        return {
+            'statusCode': 200
+        }
+
+    # Start the execution, named after the manifest file upload event
+    name = executionName(key)
+    try:
+        sfnClient.start_execution(
+            stateMachineArn=stateMachineArn,
+            name=name,
+            input=json.dumps(event)
+        )
+        print("Started reconcile " + name + " for set " + uploadEvent.setId)
+        addCount('ExecutionsStarted')
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ExecutionAlreadyExists':
+            raise
+        print("Duplicate manifest event dropped, reconcile " + name + " already started")
+        addCount('DuplicatesDropped')
+    rememberEvent(key)
+
+    return {
+        'statusCode': 200
+    }
@@ -0,0 +1,131 @@
+#===================================================================================
+# FILE: reconcile_callback.py
+#
+# DESCRIPTION: Shared helpers for the callback reconcile mode. Stores the task token
+# of a waiting state machine execution, and resumes the execution once every shard
+# of the logical dataset has recorded its expected file count.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import json
+import os
+from botocore.exceptions import ClientError
+from file_upload_event_table import setItemPartitionSuffix, shardCount, aggregateKey
+
+callbackSortKey = 'callback'
+
+# Configuration from the function environment, read once per execution environment.
+# Set for the file upload notification writers only in the callback and index
+# reconcile modes, otherwise no execution can be waiting to be resumed
+callbacksEnabled = os.environ.get('reconcileCallbacks') == 'enabled'
+
+def callbackKey(setId):
+    # Primary key of the callback item for a logical dataset
+    return {
+        'setId': {
+            'S':setId + setItemPartitionSuffix,
+        },
+        'objectKey': {
+            'S':callbackSortKey,
+        },
+    }
+
+def isComplete(aggregate):
+    # True if the running aggregates show that at least the expected number of files
+    # has been recorded for a shard of the logical dataset - files matched against the
+    # expected key index if the shard is indexed
+    if 'expectedFileCount' not in aggregate:
+        return False
+    countName = 'matchedFileCount' if 'indexed' in aggregate else 'fileCount'
+    return int(aggregate.get(countName, {'N': '0'})['N']) >= int(aggregate['expectedFileCount']['N'])
+
+def pendingShardsValue(shards):
+    # Number set attribute value holding shards of a logical dataset
+    return {
+        'NS':[str(shard) for shard in shards],
+    }
+
+def resumeIfComplete(dynamoDbClient, sfnClient, tableName, setId, shard, aggregate):
+    # Remove a shard of the logical dataset from the pending shards of the callback
+    # item if its running aggregates show it is complete, and resume the waiting state
+    # machine execution once no shards are pending. Removing a shard is a single
+    # conditional update, so it is counted exactly once however many functions see it
+    # complete. Returns True if this call resumed the execution
+    if not isComplete(aggregate):
+        return False
+    try:
+        response = dynamoDbClient.update_item(
+            TableName=tableName,
+            Key=callbackKey(setId),
+            UpdateExpression='DELETE pendingShards :shards',
+            ConditionExpression='contains(pendingShards, :shard)',
+            ExpressionAttributeValues={
+                ':shards': pendingShardsValue([shard]),
+                ':shard': {
+                    'N':str(shard),
+                },
+            },
+            ReturnValues='ALL_NEW',
+            )
+    except ClientError as error:
+        # The shard has already been removed, or nothing is waiting. If no shards are
+        # pending but the task token is still there, the function that removed the
+        # last shard failed before resuming the execution
+        if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        callback = dynamoDbClient.get_item(
+            TableName=tableName,
+            Key=callbackKey(setId),
+            ConsistentRead=True,
+            ).get('Item')
+        if callback is None or 'pendingShards' in callback:
+            return False
+        response = {'Attributes': callback}
+    if 'pendingShards' in response['Attributes']:
+        return False
+
+    response = dynamoDbClient.delete_item(
+        TableName=tableName,
+        Key=callbackKey(setId),
+        ReturnValues='ALL_OLD',
+        )
+    if 'Attributes' not in response:
+        return False
+
+    try:
+        sfnClient.send_task_success(
+            taskToken=response['Attributes']['taskToken']['S'],
+            output=json.dumps({
+                'shardCount': shardCount
+            })
+        )
+    except ClientError as error:
+        # The execution may already have timed out or been stopped
+        if error.response['Error']['Code'] not in ('TaskTimedOut', 'TaskDoesNotExist', 'InvalidToken'):
+            raise
+        print("WARNING: Unable to resume reconcile for set " + setId + ": " + repr(error))
+        return False
+    print("Resumed reconcile for set " + setId)
+    return True
+
+def resumeShardIfComplete(dynamoDbClient, sfnClient, tableName, setId, shard):
+    # Read the running aggregates of a shard of the logical dataset back once upload
+    # events have been recorded (or found already recorded) for it, and resume the
+    # waiting state machine execution if the dataset is complete, see
+    # resumeIfComplete. The read is strongly consistent, so the function that records
+    # the last file always sees the shard complete. Returns True if this call resumed
+    # the execution. Nothing is read unless the callback reconcile mode is deployed
+    if not callbacksEnabled:
+        return False
+    aggregate = dynamoDbClient.get_item(
+        TableName=tableName,
+        Key=aggregateKey(setId, shard),
+        ProjectionExpression='fileCount, matchedFileCount, expectedFileCount, indexed',
+        ConsistentRead=True,
+        ReturnConsumedCapacity='TOTAL',
+        ).get('Item')
+    if aggregate is None:
+        return False
+    return resumeIfComplete(dynamoDbClient, sfnClient, tableName, setId, shard, aggregate)
@@ -0,0 +1,80 @@
+#===================================================================================
+# FILE: reconcile_diff.py
+#
+# DESCRIPTION: Shared helpers used by the reconcile check function to report the
+# keys that differ between a manifest file and the file upload events recorded for a
+# logical dataset, as counts, bounded samples and a CSV report written to S3.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import csv
+import gzip
+import hashlib
+import io
+import os
+import tempfile
+from embedded_metrics import addCount
+
+# Configuration from the function environment, read once per execution environment
+reportBucketName = os.environ.get('reconcileReportBucketName')
+
+# Maximum number of key names sampled from each side of the differences
+diffSampleMaxKeys = 10
+
+# Columns of the report object and the suffix of its key name
+reportColumns = ['difference', 'objectKey']
+reportKeySuffix = '.csv.gz'
+
+def diffDigest(missingHashes, unexpectedHashes, resizedHashes):
+    # Digest identifying a set of differences, from the counts and sums of the missing,
+    # unexpected and resized key hashes. The same differences always give the same
+    # digest
+    state = ' '.join('%d %d' % (len(hashes), sum(hashes) % 2**64) for hashes in (missingHashes, unexpectedHashes, resizedHashes))
+    return hashlib.blake2b(state.encode('utf-8'), digest_size=8).hexdigest()
+
+def reportKey(setId, epochTime, digest):
+    # Key name of the report of a set of differences - "[LOGICAL DATASET ID]/[MANIFEST
+    # EVENT TIME]-[DIGEST].csv.gz", so the reports of a dataset are listed together
+    return setId + '/' + str(epochTime) + '-' + digest + reportKeySuffix
+
+def writeReport(s3Client, setId, epochTime, digest, missingKeyNames, unexpectedKeyNames, resizedKeyNames):
+    # Stream the key names that differ, from three iterables, into a gzip compressed
+    # CSV file in temporary storage (one row per key, "missing", "unexpected" or
+    # "resized") and upload it as the report object. Returns the S3 URI of the report
+    # and a sample of the key names of each difference
+    key = reportKey(setId, epochTime, digest)
+    samples = {
+        'missing': [],
+        'unexpected': [],
+        'resized': []
+    }
+    with tempfile.TemporaryFile() as reportFile:
+        with gzip.GzipFile(fileobj=reportFile, mode='wb', compresslevel=6) as gzipFile:
+            textFile = io.TextIOWrapper(gzipFile, encoding='utf-8', newline='')
+            writer = csv.writer(textFile)
+            writer.writerow(reportColumns)
+            for difference, keyNames in (('missing', missingKeyNames), ('unexpected', unexpectedKeyNames), ('resized', resizedKeyNames)):
+                sample = samples[difference]
+                for keyName in keyNames:
+                    writer.writerow([difference, keyName])
+                    if len(sample) < diffSampleMaxKeys:
+                        sample.append(keyName)
+            textFile.flush()
+            textFile.detach()
+        addCount('DiffReportBytes', reportFile.tell(), 'Bytes')
+        reportFile.seek(0)
+        s3Client.put_object(
+            Bucket=reportBucketName,
+            Key=key,
+            Body=reportFile,
+            ContentType='application/gzip',
+            )
+    addCount('DiffReportsWritten')
+    return 's3://' + reportBucketName + '/' + key, samples
+
+def diffSummary(diff):
+    # Counts and report location of a set of differences, without the samples, as sent
+    # in the reconciliation notification event
+    return {name: diff[name] for name in ('missing', 'unexpected', 'resized', 'matched', 'report')}
@@ -0,0 +1,73 @@
+#===================================================================================
+# FILE: reconcile_schedule.py
+#
+# DESCRIPTION: Chooses how long the Step Functions state machine waits before the
+# next reconcile check, from the progress observed between checks, and whether the
+# reconciliation time budget has been used up.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import datetime
+import math
+import os
+import time
+
+# Configuration from the function environment, read once per execution environment
+reconcileWaitMinSeconds = int(os.environ.get('reconcileWaitMinSeconds', '5'))
+reconcileWaitMaxSeconds = int(os.environ.get('reconcileWaitMaxSeconds', '120'))
+reconcileTimeoutSeconds = int(os.environ.get('reconcileTimeoutSeconds', '28800'))
+
+# Step Functions execution history limit, and the history events of each iteration of
+# the reconcile loop - 5 for the reconcile check task, 2 each for the choice and wait
+# states, with room for a retried task. Events outside the loop (the start, the
+# callback and index states, the notification) are kept in reserve
+executionHistoryMaxEvents = 25000
+historyEventsPerIteration = 12
+historyEventsReserved = 1000
+maxIterations = (executionHistoryMaxEvents - historyEventsReserved) // historyEventsPerIteration
+
+def parseStartTime(startTime):
+    # Parse a Step Functions timestamp (e.g. 2021-06-01T12:00:00.123Z) into epoch seconds
+    base, _, fraction = startTime.rstrip('Z').partition('.')
+    parsed = datetime.datetime.strptime(base, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp() + (float('0.' + fraction) if fraction else 0)
+
+def nextSchedule(schedule, fileCount, manifestCount, now=None):
+    # Return the schedule for the next iteration given the schedule of the previous
+    # iteration (holding the execution start time, the number of iterations, the last
+    # wait and the file count at the last check) and the file counts observed by this
+    # check
+    now = time.time() if now is None else now
+    minWait = reconcileWaitMinSeconds
+    maxWait = reconcileWaitMaxSeconds
+    deadline = parseStartTime(schedule['startTime']) + reconcileTimeoutSeconds
+    iteration = schedule.get('iteration', 0) + 1
+
+    # Shortest wait that spreads the iterations left over the time budget left
+    iterationsLeft = max(maxIterations - iteration, 1)
+    budgetWait = math.ceil(max(deadline - now, 0) / iterationsLeft)
+
+    lastWait = schedule.get('waitSeconds', minWait)
+    arrived = fileCount - schedule.get('lastFileCount', fileCount)
+    remaining = max(manifestCount - fileCount, 0)
+    if 'lastFileCount' not in schedule:
+        # First check - nothing is known about the rate of progress yet
+        waitSeconds = minWait
+    elif arrived > 0:
+        # Wait for roughly the time the remaining files should take at the observed rate
+        waitSeconds = remaining * lastWait / arrived
+    else:
+        # No progress since the last check - back off
+        waitSeconds = lastWait * 2
+    waitSeconds = min(max(waitSeconds, minWait), maxWait)
+    waitSeconds = int(min(max(waitSeconds, budgetWait), max(deadline - now, 1)))
+
+    return {
+        'startTime': schedule['startTime'],
+        'iteration': iteration,
+        'lastFileCount': fileCount,
+        'waitSeconds': waitSeconds,
+        'timedOut': now >= deadline or iteration >= maxIterations
+    }
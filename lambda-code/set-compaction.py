@@ -0,0 +1,224 @@
+#===================================================================================
+# FILE: set-compaction.py
+#
+# DESCRIPTION: Compacts a logical dataset once it has been reconciled. Marks the
+# running aggregates of the dataset as compacted, writes a summary of its file
+# upload events to S3, then deletes its items from the DynamoDB table.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import csv
+import gzip
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from botocore.exceptions import ClientError
+from aws_clients import LazyClient
+from embedded_metrics import emitsMetrics, addCount, setProperty
+from expected_key_index import indexKey
+from file_upload_event_table import shardCount, shardPartitionKey, markCompacted, setDirectory, itemKey, itemObjectKey, itemNumber
+from reconcile_callback import callbackKey
+from set_progress import progressKey
+from vault_event_codec import parseDetail
+
+dynamoDbClient = LazyClient('dynamodb')
+s3Client = LazyClient('s3')
+
+# Configuration from the function environment, read once per execution environment
+tableName = os.environ.get('dynamoDbTableName')
+summaryBucketName = os.environ.get('setSummaryBucketName')
+
+# Columns of the summary object and the suffix of its key name, which is the logical
+# dataset ID followed by the suffix
+summaryColumns = ['objectKey', 'objectSize', 'eventTime']
+summaryKeySuffix = '.csv.gz'
+
+# BatchWriteItem service limit - maximum delete requests per call - and the number of
+# calls made in parallel
+batchWriteMaxItems = 25
+deleteMaxWorkers = 16
+
+# Retry settings for unprocessed deletes - exponential backoff with full jitter
+batchWriteMaxAttempts = 8
+batchWriteBaseDelaySeconds = 0.05
+batchWriteMaxDelaySeconds = 2.0
+retryableErrorCodes = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded', 'InternalServerError')
+
+@emitsMetrics
+def lambda_handler(event, context):
+
+    # Set variables based on values recieved in the reconciliation successful event,
+    # which carries the manifest file upload event of the logical dataset
+    setId, epochTime, bucketName, objectKey, objectSize = parseDetail(event['detail'])
+    setDir = setDirectory(objectKey)
+    summaryKey = setId + summaryKeySuffix
+    stats = {
+        'summarisedItems': 0,
+        'deletedItems': 0,
+        'queryPages': 0
+    }
+
+    # Mark the running aggregates of every shard as compacted. No upload event can be
+    # recorded for the logical dataset from then on, so the items read below are all
+    # there will be
+    compactedTime = int(time.time())
+    for shard in range(shardCount):
+        markCompacted(dynamoDbClient, tableName, setId, shard, compactedTime)
+
+    # Write the summary object, unless an earlier invocation for the same manifest file
+    # upload event already wrote it (and may have removed some of the items since)
+    if summaryEventTime(summaryKey) != str(epochTime):
+        fileCount, totalBytes = writeSummary(setId, setDir, summaryKey, epochTime, bucketName, stats)
+        print("Set " + setId + ": " + str(fileCount) + " files, " + str(totalBytes) + " bytes summarised to s3://" + summaryBucketName + "/" + summaryKey)
+
+    # Remove the file upload event items of every shard of the logical dataset, then
+    # the progress item and any callback or expected key index item left for it
+    setKeys = [callbackKey(setId), progressKey(setId), indexKey(setId)]
+    with ThreadPoolExecutor(max_workers=deleteMaxWorkers) as executor:
+        pending = set()
+        for shard in range(shardCount):
+            for items in queryItems(shardPartitionKey(setId, shard), 'setId, objectKey', stats):
+                for start in range(0, len(items), batchWriteMaxItems):
+                    if len(pending) >= deleteMaxWorkers * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collectDeletes([future.result() for future in done], stats)
+                    pending.add(executor.submit(deleteItems, tableName, items[start:start + batchWriteMaxItems]))
+        collectDeletes([future.result() for future in wait(pending).done], stats)
+    collectDeletes([deleteItems(tableName, setKeys)], stats)
+
+    print("Set " + setId + ": compacted " + json.dumps(stats))
+    setProperty('setId', setId)
+    addCount('ItemsSummarised', stats['summarisedItems'])
+    addCount('ItemsDeleted', stats['deletedItems'])
+    addCount('QueryPages', stats['queryPages'])
+
+    return dict(stats, **{
+        'summaryKey': summaryKey,
+        'statusCode': 200
+    })
+
+def summaryEventTime(summaryKey):
+    # Event time of the manifest file upload event an existing summary object was
+    # written for, or None if there is no summary object for the logical dataset
+    try:
+        response = s3Client.head_object(Bucket=summaryBucketName, Key=summaryKey)
+    except ClientError as error:
+        if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return response.get('Metadata', {}).get('manifest-event-time')
+
+def writeSummary(setId, setDir, summaryKey, epochTime, bucketName, stats):
+    # Stream the file upload event items of every shard of the logical dataset, page by
+    # page, into a gzip compressed CSV file in temporary storage and upload it as the
+    # summary object. Returns the number of files and their total size
+    fileCount = 0
+    totalBytes = 0
+    with tempfile.TemporaryFile() as summaryFile:
+        with gzip.GzipFile(fileobj=summaryFile, mode='wb', compresslevel=6) as gzipFile:
+            textFile = io.TextIOWrapper(gzipFile, encoding='utf-8', newline='')
+            writer = csv.writer(textFile)
+            writer.writerow(summaryColumns)
+            for shard in range(shardCount):
+                for items in queryItems(shardPartitionKey(setId, shard), None, stats):
+                    for item in items:
+                        fileSize = itemNumber(item, 'objectSize')
+                        writer.writerow([itemObjectKey(item, setDir), fileSize, itemNumber(item, 'eventTime')])
+                        fileCount += 1
+                        totalBytes += fileSize
+            textFile.flush()
+            textFile.detach()
+        addCount('SummaryBytes', summaryFile.tell(), 'Bytes')
+        summaryFile.seek(0)
+        s3Client.put_object(
+            Bucket=summaryBucketName,
+            Key=summaryKey,
+            Body=summaryFile,
+            ContentType='application/gzip',
+            Metadata={
+                'file-count': str(fileCount),
+                'total-bytes': str(totalBytes),
+                'bucket-name': bucketName,
+                'manifest-event-time': str(epochTime)
+            }
+            )
+    stats['summarisedItems'] = fileCount
+    return fileCount, totalBytes
+
+def queryItems(partitionKey, projectionExpression, stats):
+    # Read every page of the items stored in a partition of the DynamoDB table (the
+    # logical dataset, or one of its shards), yielding the items of each page. Reads
+    # are strongly consistent, so they include the last items recorded before the
+    # dataset was marked as compacted
+    queryArgs = {
+        'TableName': tableName,
+        'ConsistentRead': True,
+        'KeyConditionExpression': 'setId = :setId',
+        'ExpressionAttributeValues': {
+            ':setId': {
+                'S':partitionKey,
+            },
+        },
+        'ReturnConsumedCapacity': 'TOTAL',
+    }
+    if projectionExpression:
+        queryArgs['ProjectionExpression'] = projectionExpression
+    while True:
+        response = dynamoDbClient.query(**queryArgs)
+        stats['queryPages'] += 1
+        yield response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        queryArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def collectDeletes(results, stats):
+    # Count the items removed by completed delete chunks. A chunk that could not be
+    # removed fails the invocation, so that it is retried (the summary is kept)
+    for deletedCount, failedCount in results:
+        stats['deletedItems'] += deletedCount
+        if failedCount:
+            raise RuntimeError("Unable to delete " + str(failedCount) + " items")
+
+def deleteItems(tableName, keys):
+    # Delete a chunk of items from the DynamoDB table by key, retrying unprocessed
+    # deletes with backoff between attempts. Returns the number of items deleted and
+    # the number that could not be deleted
+    keys = [{'setId': key['setId'], 'objectKey': key['objectKey']} for key in keys]
+    total = len(keys)
+    attempt = 0
+    while keys:
+        attempt += 1
+        try:
+            response = dynamoDbClient.batch_write_item(
+                RequestItems={
+                    tableName: [{'DeleteRequest': {'Key': key}} for key in keys]
+                },
+                ReturnConsumedCapacity='TOTAL',
+                )
+        except ClientError as error:
+            if attempt < batchWriteMaxAttempts and error.response['Error']['Code'] in retryableErrorCodes:
+                backoff(attempt)
+                continue
+            print("ERROR: BatchWriteItem call failed: " + repr(error))
+            return total - len(keys), len(keys)
+
+        keys = [request['DeleteRequest']['Key'] for request in response.get('UnprocessedItems', {}).get(tableName, [])]
+        addCount('UnprocessedItems', len(keys))
+        if keys:
+            if attempt >= batchWriteMaxAttempts:
+                print("ERROR: Unable to delete " + str(len(keys)) + " items after " + str(attempt) + " attempts, first " + str(itemKey(keys[0])))
+                return total - len(keys), len(keys)
+            backoff(attempt)
+
+    return total, 0
+
+def backoff(attempt):
+    # Exponential backoff with full jitter
+    addCount('Retries')
+    time.sleep(random.uniform(0, min(batchWriteMaxDelaySeconds, batchWriteBaseDelaySeconds * (2 ** attempt))))
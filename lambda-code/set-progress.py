@@ -0,0 +1,95 @@
+#===================================================================================
+# FILE: set-progress.py
+#
+# DESCRIPTION: Serves the progress of logical datasets through an AWS Lambda
+# function URL, for the comma separated logical dataset IDs in the "setId" query
+# string parameter.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import json
+import os
+import time
+from botocore.exceptions import ClientError
+from aws_clients import LazyClient
+from embedded_metrics import emitsMetrics, addCount
+from set_progress import readProgressItems, progressSummary, compactedProgress, compactedStatus
+
+dynamoDbClient = LazyClient('dynamodb')
+s3Client = LazyClient('s3')
+
+# Configuration from the function environment, read once per execution environment
+tableName = os.environ.get('dynamoDbTableName')
+summaryBucketName = os.environ.get('setSummaryBucketName')
+cacheSeconds = int(os.environ.get('setProgressCacheSeconds', '5'))
+
+# Maximum number of logical datasets per request
+requestMaxSets = 50
+
+# Suffix of the key name of the set summary object of a logical dataset, see
+# set-compaction.py
+summaryKeySuffix = '.csv.gz'
+
+# Progress of recently requested logical datasets, by ID - the time it expires and
+# the progress. Expired entries are dropped once the cache holds this many datasets
+progressCache = {}
+cacheMaxSets = 10000
+
+@emitsMetrics
+def lambda_handler(event, context):
+
+    # Validate the logical dataset IDs requested
+    parameters = event.get('queryStringParameters') or {}
+    setIds = list(dict.fromkeys(setId for setId in parameters.get('setId', '').split(',') if setId))
+    if not setIds or len(setIds) > requestMaxSets:
+        return response(400, {
+            'message': 'setId must list 1 to ' + str(requestMaxSets) + ' comma separated logical dataset IDs'
+        })
+
+    # Serve the datasets whose progress was read within the cache time from memory, and
+    # read the rest in one go
+    now = time.time()
+    misses = [setId for setId in setIds if progressCache.get(setId, (0, None))[0] <= now]
+    addCount('CacheHits', len(setIds) - len(misses))
+    addCount('CacheMisses', len(misses))
+    if misses:
+        if len(progressCache) >= cacheMaxSets:
+            for setId in [setId for setId, (expires, progress) in progressCache.items() if expires <= now]:
+                del progressCache[setId]
+        itemsBySet = readProgressItems(dynamoDbClient, tableName, misses)
+        for setId in misses:
+            progress = progressSummary(setId, itemsBySet.get(setId), now)
+            if progress is None or progress['status'] == compactedStatus:
+                progress = summaryProgress(setId) or progress or {'setId': setId, 'status': 'unknown'}
+            progressCache[setId] = (now + cacheSeconds, progress)
+
+    return response(200, {
+        'sets': [progressCache[setId][1] for setId in setIds]
+    })
+
+def summaryProgress(setId):
+    # Progress of a compacted logical dataset from its set summary object, written
+    # from the file upload events of every file. None if it has no summary object
+    if not summaryBucketName:
+        return None
+    try:
+        metadata = s3Client.head_object(Bucket=summaryBucketName, Key=setId + summaryKeySuffix).get('Metadata', {})
+    except ClientError as error:
+        if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return compactedProgress(setId, int(metadata.get('file-count', '0')), int(metadata.get('total-bytes', '0')))
+
+def response(statusCode, body):
+    # Function URL response, which clients and any cache in front of the function may
+    # keep for the cache time
+    return {
+        'statusCode': statusCode,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Cache-Control': 'max-age=' + str(cacheSeconds)
+        },
+        'body': json.dumps(body)
+    }
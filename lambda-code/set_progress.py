@@ -0,0 +1,190 @@
+#===================================================================================
+# FILE: set_progress.py
+#
+# DESCRIPTION: Shared helpers used to record and read the progress of a logical
+# dataset from its running aggregates and progress item, without reading its file
+# upload events.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import math
+import time
+from file_upload_event_table import shardCount, partitionShard, aggregateKey, setItemPartitionSuffix, aggregateSortKey, compactedAttributeName
+
+progressSortKey = 'progress'
+
+# BatchGetItem service limit - maximum keys per call - and retry settings for keys
+# left unprocessed
+batchGetMaxKeys = 100
+batchGetMaxAttempts = 5
+batchGetBaseDelaySeconds = 0.05
+
+# Reconcile status of a logical dataset - uploading until its manifest file is
+# reconciled, then the verdict of the reconcile notify function, and compacted once
+# its items have been replaced by a set summary (see set-compaction.py)
+uploadingStatus = 'uploading'
+reconcilingStatus = 'reconciling'
+compactedStatus = 'compacted'
+
+def progressKey(setId):
+    # Primary key of the progress item for a logical dataset
+    return {
+        'setId': {
+            'S':setId + setItemPartitionSuffix,
+        },
+        'objectKey': {
+            'S':progressSortKey,
+        },
+    }
+
+def recordManifest(dynamoDbClient, tableName, setId, manifestCount, epochTime):
+    # Store the file count of the manifest file of a logical dataset, and the event time
+    # of the manifest file upload event, in its progress item
+    dynamoDbClient.update_item(
+        TableName=tableName,
+        Key=progressKey(setId),
+        UpdateExpression='SET manifestFileCount = :manifestFileCount, manifestEventTime = :manifestEventTime, reconcileStatus = :status',
+        ExpressionAttributeValues={
+            ':manifestFileCount': {
+                'N':str(manifestCount),
+            },
+            ':manifestEventTime': {
+                'N':str(epochTime),
+            },
+            ':status': {
+                'S':reconcilingStatus,
+            },
+        },
+        )
+
+def recordVerdict(dynamoDbClient, tableName, setId, status):
+    # Store the reconcile verdict of a logical dataset, and the time it was reached, in
+    # its progress item
+    dynamoDbClient.update_item(
+        TableName=tableName,
+        Key=progressKey(setId),
+        UpdateExpression='SET reconcileStatus = :status, reconcileTime = :reconcileTime',
+        ExpressionAttributeValues={
+            ':status': {
+                'S':status,
+            },
+            ':reconcileTime': {
+                'N':str(int(time.time())),
+            },
+        },
+        )
+
+def itemSetId(item):
+    # Logical dataset ID of an aggregates or progress item
+    partitionKey = item['setId']['S'][:-len(setItemPartitionSuffix)]
+    if item['objectKey']['S'] == progressSortKey:
+        return partitionKey
+    return partitionShard(partitionKey)[0]
+
+def readProgressItems(dynamoDbClient, tableName, setIds):
+    # Read the aggregates items of every shard and the progress item of each logical
+    # dataset, as many as fit in each BatchGetItem request. Returns the items found by
+    # logical dataset ID. Eventually consistent reads are enough for progress
+    keys = []
+    for setId in setIds:
+        keys.extend(aggregateKey(setId, shard) for shard in range(shardCount))
+        keys.append(progressKey(setId))
+    itemsBySet = {}
+    for start in range(0, len(keys), batchGetMaxKeys):
+        pending = keys[start:start + batchGetMaxKeys]
+        for attempt in range(batchGetMaxAttempts):
+            response = dynamoDbClient.batch_get_item(
+                RequestItems={
+                    tableName: {
+                        'Keys': pending,
+                        'ProjectionExpression': 'setId, objectKey, fileCount, totalBytes, firstEventTime, lastEventTime, expectedFileCount, matchedFileCount, unexpectedFileCount, manifestFileCount, reconcileStatus, reconcileTime, ' + compactedAttributeName,
+                    }
+                },
+                ReturnConsumedCapacity='TOTAL',
+                )
+            for item in response['Responses'].get(tableName, []):
+                itemsBySet.setdefault(itemSetId(item), []).append(item)
+            pending = response.get('UnprocessedKeys', {}).get(tableName, {}).get('Keys', [])
+            if not pending:
+                break
+            time.sleep(batchGetBaseDelaySeconds * (2 ** attempt))
+        else:
+            raise RuntimeError("Unable to read the progress of " + str(len(pending)) + " items")
+    return itemsBySet
+
+def itemNumbers(items, attributeName):
+    # Values of a number attribute of the items that have it
+    return [int(item[attributeName]['N']) for item in items if attributeName in item]
+
+def progressSummary(setId, items, now=None):
+    # Progress of a logical dataset from its aggregates and progress items - files and
+    # bytes recorded, manifest file count, percent complete, arrival rate (files per
+    # second), estimated seconds until every file has arrived, and the files matched
+    # and unexpected in the index reconcile mode. None if no items exist for the dataset
+    if not items:
+        return None
+    now = time.time() if now is None else now
+    aggregates = [item for item in items if item['objectKey']['S'] == aggregateSortKey]
+    progress = next((item for item in items if item['objectKey']['S'] == progressSortKey), {})
+
+    # A compacted dataset had every file of its manifest file, as counted by its
+    # aggregates when it was compacted
+    if any(compactedAttributeName in aggregate for aggregate in aggregates):
+        return compactedProgress(setId, sum(itemNumbers(aggregates, 'fileCount')), sum(itemNumbers(aggregates, 'totalBytes')))
+
+    # The manifest file count is stored by the first reconcile check, or in the callback
+    # reconcile mode as the expected file count of every shard
+    fileCount = sum(itemNumbers(aggregates, 'fileCount'))
+    expectedCounts = itemNumbers(aggregates, 'expectedFileCount')
+    manifestCount = int(progress['manifestFileCount']['N']) if 'manifestFileCount' in progress else None
+    if manifestCount is None and expectedCounts and len(expectedCounts) == len(aggregates):
+        manifestCount = sum(expectedCounts)
+    status = progress['reconcileStatus']['S'] if 'reconcileStatus' in progress else (reconcilingStatus if manifestCount is not None else uploadingStatus)
+
+    # Average arrival rate between the first and the last file, and the time the rest of
+    # the files should take at that rate from the last arrival
+    firstEventTime = min(itemNumbers(aggregates, 'firstEventTime'), default=None)
+    lastEventTime = max(itemNumbers(aggregates, 'lastEventTime'), default=None)
+    arrivalRate = None
+    if fileCount > 1 and firstEventTime is not None and lastEventTime > firstEventTime:
+        arrivalRate = (fileCount - 1) / (lastEventTime - firstEventTime)
+    etaSeconds = None
+    if manifestCount is not None:
+        remaining = max(manifestCount - fileCount, 0)
+        if remaining == 0:
+            etaSeconds = 0
+        elif arrivalRate:
+            etaSeconds = max(0, int(math.ceil(lastEventTime + remaining / arrivalRate - now)))
+
+    # Files checked against the expected key index, in the index reconcile mode
+    matchedCounts = itemNumbers(aggregates, 'matchedFileCount')
+    unexpectedCounts = itemNumbers(aggregates, 'unexpectedFileCount')
+
+    return {
+        'setId': setId,
+        'status': status,
+        'files': fileCount,
+        'bytes': sum(itemNumbers(aggregates, 'totalBytes')),
+        'manifestFiles': manifestCount,
+        'percentComplete': round(100.0 * min(fileCount, manifestCount) / manifestCount, 2) if manifestCount else None,
+        'filesPerSecond': round(arrivalRate, 3) if arrivalRate else None,
+        'etaSeconds': etaSeconds,
+        'lastEventTime': lastEventTime,
+        'reconcileTime': int(progress['reconcileTime']['N']) if 'reconcileTime' in progress else None,
+        'matchedFiles': sum(matchedCounts) if matchedCounts else None,
+        'unexpectedFiles': sum(unexpectedCounts) if unexpectedCounts else None
+    }
+
+def compactedProgress(setId, fileCount, totalBytes):
+    # Progress of a logical dataset that has been compacted
+    return {
+        'setId': setId,
+        'status': compactedStatus,
+        'files': fileCount,
+        'bytes': totalBytes,
+        'manifestFiles': fileCount,
+        'percentComplete': 100.0,
+        'etaSeconds': 0
+    }
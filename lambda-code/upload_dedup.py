@@ -0,0 +1,55 @@
+#===================================================================================
+# FILE: upload_dedup.py
+#
+# DESCRIPTION: Shared helpers used to drop duplicate file upload events. Each
+# execution environment remembers the events it has recently processed, so
+# redeliveries to a warm function are dropped before any call is made.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import collections
+import hashlib
+import re
+
+# Maximum number of upload events remembered by each execution environment
+recentEventsMaxEntries = 10000
+
+# Upload events recently processed by this execution environment, least recently
+# used first
+recentEvents = collections.OrderedDict()
+
+# Step Functions execution names are limited to 80 characters, and some characters
+# are not allowed
+executionNameMaxSetIdLength = 40
+executionNameInvalidCharacters = re.compile(r'[^A-Za-z0-9_.-]')
+
+def dedupKey(setId, objectKey, eventTime):
+    # Identity of an upload event. Uploads of the same object at different times are
+    # different events
+    return (setId, objectKey, eventTime)
+
+def isRecentDuplicate(key):
+    # True if this execution environment has already processed the upload event
+    if key in recentEvents:
+        recentEvents.move_to_end(key)
+        return True
+    return False
+
+def rememberEvent(key):
+    # Remember an upload event once it has been processed, so later deliveries of it
+    # are dropped. Only call this once the event has been processed successfully
+    recentEvents[key] = True
+    recentEvents.move_to_end(key)
+    if len(recentEvents) > recentEventsMaxEntries:
+        recentEvents.popitem(last=False)
+
+def executionName(key):
+    # Deterministic Step Functions execution name for a manifest file upload event.
+    # Starting a second execution with the same name fails, so duplicate manifest
+    # events cannot start a second reconciliation of the same logical dataset. The
+    # readable part of the name is followed by a hash of the whole event identity
+    setId, objectKey, eventTime = key
+    digest = hashlib.blake2b('\n'.join([setId, objectKey, str(eventTime)]).encode('utf-8'), digest_size=8).hexdigest()
+    return executionNameInvalidCharacters.sub('_', setId)[:executionNameMaxSetIdLength] + '-' + str(eventTime) + '-' + digest
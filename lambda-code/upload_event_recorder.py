@@ -0,0 +1,134 @@
+#===================================================================================
+# FILE: upload_event_recorder.py
+#
+# DESCRIPTION: Shared helpers used by the file upload notification writers to record
+# upload events in the DynamoDB table. The items of the events of a shard of a
+# logical dataset and the change they make to the running aggregates of the shard
+# are written in one transaction.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import collections
+import random
+import time
+from botocore.exceptions import ClientError
+from embedded_metrics import addCount
+from expected_key_index import indexCounts, flagUnexpected
+from file_upload_event_table import itemKey, aggregateDelta, aggregateUpdate, isNewerEvent, storedVersionCondition
+
+# TransactWriteItems service limit - maximum actions per call. One action of each
+# transaction updates the running aggregates of the shard
+transactMaxItems = 100
+transactMaxEvents = transactMaxItems - 1
+
+# Retry settings for cancelled transactions - exponential backoff with full jitter
+transactMaxAttempts = 6
+transactBaseDelaySeconds = 0.05
+transactMaxDelaySeconds = 2.0
+retryableErrorCodes = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded', 'InternalServerError', 'TransactionInProgressException')
+retryableReasonCodes = ('TransactionConflict', 'ProvisionedThroughputExceeded', 'ThrottlingError', 'RequestLimitExceeded', 'InternalServerError')
+
+# An upload event to record - the event, as parsed by vault_event_codec.py, its item
+# and its expected key index verdict (see expected_key_index.py)
+UploadRecord = collections.namedtuple('UploadRecord', ['uploadEvent', 'item', 'verdict'])
+
+# Outcome of recording upload events - the records written and dropped, the number
+# of files not seen before, and whether every record was dropped because the logical
+# dataset has been compacted
+RecordOutcome = collections.namedtuple('RecordOutcome', ['written', 'dropped', 'fileCount', 'compacted'])
+
+def recordUploadEvents(dynamoDbClient, tableName, shard, records):
+    # Record upload events of one shard of a logical dataset, with distinct object
+    # keys, at most transactMaxEvents of them, with the change they make to the
+    # running aggregates of the shard in the same transaction. Returns the outcome.
+    # Raises ClientError if the transaction could not be written, in which case
+    # nothing was
+    storedItems = {}
+    attempt = 0
+    while True:
+        attempt += 1
+        newerRecords = []
+        droppedRecords = []
+        for record in records:
+            if isNewerEvent(record.uploadEvent, storedItems.get(itemKey(record.item))):
+                newerRecords.append(record)
+            else:
+                droppedRecords.append(record)
+        if not newerRecords:
+            return RecordOutcome([], droppedRecords, 0, False)
+        transactItems, fileCount, unexpectedRecords = buildTransaction(tableName, shard, newerRecords, storedItems)
+        try:
+            dynamoDbClient.transact_write_items(
+                TransactItems=transactItems,
+                ReturnConsumedCapacity='TOTAL',
+                )
+        except ClientError as error:
+            reasons = error.response.get('CancellationReasons', [])
+            if any(reason.get('Code') == 'TransactionConflict' for reason in reasons):
+                # Another writer of the shard updated its running aggregates at the same
+                # time, counted to alarm on the conflict rate (see fileUploadTableShardCount)
+                addCount('TransactionConflicts')
+            if len(reasons) > len(newerRecords) and reasons[len(newerRecords)].get('Code') == 'ConditionalCheckFailed':
+                # The running aggregates of the shard are marked as compacted
+                return RecordOutcome([], records, 0, True)
+            changedRecords = [(record, reason) for record, reason in zip(newerRecords, reasons) if reason.get('Code') == 'ConditionalCheckFailed']
+            if changedRecords and attempt < transactMaxAttempts:
+                # Objects seen, or recorded again, since the change was worked out - retry
+                # straight away from the stored items returned
+                for record, reason in changedRecords:
+                    storedItems[itemKey(record.item)] = reason.get('Item')
+                continue
+            retryable = error.response['Error']['Code'] in retryableErrorCodes or any(reason.get('Code') in retryableReasonCodes for reason in reasons)
+            if attempt < transactMaxAttempts and retryable:
+                backoff(attempt)
+                continue
+            raise
+        for record in unexpectedRecords:
+            flagUnexpected(record.uploadEvent)
+        return RecordOutcome(newerRecords, droppedRecords, fileCount, False)
+
+def buildTransaction(tableName, shard, records, storedItems):
+    # Actions of the transaction recording upload events over the stored items of their
+    # objects - a conditional put of each item, then the update of the running
+    # aggregates of the shard by the sum of their changes. Returns the actions, the
+    # number of files not seen before and the records of files flagged as unexpected
+    transactItems = []
+    fileCount = totalBytes = keyDigest = matchedCount = unexpectedCount = 0
+    unexpectedRecords = []
+    for record in records:
+        storedItem = storedItems.get(itemKey(record.item))
+        conditionExpression, conditionValues = storedVersionCondition(storedItem)
+        put = {
+            'TableName': tableName,
+            'Item': record.item,
+            'ConditionExpression': conditionExpression,
+            'ReturnValuesOnConditionCheckFailure': 'ALL_OLD',
+        }
+        if conditionValues:
+            put['ExpressionAttributeValues'] = conditionValues
+        transactItems.append({'Put': put})
+        files, sizes, digest = aggregateDelta(record.uploadEvent, storedItem)
+        matched, unexpected = indexCounts(record.verdict, storedItem)
+        fileCount += files
+        totalBytes += sizes
+        keyDigest += digest
+        matchedCount += matched
+        unexpectedCount += unexpected
+        if unexpected:
+            unexpectedRecords.append(record)
+
+    # The first upload event recorded for the shard is the earliest of the records, the
+    # last event time is the latest
+    firstRecord = min(records, key=lambda record: record.uploadEvent.eventTime)
+    lastEventTime = max(record.uploadEvent.eventTime for record in records)
+    transactItems.append({
+        'Update': aggregateUpdate(tableName, firstRecord.uploadEvent, shard, fileCount, totalBytes, keyDigest, lastEventTime, matchedCount, unexpectedCount)
+    })
+    return transactItems, fileCount, unexpectedRecords
+
+def backoff(attempt):
+    # Exponential backoff with full jitter
+    addCount('Retries')
+    time.sleep(random.uniform(0, min(transactMaxDelaySeconds, transactBaseDelaySeconds * (2 ** attempt))))
@@ -0,0 +1,83 @@
+#===================================================================================
+# FILE: upload_trace.py
+#
+# DESCRIPTION: Shared helpers used to trace file upload events through the pipeline.
+# Each stage stamps the trace carried in the event detail when it handles the event,
+# and records the latency of the hops ending at its stamps.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import collections
+import os
+import time
+from embedded_metrics import putMetric, setProperty
+from vault_event_codec import Trace
+
+# Configuration from the function environment, read once per execution environment.
+# Only the function that starts traces reads it, later stages trace the events that
+# carry a trace
+tracingEnabled = os.environ.get('uploadTracing', 'enabled') == 'enabled'
+
+# Stamps of a trace in the order the stages add them, with the name of the metric
+# holding the latency of the hop ending at each stamp. A hop starts at the latest
+# earlier stamp in the trace, as the "buffered" stamp is only added in the buffered
+# ingest mode
+hopMetricNames = collections.OrderedDict([
+    ('uploaded', None),                          # Storage Gateway event time
+    ('queued', 'GatewayDeliveryLatency'),        # sent to the file upload event queue
+    ('received', 'QueueWaitLatency'),            # received by the check function
+    ('classified', 'ClassifyLatency'),           # classified, entry built
+    ('published', 'PublishLatency'),             # sent to the custom bus
+    ('buffered', 'BusDeliveryLatency'),          # sent to the buffer queue
+    ('delivered', 'WriterDeliveryLatency'),      # received by the writer
+    ('written', 'WriteLatency'),                 # recorded in the table
+    ('reconciled', 'ReconcileLatency'),          # reconcile verdict (after the last file written)
+])
+stampOrder = list(hopMetricNames)
+
+# Metrics holding the latency from the upload to a stamp, by stamp
+totalMetricNames = {
+    'written': 'UploadToWrittenLatency',
+    'reconciled': 'UploadToReconciledLatency',
+}
+
+def nowMs():
+    # Current time in epoch milliseconds, the unit of every stamp
+    return int(time.time() * 1000)
+
+def startTrace(traceId, eventTime, queuedMs, receivedMs):
+    # Trace for an upload notification, from the Storage Gateway event time (epoch
+    # seconds) and the times it was queued and received
+    stamps = collections.OrderedDict([('uploaded', eventTime * 1000)])
+    if queuedMs is not None:
+        stamps['queued'] = queuedMs
+    stamps['received'] = receivedMs
+    return Trace(traceId, stamps)
+
+def addStamp(trace, name, stamp=None):
+    # Add a stamp to a trace, now unless a time is given. Returns the stamp
+    if stamp is None:
+        stamp = nowMs()
+    trace.stamps[name] = stamp
+    return stamp
+
+def recordHops(trace, names):
+    # Publish the latency of the hops ending at the named stamps of a trace, and the
+    # latency from the upload to the last of them if it is tracked
+    for name in names:
+        if name not in trace.stamps:
+            continue
+        earlier = [trace.stamps[stamp] for stamp in stampOrder[:stampOrder.index(name)] if stamp in trace.stamps]
+        if earlier:
+            putMetric(hopMetricNames[name], max(0, trace.stamps[name] - earlier[-1]), 'Milliseconds')
+    last = names[-1]
+    if last in totalMetricNames and last in trace.stamps and 'uploaded' in trace.stamps:
+        putMetric(totalMetricNames[last], max(0, trace.stamps[last] - trace.stamps['uploaded']), 'Milliseconds')
+
+def traceProperty(trace):
+    # Add the trace ID to the metrics of the invocation, so the log of an event can be
+    # found from its trace ID. Only used by functions that handle one event at a time
+    if trace is not None:
+        setProperty('traceId', trace.traceId)
@@ -0,0 +1,164 @@
+#===================================================================================
+# FILE: vault_event_codec.py
+#
+# DESCRIPTION: Encodes and decodes the "vault.application" events sent to the custom
+# EventBridge bus - the "data" and "manifest" file upload events and the file upload
+# reconciliation notifications - and their optional trace.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import collections
+import json
+from json.encoder import encode_basestring
+
+eventSource = 'vault.application'
+dataFileUploadDetailType = 'Data File Upload Event'
+manifestFileUploadDetailType = 'Manifest File Upload Event'
+reconcileSuccessfulDetailType = 'File Upload Reconciliation Successful'
+reconcileTimeoutDetailType = 'File Upload Reconciliation Timeout'
+
+# Version of the detail schema written in each event. Events without a version were
+# sent before the schema was versioned and have the same fields as version 1
+schemaVersion = 1
+
+# PutEvents service limit - maximum size in bytes of an entry (and of a whole request)
+putEventsMaxBytes = 256 * 1024
+
+# The fields of an event detail
+VaultEvent = collections.namedtuple('VaultEvent', ['setId', 'eventTime', 'bucketName', 'objectKey', 'objectSize'])
+
+# The optional trace of an event detail - its ID and the stamps (epoch milliseconds by
+# stage name) added by each stage the event passed through, in the order they were added
+Trace = collections.namedtuple('Trace', ['traceId', 'stamps'])
+
+class EventSchemaError(ValueError):
+    # Raised for an event detail that does not match the schema
+    pass
+
+class EventTooLargeError(ValueError):
+    # Raised for an entry that is over the PutEvents entry size limit
+    pass
+
+# Compact JSON detail with the fields in a fixed order - the same output as
+# json.dumps(detail, separators=(',', ':'), ensure_ascii=False) without building a
+# dictionary or walking it with the general purpose encoder
+detailTemplate = '{"schema-version":' + str(schemaVersion) + ',"set-id":%s,"event-time":%d,"bucket-name":%s,"object-key":%s,"object-size":%d}'
+decodeJson = json.JSONDecoder().decode
+
+# Trace fields, added after the other fields of a detail when it has a trace. The
+# stamps are always the last field, so a stamp can be added to an encoded detail
+traceTemplate = ',"trace-id":%s,"trace-stamps":{%s}}'
+stampTemplate = ',"%s":%d}}'
+traceStampsField = '"trace-stamps":{'
+
+# Largest stamp, in epoch milliseconds, room is reserved for in an entry
+stampMaxMs = 10 ** 13 - 1
+
+# Reconcile differences field, added before the trace fields of a reconciliation
+# notification when the keys differ
+diffTemplate = ',"reconcile-diff":%s}'
+
+def encodeDetail(vaultEvent, trace=None, diff=None):
+    # Serialise a VaultEvent, and its trace and reconcile differences if any, to the
+    # JSON detail of an event
+    detail = detailTemplate % (encode_basestring(vaultEvent.setId), vaultEvent.eventTime, encode_basestring(vaultEvent.bucketName),
+        encode_basestring(vaultEvent.objectKey), vaultEvent.objectSize)
+    if diff is not None:
+        detail = detail[:-1] + diffTemplate % json.dumps(diff, separators=(',', ':'), ensure_ascii=False)
+    if trace is None:
+        return detail
+    return detail[:-1] + traceTemplate % (encode_basestring(trace.traceId),
+        ','.join(encode_basestring(name) + ':' + str(stamp) for name, stamp in trace.stamps.items()))
+
+def hasTrace(entry):
+    # True if the detail of an entry carries a trace. The trace stamps are always the
+    # last field of a detail, and the marker cannot appear in an escaped string field
+    return traceStampsField in entry['Detail']
+
+def stampEntry(entry, name, stamp):
+    # Add a stamp to the trace of an entry without serialising its detail again. Entries
+    # without a trace are left as they are
+    if hasTrace(entry):
+        entry['Detail'] = entry['Detail'][:-2] + stampTemplate % (name, stamp)
+
+def stampSize(name):
+    # Bytes a stamp adds to the detail of an entry with a trace
+    return len(stampTemplate % (name, stampMaxMs)) - len('}}')
+
+def entrySize(entry, laterStamps=()):
+    # Size of a PutEvents entry as counted by EventBridge against the request limit,
+    # once it has been given the named stamps if it has a trace
+    size = len(entry['Source'].encode('utf-8')) + len(entry['DetailType'].encode('utf-8')) + len(entry['Detail'].encode('utf-8'))
+    if laterStamps and hasTrace(entry):
+        size += sum(stampSize(name) for name in laterStamps)
+    return size
+
+def buildEntry(detailType, vaultEvent, eventBusName, trace=None, diff=None, laterStamps=()):
+    # Build the PutEvents entry for an event, with its trace and reconcile differences
+    # if any, raising EventTooLargeError if it could never be accepted once given the
+    # named stamps
+    entry = {
+        'DetailType': detailType,
+        'Source': eventSource,
+        'Detail': encodeDetail(vaultEvent, trace, diff),
+        'EventBusName': eventBusName
+    }
+    size = entrySize(entry, laterStamps)
+    if size > putEventsMaxBytes:
+        raise EventTooLargeError('Event for ' + vaultEvent.objectKey[:100] + ' is ' + str(size) + ' bytes')
+    return entry
+
+def parseDetail(detail):
+    # Validate an event detail, either decoded (as passed to a Lambda function or state
+    # machine by EventBridge) or as a JSON string, and return it as a VaultEvent
+    if isinstance(detail, str):
+        try:
+            detail = decodeJson(detail)
+        except ValueError as error:
+            raise EventSchemaError('Event detail is not valid JSON: ' + str(error))
+    if not isinstance(detail, dict):
+        raise EventSchemaError('Event detail is not an object')
+    version = detail.get('schema-version', schemaVersion)
+    if version != schemaVersion:
+        raise EventSchemaError('Unsupported event schema version ' + repr(version))
+    try:
+        vaultEvent = VaultEvent(detail['set-id'], detail['event-time'], detail['bucket-name'], detail['object-key'], detail['object-size'])
+    except KeyError as error:
+        raise EventSchemaError('Event detail is missing ' + str(error))
+    if not (isinstance(vaultEvent.setId, str) and vaultEvent.setId and isinstance(vaultEvent.bucketName, str) and vaultEvent.bucketName
+            and isinstance(vaultEvent.objectKey, str) and vaultEvent.objectKey):
+        raise EventSchemaError('Event detail set-id, bucket-name and object-key must be non-empty strings')
+    if type(vaultEvent.eventTime) is not int or type(vaultEvent.objectSize) is not int or vaultEvent.objectSize < 0:
+        raise EventSchemaError('Event detail event-time and object-size must be integers')
+    return vaultEvent
+
+def parseTrace(detail):
+    # Return the trace of an event detail (decoded, or as a JSON string) as a Trace, or
+    # None if it has none. Traces are only used to measure latency, so a trace that does
+    # not match the schema is ignored rather than failing the event
+    if isinstance(detail, str):
+        detail = decodeJson(detail)
+    traceId = detail.get('trace-id')
+    stamps = detail.get('trace-stamps')
+    if not isinstance(traceId, str) or not isinstance(stamps, dict):
+        return None
+    if not all(type(stamp) is int for stamp in stamps.values()):
+        return None
+    return Trace(traceId, stamps)
+
+def parseEnvelope(body):
+    # Validate an EventBridge event delivered as a JSON string (e.g. the body of an SQS
+    # message) and return its detail as a VaultEvent
+    return parseTracedEnvelope(body)[0]
+
+def parseTracedEnvelope(body):
+    # As parseEnvelope, also returning the trace of the detail (None if it has none)
+    try:
+        event = decodeJson(body)
+    except ValueError as error:
+        raise EventSchemaError('Event is not valid JSON: ' + str(error))
+    if not isinstance(event, dict) or 'detail' not in event:
+        raise EventSchemaError('Event has no detail')
+    return parseDetail(event['detail']), parseTrace(event['detail'])
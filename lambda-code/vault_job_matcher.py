@@ -0,0 +1,39 @@
+#===================================================================================
+# FILE: vault_job_matcher.py
+#
+# DESCRIPTION: Compiles the vault job routing rules (passed to the function as JSON
+# in the "vaultJobRules" environment variable) into a matcher that classifies an S3
+# object key as a "data" or "manifest" file of a logical dataset, or neither.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import re
+from manifest_format import compressedSuffixes
+
+def compileMatcher(rules):
+    # Return a function that maps an object key to (setId, isManifest), or None if the
+    # key is not in a vault job directory. The job directory patterns of all rules are
+    # compiled into one regular expression with a single group, capturing the rest of
+    # the directory name, per rule - the group that matched identifies the rule
+    jobDirPattern = re.compile('|'.join(
+        re.escape(rule.get('jobDirPrefix', '')) + '([^/]+)' + re.escape(rule.get('jobDirSuffix', ''))
+        for rule in rules))
+    manifestSuffixes = [rule['manifestSuffix'] for rule in rules]
+    setIdSeparators = [rule.get('setIdSeparator', '-') for rule in rules]
+
+    def classifyObjectKey(objectKey):
+        match = jobDirPattern.fullmatch(objectKey.split('/', 1)[0])
+        if match is None:
+            return None
+        setId = match.group(match.lastindex)
+        separator = setIdSeparators[match.lastindex - 1]
+        if separator:
+            setId = setId.split(separator, 1)[0]
+        if not setId:
+            return None
+        manifestName = setId + manifestSuffixes[match.lastindex - 1]
+        return setId, objectKey.endswith(manifestName) or any(objectKey.endswith(manifestName + suffix) for suffix in compressedSuffixes)
+
+    return classifyObjectKey
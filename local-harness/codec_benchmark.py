@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#===================================================================================
+# FILE: codec_benchmark.py
+#
+# USAGE: codec_benchmark.py
+#        [--number number of operations timed per repeat]
+#        [--repeat number of repeats, the fastest is reported]
+#        [--json print the report as JSON]
+#
+# DESCRIPTION: Microbenchmarks for vault_event_codec.py - encoding the detail of a
+# "vault.application" event and building its PutEvents entry, and parsing and
+# validating a received detail or SQS message body - compared with building the
+# detail by string concatenation and reading fields from json.loads. Also checks
+# that object keys containing quotes, backslashes, control and non-ASCII characters
+# round trip through the codec (string concatenation produces invalid JSON for them).
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambda-code'))
+import vault_event_codec
+from vault_event_codec import VaultEvent, encodeDetail, buildEntry, entrySize, parseDetail, parseEnvelope
+
+sampleEvent = VaultEvent('20211201-00001', 1638316800, 'vault-bucket', '20211201-00001-vaultjob/data/part-000042/file-0001234.dat', 104857600)
+
+# Object keys that string concatenation cannot encode
+awkwardKeys = [
+    'set-vaultjob/quote"in name.dat',
+    'set-vaultjob/back\\slash.dat',
+    'set-vaultjob/tab\tand newline\n.dat',
+    'set-vaultjob/café 文件.dat'
+]
+
+def concatenatedDetail(uploadEvent):
+    # The detail as built before the codec was introduced
+    setId, epochTime, bucketName, objectKey, objectSize = uploadEvent
+    return "{\"set-id\":\""+ setId +"\",\"event-time\":"+ str(epochTime) +",\"bucket-name\":\""+ bucketName +"\",\"object-key\":\""+ objectKey +"\",\"object-size\":"+ str(objectSize) +"}"
+
+def extractedFields(detail):
+    # Field extraction as done by each function before the codec was introduced
+    return detail['set-id'], detail['event-time'], detail['bucket-name'], detail['object-key'], detail['object-size']
+
+def nanosPerOperation(statement, number, repeat):
+    # Fastest time of an operation in nanoseconds
+    return min(timeit.repeat(statement, number=number, repeat=repeat)) / number * 1e9
+
+def checkAwkwardKeys():
+    # Whether each awkward key round trips through the codec and through concatenation
+    results = []
+    for objectKey in awkwardKeys:
+        uploadEvent = sampleEvent._replace(objectKey=objectKey)
+        try:
+            concatenated = json.loads(concatenatedDetail(uploadEvent))['object-key'] == objectKey
+        except ValueError:
+            concatenated = False
+        detail = encodeDetail(uploadEvent)
+        results.append({
+            'objectKey': objectKey,
+            'codec': parseDetail(detail) == uploadEvent and detail == json.dumps(json.loads(detail), separators=(',', ':'), ensure_ascii=False),
+            'concatenation': concatenated
+        })
+    return results
+
+def main():
+    argParser = argparse.ArgumentParser(description='Microbenchmarks for the vault event codec.')
+    argParser.add_argument('--number', type=int, default=100000, help='number of operations timed per repeat')
+    argParser.add_argument('--repeat', type=int, default=5, help='number of repeats, the fastest is reported')
+    argParser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = argParser.parse_args()
+
+    detail = encodeDetail(sampleEvent)
+    decodedDetail = json.loads(detail)
+    body = json.dumps({'version': '0', 'detail-type': vault_event_codec.dataFileUploadDetailType,
+        'source': vault_event_codec.eventSource, 'detail': decodedDetail})
+    entry = buildEntry(vault_event_codec.dataFileUploadDetailType, sampleEvent, 'benchmarkEventBus')
+    benchmarks = [
+        ('encode: string concatenation', lambda: concatenatedDetail(sampleEvent)),
+        ('encode: json.dumps', lambda: json.dumps(decodedDetail, separators=(',', ':'), ensure_ascii=False)),
+        ('encode: encodeDetail', lambda: encodeDetail(sampleEvent)),
+        ('encode: buildEntry (with size check)', lambda: buildEntry(vault_event_codec.dataFileUploadDetailType, sampleEvent, 'benchmarkEventBus')),
+        ('size: entrySize', lambda: entrySize(entry)),
+        ('parse: field extraction, decoded detail', lambda: extractedFields(decodedDetail)),
+        ('parse: parseDetail, decoded detail', lambda: parseDetail(decodedDetail)),
+        ('parse: json.loads and field extraction, SQS body', lambda: extractedFields(json.loads(body)['detail'])),
+        ('parse: parseEnvelope, SQS body', lambda: parseEnvelope(body))
+    ]
+    report = {
+        'detailBytes': len(detail.encode('utf-8')),
+        'nanosPerOperation': {name: round(nanosPerOperation(statement, args.number, args.repeat)) for name, statement in benchmarks},
+        'awkwardKeys': checkAwkwardKeys()
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+    print('Fastest of ' + str(args.repeat) + ' x ' + str(args.number) + ' operations. Detail: ' + str(report['detailBytes']) + ' bytes')
+    print()
+    for name, nanos in report['nanosPerOperation'].items():
+        print('%-52s %8d ns' % (name, nanos))
+    print()
+    print('%-40s %8s %14s' % ('Object key', 'Codec', 'Concatenation'))
+    for result in report['awkwardKeys']:
+        print('%-40s %8s %14s' % (repr(result['objectKey']), 'ok' if result['codec'] else 'BROKEN', 'ok' if result['concatenation'] else 'BROKEN'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+#===================================================================================
+# FILE: cold_start_benchmark.py
+#
+# USAGE: cold_start_benchmark.py
+#        [--runs number of cold starts measured per function]
+#        [--top-imports number of slowest imports listed per function]
+#        [--json print the report as JSON]
+#
+# DESCRIPTION: Measures the cold start cost of each function in lambda-code. Each
+# function is deployed to a temporary directory exactly as the CDK application bundles
+# it (see lambda_bundles.py) and loaded in a new Python process, as in a new Lambda
+# execution environment. Reports the bundle size, the time to import the handler
+# module (the Lambda init phase), the time to create the AWS clients it uses (which
+# happens on first use, in the first invocation) and peak memory. Optionally lists
+# the slowest imports, from "python -X importtime".
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import types
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoDir)
+from storage_gateway_file_upload_notification_processing.lambda_bundles import lambdaCodeDir, bundleFiles
+from storage_gateway_file_upload_notification_processing.vault_job_rules import loadVaultJobRules
+
+# Run in the new process - loads the handler from the bundle directory and reports
+# timings as JSON. Clients are created for every lazily created client the handler
+# module holds, as the first invocation would
+coldStartScript = '''
+import importlib.util, json, resource, sys, time
+started = time.perf_counter()
+bundleDir, handlerFile = sys.argv[1], sys.argv[2]
+sys.path.insert(0, bundleDir)
+spec = importlib.util.spec_from_file_location(handlerFile[:-3].replace('-', '_'), bundleDir + '/' + handlerFile)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+services = []
+for value in list(vars(module).values()):
+    serviceName = getattr(value, 'serviceName', None)
+    if isinstance(serviceName, str) and hasattr(value, '__getattr__'):
+        getattr(value, 'meta')
+        services.append(serviceName)
+clientsCreated = time.perf_counter()
+print(json.dumps({
+    'importSeconds': imported - started,
+    'clientSeconds': clientsCreated - imported,
+    'services': sorted(set(services)),
+    'maxRssKb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+}))
+'''
+
+def functionEnvironment():
+    # Environment variables for the functions, a superset of what the stack sets for
+    # any single function
+    with open(os.path.join(repoDir, 'cdk.context.json')) as contextJson:
+        context = json.load(contextJson)
+    environment = dict(os.environ, **{
+        'AWS_DEFAULT_REGION': 'eu-west-1',
+        'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': '128',
+        'eventBusName': 'benchmarkEventBus',
+        'dynamoDbTableName': 'benchmarkTable',
+        'vaultJobRules': json.dumps(loadVaultJobRules(types.SimpleNamespace(try_get_context=context.get)))
+    })
+    for key in ('reconcileTimeoutSeconds', 'reconcileWaitMinSeconds', 'reconcileWaitMaxSeconds'):
+        environment[key] = context[key]
+    return environment
+
+def buildBundle(handlerFile, bundleDir):
+    # Copy the files the CDK application deploys for a handler. Returns the bundle size
+    bundleBytes = 0
+    for fileName in bundleFiles(handlerFile):
+        shutil.copy(os.path.join(lambdaCodeDir, fileName), bundleDir)
+        bundleBytes += os.path.getsize(os.path.join(bundleDir, fileName))
+    return bundleBytes
+
+def slowestImports(bundleDir, handlerFile, environment, count):
+    # The imports with the highest cumulative time, from "python -X importtime"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', coldStartScript, bundleDir, handlerFile],
+        env=environment, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        selfMicros, cumulativeMicros, name = line[len('import time:'):].split('|')
+        # Nested imports are indented by two spaces per level. Only the imports made by
+        # the handler and shared modules, and the imports they make, are listed
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:
+            imports.append((int(cumulativeMicros), '  ' * depth + name.strip()))
+    return [{'module': name, 'ms': round(micros / 1000, 1)} for micros, name in sorted(imports, reverse=True)[:count]]
+
+def main():
+    argParser = argparse.ArgumentParser(description='Measure the cold start cost of each function in lambda-code.')
+    argParser.add_argument('--runs', type=int, default=5, help='number of cold starts measured per function')
+    argParser.add_argument('--top-imports', type=int, default=0, help='number of slowest imports listed per function')
+    argParser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = argParser.parse_args()
+
+    environment = functionEnvironment()
+    handlerFiles = sorted(fileName for fileName in os.listdir(lambdaCodeDir) if fileName.endswith('.py') and '-' in fileName)
+    allBytes = sum(os.path.getsize(os.path.join(lambdaCodeDir, fileName)) for fileName in os.listdir(lambdaCodeDir) if fileName.endswith('.py'))
+    report = {'lambdaCodeBytes': allBytes, 'functions': {}}
+    for handlerFile in handlerFiles:
+        bundleDir = tempfile.mkdtemp(prefix='bundle-')
+        try:
+            bundleBytes = buildBundle(handlerFile, bundleDir)
+            runs = []
+            for run in range(args.runs):
+                result = subprocess.run([sys.executable, '-c', coldStartScript, bundleDir, handlerFile],
+                    env=environment, capture_output=True, text=True, check=True)
+                runs.append(json.loads(result.stdout))
+            report['functions'][handlerFile] = {
+                'bundleFiles': len(bundleFiles(handlerFile)),
+                'bundleBytes': bundleBytes,
+                'importMs': round(statistics.median(run['importSeconds'] for run in runs) * 1000, 1),
+                'clientMs': round(statistics.median(run['clientSeconds'] for run in runs) * 1000, 1),
+                'services': runs[0]['services'],
+                'maxRssMb': round(max(run['maxRssKb'] for run in runs) / 1024, 1)
+            }
+            if args.top_imports:
+                report['functions'][handlerFile]['slowestImports'] = slowestImports(bundleDir, handlerFile, environment, args.top_imports)
+        finally:
+            shutil.rmtree(bundleDir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print('Median of ' + str(args.runs) + ' cold starts. All of lambda-code: ' + str(allBytes) + ' bytes')
+    print()
+    print('%-36s %6s %8s %10s %10s %10s %8s  %s' % ('Function', 'Files', 'Bytes', 'Import ms', 'Client ms', 'Total ms', 'RSS MB', 'Clients'))
+    for handlerFile, result in report['functions'].items():
+        print('%-36s %6d %8d %10.1f %10.1f %10.1f %8.1f  %s' % (handlerFile, result['bundleFiles'], result['bundleBytes'],
+            result['importMs'], result['clientMs'], result['importMs'] + result['clientMs'], result['maxRssMb'], ', '.join(result['services'])))
+        for slowImport in result.get('slowestImports', []):
+            print('    %-60s %8.1f ms' % (slowImport['module'], slowImport['ms']))
+
+if __name__ == '__main__':
+    main()
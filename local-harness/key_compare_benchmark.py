@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#===================================================================================
+# FILE: key_compare_benchmark.py
+#
+# USAGE: key_compare_benchmark.py
+#        [--files comma separated numbers of files in the logical dataset]
+#        [--page-files number of key names per DynamoDB query page]
+#        [--legacy-max-files largest dataset compared as sorted key name strings]
+#        [--json print the report as JSON]
+#
+# DESCRIPTION: Measures the time and peak memory the reconcile check function needs
+# to compare the key names recorded in DynamoDB with a manifest file, for logical
+# datasets of millions of files. Compares the sorted key hash arrays of
+# hashed_key_set.py, with NumPy and with the standard array module fallback, with
+# the sorted lists of key name strings used before. Each variant runs in a new
+# Python process so that its peak memory can be measured. The manifest body is
+# built before measuring starts (as it is downloaded), and the query pages are
+# generated one at a time (as they are read).
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+lambdaCodeDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambda-code')
+
+# Run in the new process - builds a manifest body for the number of files, then
+# parses it, reads the key names page by page and compares them as the variant does,
+# and reports timings as JSON
+compareScript = '''
+import json, resource, sys, time
+variant, fileCount, pageFiles = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+if variant == 'array':
+    sys.modules['numpy'] = None
+sys.path.insert(0, sys.argv[4])
+import hashed_key_set
+from file_upload_event_table import keyHash
+
+def fileKey(fileNumber):
+    # Object key of a data file, as synthetic_events.fileKey lays them out
+    return '1000-vaultjob/dir' + str(fileNumber % 30).zfill(3) + '/file' + str(fileNumber).zfill(8) + '.dat'
+
+def queryPages():
+    # Pages of key names as DynamoDB returns them, in sort key order
+    keyNames = []
+    for fileNumber in range(fileCount):
+        keyNames.append(fileKey(fileNumber))
+        if len(keyNames) == pageFiles:
+            yield sorted(keyNames)
+            keyNames = []
+    if keyNames:
+        yield sorted(keyNames)
+
+body = bytearray()
+for start in range(0, fileCount, pageFiles):
+    body += ''.join([fileKey(fileNumber) + '\\n' for fileNumber in range(start, min(start + pageFiles, fileCount))]).encode('utf-8')
+startRssKb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+started = time.perf_counter()
+if variant == 'strings':
+    manifestList = body.decode('utf-8').splitlines()
+    manifestList.sort()
+    sum(keyHash(keyName) for keyName in manifestList)
+    sortedKeys = '\\n'.join(manifestList).encode('utf-8')
+    del manifestList
+    parsed = time.perf_counter()
+    keyNameList = []
+    for page in queryPages():
+        keyNameList.extend(page)
+    keyNameList.sort()
+    queried = time.perf_counter()
+    matches = len(keyNameList) == fileCount and '\\n'.join(keyNameList).encode('utf-8') == sortedKeys
+    heldBytes = len(sortedKeys) + sys.getsizeof(keyNameList) + sum(sys.getsizeof(keyName) for keyName in keyNameList)
+else:
+    manifestHashes = hashed_key_set.sortedHashArray(hashed_key_set.lineDigests(body))
+    hashed_key_set.hashSum(manifestHashes)
+    parsed = time.perf_counter()
+    keyHashes = hashed_key_set.sortedHashArray(b''.join([hashed_key_set.keyDigests(page) for page in queryPages()]))
+    queried = time.perf_counter()
+    matches = hashed_key_set.hashArraysEqual(manifestHashes, keyHashes)
+    heldBytes = (len(manifestHashes) + len(keyHashes)) * keyHashes.itemsize
+compared = time.perf_counter()
+print(json.dumps({
+    'matches': matches,
+    'parseSeconds': parsed - started,
+    'querySeconds': queried - parsed,
+    'compareSeconds': compared - queried,
+    'heldMb': heldBytes / 1024 / 1024,
+    'peakRssDeltaMb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - startRssKb) / 1024
+}))
+'''
+
+def numpyAvailable():
+    # True if NumPy can be imported, otherwise only the fallback is measured
+    result = subprocess.run([sys.executable, '-c', 'import numpy'], capture_output=True)
+    return result.returncode == 0
+
+def runVariant(variant, fileCount, pageFiles):
+    # Run the comparison for a variant in a new process and return its report
+    result = subprocess.run([sys.executable, '-c', compareScript, variant, str(fileCount), str(pageFiles), lambdaCodeDir],
+        capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+def main():
+    argParser = argparse.ArgumentParser(description='Measure the reconcile key name comparison for large logical datasets.')
+    argParser.add_argument('--files', default='1000000,10000000', help='comma separated numbers of files in the logical dataset')
+    argParser.add_argument('--page-files', type=int, default=10000, help='number of key names per DynamoDB query page')
+    argParser.add_argument('--legacy-max-files', type=int, default=2000000, help='largest dataset compared as sorted key name strings')
+    argParser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = argParser.parse_args()
+
+    variants = ['numpy', 'array'] if numpyAvailable() else ['array']
+    report = {}
+    for fileCount in [int(files) for files in args.files.split(',')]:
+        report[fileCount] = {}
+        for variant in (['strings'] if fileCount <= args.legacy_max_files else []) + variants:
+            report[fileCount][variant] = runVariant(variant, fileCount, args.page_files)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print('%10s %-8s %10s %10s %10s %10s %10s %12s' % ('Files', 'Variant', 'Parse s', 'Query s', 'Compare s', 'Total s', 'Held MB', 'Peak RSS MB'))
+    for fileCount, results in report.items():
+        for variant, result in results.items():
+            totalSeconds = result['parseSeconds'] + result['querySeconds'] + result['compareSeconds']
+            print('%10d %-8s %10.2f %10.2f %10.3f %10.2f %10.1f %12.1f%s' % (fileCount, variant, result['parseSeconds'], result['querySeconds'],
+                result['compareSeconds'], totalSeconds, result['heldMb'], result['peakRssDeltaMb'], '' if result['matches'] else '  MISMATCH'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,802 @@
+#===================================================================================
+# FILE: local_aws.py
+#
+# DESCRIPTION: In-memory stand-ins for the AWS service clients used by the functions
+# in lambda-code (Amazon DynamoDB, Amazon S3, Amazon EventBridge, AWS Step Functions)
+# and for an Amazon SQS queue. Used by pipeline_simulator.py to run the event
+# processing flow locally. Only the API calls and request parameters used by this
+# application are implemented. Every call is counted, can be given a simulated
+# latency, and errors are raised as botocore ClientErrors like the real clients.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import collections
+import copy
+import functools
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+# DynamoDB limits modelled by the table stand-in
+queryPageMaxBytes = 1024 * 1024
+batchWriteMaxItems = 25
+transactWriteMaxItems = 100
+batchGetMaxKeys = 100
+
+# EventBridge limits modelled by the event bus stand-in
+putEventsMaxEntries = 10
+putEventsMaxBytes = 256 * 1024
+
+def clientError(code, operationName, message='', httpStatusCode=400):
+    # Build a ClientError shaped like those raised by botocore
+    return ClientError({
+        'Error': {'Code': code, 'Message': message},
+        'ResponseMetadata': {'HTTPStatusCode': httpStatusCode}
+    }, operationName)
+
+class ApiStats:
+    # Counts API calls by service and operation, and adds a simulated latency to each
+    # call. Shared by all stand-ins in a simulation
+
+    def __init__(self, latencySeconds=0.0):
+        self.latencySeconds = latencySeconds
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def record(self, service, operation):
+        if self.latencySeconds:
+            time.sleep(self.latencySeconds)
+        with self.lock:
+            self.calls[service + '.' + operation] += 1
+
+#-----------------------------------------------------------------------------------
+# Amazon DynamoDB
+#-----------------------------------------------------------------------------------
+
+def attributeValue(value):
+    # Convert a DynamoDB attribute value to a comparable Python value
+    (valueType, raw), = value.items()
+    if valueType == 'N':
+        return int(raw) if re.match(r'^-?\d+$', raw) else float(raw)
+    if valueType == 'NS':
+        return frozenset(attributeValue({'N': number}) for number in raw)
+    if valueType == 'SS':
+        return frozenset(raw)
+    return raw
+
+def numberValue(number):
+    return {'N': str(number)}
+
+def itemSize(item):
+    # Approximate size of an item as counted by DynamoDB
+    size = 0
+    for name, value in item.items():
+        (valueType, raw), = value.items()
+        size += len(name.encode('utf-8'))
+        if valueType == 'N':
+            size += (len(raw) + 1) // 2 + 1
+        elif valueType == 'S':
+            size += len(raw.encode('utf-8'))
+        elif valueType == 'B':
+            size += len(raw)
+        else:
+            size += len(json.dumps(raw))
+    return size
+
+def capacityUnits(sizeBytes, blockBytes, unitsPerBlock=1.0):
+    return max(1, math.ceil(sizeBytes / blockBytes)) * unitsPerBlock
+
+class Expression:
+    # Minimal parser and evaluator for the DynamoDB expression syntax used by this
+    # application - condition, key condition, update and projection expressions
+
+    tokenPattern = re.compile(r'\s*(<>|<=|>=|[=<>(),]|:[A-Za-z0-9_]+|#[A-Za-z0-9_]+|[A-Za-z_][A-Za-z0-9_.]*|\S)')
+
+    def __init__(self, text, names=None, values=None):
+        self.tokens = self.tokenPattern.findall(text or '')
+        self.position = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token.upper() != expected):
+            raise clientError('ValidationException', 'Expression', 'Invalid expression near ' + str(token))
+        self.position += 1
+        return token
+
+    def name(self, token):
+        return self.names.get(token, token)
+
+    def operand(self, item):
+        token = self.take()
+        if token.startswith(':'):
+            return attributeValue(self.values[token])
+        if token.lower() == 'size':
+            self.take('(')
+            value = item.get(self.name(self.take()))
+            self.take(')')
+            return len(attributeValue(value)) if value else None
+        value = item.get(self.name(token))
+        return attributeValue(value) if value else None
+
+    # Conditions: OR > AND > NOT > comparison / function
+    def condition(self, item):
+        result = self.conjunction(item)
+        while self.peek() and self.peek().upper() == 'OR':
+            self.take()
+            right = self.conjunction(item)
+            result = result or right
+        return result
+
+    def conjunction(self, item):
+        result = self.negation(item)
+        while self.peek() and self.peek().upper() == 'AND':
+            self.take()
+            right = self.negation(item)
+            result = result and right
+        return result
+
+    def negation(self, item):
+        if self.peek() and self.peek().upper() == 'NOT':
+            self.take()
+            return not self.negation(item)
+        return self.comparison(item)
+
+    def comparison(self, item):
+        token = self.peek()
+        if token == '(':
+            self.take()
+            result = self.condition(item)
+            self.take(')')
+            return result
+        if token in ('attribute_exists', 'attribute_not_exists'):
+            self.take()
+            self.take('(')
+            exists = self.name(self.take()) in item
+            self.take(')')
+            return exists if token == 'attribute_exists' else not exists
+        if token == 'contains':
+            self.take()
+            self.take('(')
+            value = self.operand(item)
+            self.take(',')
+            member = self.operand(item)
+            self.take(')')
+            return value is not None and member in value
+        if token == 'begins_with':
+            self.take()
+            self.take('(')
+            value = self.operand(item)
+            self.take(',')
+            prefix = self.operand(item)
+            self.take(')')
+            return isinstance(value, str) and value.startswith(prefix)
+        left = self.operand(item)
+        operator = self.take()
+        if operator.upper() == 'BETWEEN':
+            low = self.operand(item)
+            self.take('AND')
+            high = self.operand(item)
+            return left is not None and low <= left <= high
+        right = self.operand(item)
+        if operator == '=':
+            return left == right
+        if operator == '<>':
+            return left != right
+        if left is None or right is None:
+            return False
+        return {'<': left < right, '<=': left <= right, '>': left > right, '>=': left >= right}[operator]
+
+    # Updates: SET/ADD/REMOVE/DELETE clauses
+    def update(self, item):
+        while self.peek():
+            clause = self.take().upper()
+            while True:
+                if clause == 'SET':
+                    target = self.name(self.take())
+                    self.take('=')
+                    item[target] = self.setValue(item)
+                elif clause == 'ADD':
+                    target = self.name(self.take())
+                    delta = self.values[self.take()]
+                    current = attributeValue(item[target]) if target in item else 0
+                    item[target] = numberValue(current + attributeValue(delta))
+                elif clause == 'REMOVE':
+                    item.pop(self.name(self.take()), None)
+                elif clause == 'DELETE':
+                    # Remove elements from a set, removing the attribute if it is left empty
+                    target = self.name(self.take())
+                    (setType, removed), = self.values[self.take()].items()
+                    if target in item:
+                        remaining = [element for element in item[target][setType] if element not in removed]
+                        if remaining:
+                            item[target] = {setType: remaining}
+                        else:
+                            del item[target]
+                else:
+                    raise clientError('ValidationException', 'UpdateItem', 'Unsupported clause ' + clause)
+                if self.peek() != ',':
+                    break
+                self.take(',')
+
+    def setValue(self, item):
+        value = self.setOperand(item)
+        if self.peek() in ('+', '-'):
+            operator = self.take()
+            right = self.setOperand(item)
+            total = attributeValue(value) + attributeValue(right) if operator == '+' else attributeValue(value) - attributeValue(right)
+            return numberValue(total)
+        return value
+
+    def setOperand(self, item):
+        token = self.take()
+        if token.startswith(':'):
+            return self.values[token]
+        if token == 'if_not_exists':
+            self.take('(')
+            target = self.name(self.take())
+            self.take(',')
+            default = self.setOperand(item)
+            self.take(')')
+            return item.get(target, default)
+        return item[self.name(token)]
+
+def project(item, projectionExpression, names):
+    if not projectionExpression:
+        return copy.deepcopy(item)
+    attributes = [names.get(name.strip(), name.strip()) for name in projectionExpression.split(',')]
+    return {name: copy.deepcopy(item[name]) for name in attributes if name in item}
+
+class LocalDynamoDbClient:
+    # Stand-in for the DynamoDB client. Holds any number of tables, each with the
+    # setId/objectKey key schema of the file upload event table
+
+    def __init__(self, apiStats, failureRate=0.0, seed=0, lostResponseRate=0.0):
+        self.apiStats = apiStats
+        self.failureRate = failureRate
+        self.lostResponseRate = lostResponseRate
+        self.lostResponses = 0
+        self.random = random.Random(seed)
+        self.tables = collections.defaultdict(dict)
+        self.itemSizes = collections.defaultdict(dict)
+        self.lock = threading.RLock()
+        self.consumedWriteUnits = 0.0
+        self.consumedReadUnits = 0.0
+        self.partitionWriteUnits = collections.Counter()
+
+    def key(self, item):
+        return (item['setId']['S'], item['objectKey']['S'])
+
+    def storeItem(self, tableName, item):
+        # Store an item, keeping the size it was last written with even once deleted
+        self.tables[tableName][self.key(item)] = item
+        self.itemSizes[tableName][self.key(item)] = itemSize(item)
+
+    def recordWrite(self, item, units):
+        # Write capacity consumed, in total and by partition key value
+        self.consumedWriteUnits += units
+        self.partitionWriteUnits[item['setId']['S']] += units
+
+    def consumedCapacity(self, response, tableName, unitsBefore, kwargs, perTable=False):
+        # Add the capacity consumed since unitsBefore to a response, if it was asked for
+        if kwargs.get('ReturnConsumedCapacity', 'NONE') != 'NONE':
+            consumed = {'TableName': tableName, 'CapacityUnits': self.consumedReadUnits + self.consumedWriteUnits - unitsBefore}
+            response['ConsumedCapacity'] = [consumed] if perTable else consumed
+        return response
+
+    def injectFailure(self):
+        return self.failureRate and self.random.random() < self.failureRate
+
+    def checkCondition(self, operationName, item, kwargs):
+        if 'ConditionExpression' in kwargs:
+            expression = Expression(kwargs['ConditionExpression'], kwargs.get('ExpressionAttributeNames'), kwargs.get('ExpressionAttributeValues'))
+            if not expression.condition(item or {}):
+                error = clientError('ConditionalCheckFailedException', operationName, 'The conditional request failed')
+                if kwargs.get('ReturnValuesOnConditionCheckFailure') == 'ALL_OLD' and item:
+                    error.response['Item'] = copy.deepcopy(item)
+                raise error
+
+    def put_item(self, TableName, Item, ReturnValues='NONE', **kwargs):
+        self.apiStats.record('dynamodb', 'PutItem')
+        with self.lock:
+            unitsBefore = self.consumedReadUnits + self.consumedWriteUnits
+            table = self.tables[TableName]
+            key = self.key(Item)
+            old = table.get(key)
+            self.checkCondition('PutItem', old, kwargs)
+            self.storeItem(TableName, copy.deepcopy(Item))
+            self.recordWrite(Item, capacityUnits(max(itemSize(Item), itemSize(old or {})), 1024))
+            response = {'Attributes': copy.deepcopy(old)} if old is not None and ReturnValues == 'ALL_OLD' else {}
+            return self.consumedCapacity(response, TableName, unitsBefore, kwargs)
+
+    def update_item(self, TableName, Key, UpdateExpression, ReturnValues='NONE', **kwargs):
+        self.apiStats.record('dynamodb', 'UpdateItem')
+        with self.lock:
+            unitsBefore = self.consumedReadUnits + self.consumedWriteUnits
+            table = self.tables[TableName]
+            key = self.key(Key)
+            old = table.get(key)
+            self.checkCondition('UpdateItem', old, kwargs)
+            item = copy.deepcopy(old) if old is not None else copy.deepcopy(Key)
+            Expression(UpdateExpression, kwargs.get('ExpressionAttributeNames'), kwargs.get('ExpressionAttributeValues')).update(item)
+            self.storeItem(TableName, item)
+            self.recordWrite(Key, capacityUnits(max(itemSize(item), itemSize(old or {})), 1024))
+            response = {}
+            if ReturnValues in ('ALL_NEW', 'UPDATED_NEW'):
+                response = {'Attributes': copy.deepcopy(item)}
+            if ReturnValues in ('ALL_OLD', 'UPDATED_OLD') and old is not None:
+                response = {'Attributes': copy.deepcopy(old)}
+            return self.consumedCapacity(response, TableName, unitsBefore, kwargs)
+
+    def delete_item(self, TableName, Key, ReturnValues='NONE', **kwargs):
+        self.apiStats.record('dynamodb', 'DeleteItem')
+        with self.lock:
+            unitsBefore = self.consumedReadUnits + self.consumedWriteUnits
+            table = self.tables[TableName]
+            old = table.get(self.key(Key))
+            self.checkCondition('DeleteItem', old, kwargs)
+            table.pop(self.key(Key), None)
+            self.recordWrite(Key, capacityUnits(itemSize(old or {}), 1024))
+            response = {'Attributes': copy.deepcopy(old)} if old is not None and ReturnValues == 'ALL_OLD' else {}
+            return self.consumedCapacity(response, TableName, unitsBefore, kwargs)
+
+    def get_item(self, TableName, Key, ProjectionExpression=None, ExpressionAttributeNames=None, ConsistentRead=False, **kwargs):
+        self.apiStats.record('dynamodb', 'GetItem')
+        with self.lock:
+            item = self.tables[TableName].get(self.key(Key))
+            self.consumedReadUnits += capacityUnits(itemSize(item or {}), 4096, 1.0 if ConsistentRead else 0.5)
+            return {'Item': project(item, ProjectionExpression, ExpressionAttributeNames or {})} if item is not None else {}
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeValues, ProjectionExpression=None, ExpressionAttributeNames=None, ExclusiveStartKey=None, Limit=None, ConsistentRead=False, ReturnConsumedCapacity='NONE', **kwargs):
+        self.apiStats.record('dynamodb', 'Query')
+        names = ExpressionAttributeNames or {}
+        with self.lock:
+            items = sorted(self.tables[TableName].items())
+        items = [item for key, item in items if Expression(KeyConditionExpression, names, ExpressionAttributeValues).condition(item)]
+        if not kwargs.get('ScanIndexForward', True):
+            items.reverse()
+        if ExclusiveStartKey is not None:
+            startKey = self.key(ExclusiveStartKey)
+            items = [item for item in items if (self.key(item) > startKey if kwargs.get('ScanIndexForward', True) else self.key(item) < startKey)]
+
+        # Pages end at 1 MB of items read, or at the limit
+        page = []
+        pageBytes = 0
+        for item in items:
+            if pageBytes >= queryPageMaxBytes or (Limit and len(page) >= Limit):
+                break
+            page.append(item)
+            pageBytes += itemSize(item)
+        units = capacityUnits(pageBytes, 4096, 1.0 if ConsistentRead else 0.5)
+        self.consumedReadUnits += units
+
+        # Filters apply to the page read, so filtered items still consume capacity
+        scannedCount = len(page)
+        filterExpression = kwargs.get('FilterExpression')
+        matched = [item for item in page if filterExpression is None or Expression(filterExpression, names, ExpressionAttributeValues).condition(item)]
+        response = {'Items': [project(item, ProjectionExpression, names) for item in matched], 'Count': len(matched), 'ScannedCount': scannedCount}
+        if len(page) < len(items):
+            response['LastEvaluatedKey'] = {'setId': page[-1]['setId'], 'objectKey': page[-1]['objectKey']}
+        if ReturnConsumedCapacity != 'NONE':
+            response['ConsumedCapacity'] = {'TableName': TableName, 'CapacityUnits': units}
+        return response
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.apiStats.record('dynamodb', 'BatchWriteItem')
+        unprocessed = {}
+        requestCount = 0
+        with self.lock:
+            unitsBefore = self.consumedReadUnits + self.consumedWriteUnits
+            for tableName, requests in RequestItems.items():
+                keys = set()
+                for request in requests:
+                    requestCount += 1
+                    item = request['PutRequest']['Item'] if 'PutRequest' in request else request['DeleteRequest']['Key']
+                    if self.key(item) in keys:
+                        raise clientError('ValidationException', 'BatchWriteItem', 'Provided list of item keys contains duplicates')
+                    keys.add(self.key(item))
+                if requestCount > batchWriteMaxItems:
+                    raise clientError('ValidationException', 'BatchWriteItem', 'Too many items requested for the BatchWriteItem call')
+                for request in requests:
+                    if self.injectFailure():
+                        unprocessed.setdefault(tableName, []).append(request)
+                        continue
+                    if 'PutRequest' in request:
+                        item = request['PutRequest']['Item']
+                        self.storeItem(tableName, copy.deepcopy(item))
+                        self.recordWrite(item, capacityUnits(itemSize(item), 1024))
+                    else:
+                        old = self.tables[tableName].pop(self.key(request['DeleteRequest']['Key']), None)
+                        self.recordWrite(request['DeleteRequest']['Key'], capacityUnits(itemSize(old or {}), 1024))
+            return self.consumedCapacity({'UnprocessedItems': unprocessed}, next(iter(RequestItems)), unitsBefore, kwargs, perTable=True)
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self.apiStats.record('dynamodb', 'BatchGetItem')
+        responses = {}
+        unprocessed = {}
+        with self.lock:
+            unitsBefore = self.consumedReadUnits + self.consumedWriteUnits
+            for tableName, request in RequestItems.items():
+                if len(request['Keys']) > batchGetMaxKeys:
+                    raise clientError('ValidationException', 'BatchGetItem', 'Too many items requested for the BatchGetItem call')
+                names = request.get('ExpressionAttributeNames', {})
+                responses[tableName] = []
+                for key in request['Keys']:
+                    if self.injectFailure():
+                        unprocessed.setdefault(tableName, dict(request, Keys=[]))['Keys'].append(key)
+                        continue
+                    item = self.tables[tableName].get(self.key(key))
+                    self.consumedReadUnits += capacityUnits(itemSize(item or {}), 4096, 1.0 if request.get('ConsistentRead') else 0.5)
+                    if item is not None:
+                        responses[tableName].append(project(item, request.get('ProjectionExpression'), names))
+            return self.consumedCapacity({'Responses': responses, 'UnprocessedKeys': unprocessed}, next(iter(RequestItems)), unitsBefore, kwargs, perTable=True)
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        # All actions are applied, or none. Every condition is checked before anything is
+        # written, and a cancelled transaction reports a reason for each action in order.
+        # Transactional writes consume twice the write capacity of standard writes. A
+        # share of the transactions written can have their response lost, as if the
+        # function failed after the items were written but before it could act on it
+        self.apiStats.record('dynamodb', 'TransactWriteItems')
+        if len(TransactItems) > transactWriteMaxItems:
+            raise clientError('ValidationException', 'TransactWriteItems', 'Member must have length less than or equal to ' + str(transactWriteMaxItems))
+        with self.lock:
+            unitsBefore = self.consumedReadUnits + self.consumedWriteUnits
+            actions = []
+            keys = set()
+            for transactItem in TransactItems:
+                actionType, action = next(iter(transactItem.items()))
+                key = (action['TableName'], self.key(action['Item'] if actionType == 'Put' else action['Key']))
+                if key in keys:
+                    raise clientError('ValidationException', 'TransactWriteItems', 'Transaction request cannot include multiple operations on one item')
+                keys.add(key)
+                actions.append((actionType, action, key))
+            reasons = []
+            for actionType, action, (tableName, key) in actions:
+                old = self.tables[tableName].get(key)
+                try:
+                    self.checkCondition(actionType + 'Item', old, action)
+                    reasons.append({'Code': 'None'})
+                except ClientError as error:
+                    reason = {'Code': 'ConditionalCheckFailed', 'Message': 'The conditional request failed'}
+                    if 'Item' in error.response:
+                        reason['Item'] = error.response['Item']
+                    reasons.append(reason)
+            if self.injectFailure() and all(reason['Code'] == 'None' for reason in reasons):
+                reasons[self.random.randrange(len(reasons))] = {'Code': 'TransactionConflict', 'Message': 'Transaction is ongoing for the item'}
+            if any(reason['Code'] != 'None' for reason in reasons):
+                error = clientError('TransactionCanceledException', 'TransactWriteItems', 'Transaction cancelled, please refer cancellation reasons for specific reasons [' + ', '.join(reason['Code'] for reason in reasons) + ']')
+                error.response['CancellationReasons'] = reasons
+                raise error
+            for actionType, action, (tableName, key) in actions:
+                old = self.tables[tableName].get(key)
+                if actionType == 'Put':
+                    item = copy.deepcopy(action['Item'])
+                else:
+                    item = copy.deepcopy(old) if old is not None else copy.deepcopy(action['Key'])
+                    Expression(action['UpdateExpression'], action.get('ExpressionAttributeNames'), action.get('ExpressionAttributeValues')).update(item)
+                self.storeItem(tableName, item)
+                self.recordWrite(item, capacityUnits(max(itemSize(item), itemSize(old or {})), 1024, 2.0))
+            if self.lostResponseRate and self.random.random() < self.lostResponseRate:
+                self.lostResponses += 1
+                raise ReadTimeoutError(endpoint_url='https://dynamodb.local')
+            return self.consumedCapacity({}, actions[0][2][0], unitsBefore, kwargs, perTable=True)
+
+#-----------------------------------------------------------------------------------
+# Amazon S3
+#-----------------------------------------------------------------------------------
+
+class LocalBody:
+    # Stand-in for a streaming response body
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size=-1):
+        data, self.data = (self.data, b'') if size is None or size < 0 else (self.data[:size], self.data[size:])
+        return data
+
+    def iter_chunks(self, chunk_size=1024 * 1024):
+        while self.data:
+            yield self.read(chunk_size)
+
+class LocalS3Client:
+    # Stand-in for the S3 client. A caller without s3:ListBucket on a bucket is denied
+    # (403) reading a key that does not exist, rather than told it is not found (404),
+    # as by S3
+
+    def __init__(self, apiStats, listableBuckets=None):
+        self.apiStats = apiStats
+        self.listableBuckets = listableBuckets
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.bytesRead = 0
+
+    def withListBucket(self, bucketNames):
+        # The client as seen by a function granted s3:ListBucket on the given buckets only,
+        # sharing the objects of this client
+        view = copy.copy(self)
+        view.listableBuckets = frozenset(bucketNames)
+        return view
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        self.apiStats.record('s3', 'PutObject')
+        data = Body.encode('utf-8') if isinstance(Body, str) else (Body.read() if hasattr(Body, 'read') else bytes(Body))
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        with self.lock:
+            self.objects[(Bucket, Key)] = (data, etag, dict(kwargs))
+        return {'ETag': etag}
+
+    def lookup(self, operationName, Bucket, Key):
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                if self.listableBuckets is not None and Bucket not in self.listableBuckets:
+                    # Responses to HEAD requests have no body, so only the status code is known
+                    raise clientError('403' if operationName == 'HeadObject' else 'AccessDenied', operationName, 'Access Denied', 403)
+                raise clientError('NoSuchKey', operationName, 'The specified key does not exist.', 404)
+            return self.objects[(Bucket, Key)]
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.apiStats.record('s3', 'HeadObject')
+        data, etag, extra = self.lookup('HeadObject', Bucket, Key)
+        return {'ContentLength': len(data), 'ETag': etag, 'Metadata': extra.get('Metadata', {})}
+
+    def get_object(self, Bucket, Key, Range=None, IfNoneMatch=None, IfMatch=None, **kwargs):
+        self.apiStats.record('s3', 'GetObject')
+        data, etag, extra = self.lookup('GetObject', Bucket, Key)
+        if IfMatch is not None and IfMatch != etag:
+            raise clientError('PreconditionFailed', 'GetObject', 'At least one of the pre-conditions you specified did not hold', 412)
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise clientError('304', 'GetObject', 'Not Modified', 304)
+        response = {'ETag': etag, 'ContentLength': len(data), 'Metadata': extra.get('Metadata', {})}
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            start = int(start)
+            end = min(int(end), len(data) - 1) if end else len(data) - 1
+            if start >= len(data):
+                raise clientError('InvalidRange', 'GetObject', 'The requested range is not satisfiable', 416)
+            response['ContentRange'] = 'bytes ' + str(start) + '-' + str(end) + '/' + str(len(data))
+            data = data[start:end + 1]
+            response['ContentLength'] = len(data)
+        with self.lock:
+            self.bytesRead += len(data)
+        response['Body'] = LocalBody(data)
+        return response
+
+#-----------------------------------------------------------------------------------
+# Amazon SQS
+#-----------------------------------------------------------------------------------
+
+class LocalSqsQueue:
+    # Stand-in for an SQS queue drained by a Lambda event source mapping. The
+    # simulation calls receive() to take a batch of visible messages and release()
+    # to make failed messages visible again after the visibility timeout
+
+    def __init__(self, name, visibilityTimeoutSeconds=30, maxReceiveCount=None):
+        self.name = name
+        self.visibilityTimeoutSeconds = visibilityTimeoutSeconds
+        self.maxReceiveCount = maxReceiveCount
+        self.visible = collections.deque()
+        self.sentCount = 0
+        self.deadLetters = []
+        self.nextMessageId = 0
+
+    def send(self, body, now):
+        self.nextMessageId += 1
+        self.sentCount += 1
+        self.visible.append({'messageId': self.name + '-' + str(self.nextMessageId), 'body': body, 'receiveCount': 0, 'sentTime': now})
+
+    def receive(self, maxMessages):
+        batch = []
+        while self.visible and len(batch) < maxMessages:
+            message = self.visible.popleft()
+            message['receiveCount'] += 1
+            batch.append(message)
+        return batch
+
+    def release(self, message):
+        # Returns False if the message has been received too many times and was moved
+        # to the dead letter list instead
+        if self.maxReceiveCount is not None and message['receiveCount'] >= self.maxReceiveCount:
+            self.deadLetters.append(message)
+            return False
+        self.visible.append(message)
+        return True
+
+def sqsRecord(message, queueName):
+    # SQS event record, as passed to a Lambda function by an SQS event source mapping
+    return {
+        'messageId': message['messageId'],
+        'receiptHandle': message['messageId'],
+        'body': message['body'],
+        'attributes': {
+            'ApproximateReceiveCount': str(message['receiveCount']),
+            'SentTimestamp': str(int(message['sentTime'] * 1000))
+        },
+        'messageAttributes': {},
+        'eventSource': 'aws:sqs',
+        'eventSourceARN': 'arn:aws:sqs:local:000000000000:' + queueName,
+        'awsRegion': 'local'
+    }
+
+#-----------------------------------------------------------------------------------
+# Amazon EventBridge
+#-----------------------------------------------------------------------------------
+
+def patternMatches(pattern, event):
+    # Match an event against an EventBridge event pattern. Supports exact values,
+    # prefix, suffix, wildcard and anything-but content filters
+    for field, expected in pattern.items():
+        value = event.get(field)
+        if isinstance(expected, dict):
+            if not isinstance(value, dict) or not patternMatches(expected, value):
+                return False
+            continue
+        if not any(valueMatches(rule, value) for rule in expected):
+            return False
+    return True
+
+def valueMatches(rule, value):
+    if not isinstance(rule, dict):
+        return value == rule
+    if value is None:
+        return False
+    if 'prefix' in rule:
+        return isinstance(value, str) and value.startswith(rule['prefix'])
+    if 'suffix' in rule:
+        return isinstance(value, str) and value.endswith(rule['suffix'])
+    if 'wildcard' in rule:
+        return isinstance(value, str) and wildcardPattern(rule['wildcard']).fullmatch(value) is not None
+    if 'anything-but' in rule:
+        excluded = rule['anything-but']
+        return value not in (excluded if isinstance(excluded, list) else [excluded])
+    raise ValueError('Unsupported content filter ' + json.dumps(rule))
+
+@functools.lru_cache(maxsize=None)
+def wildcardPattern(wildcard):
+    # Regular expression for an EventBridge wildcard filter, where * matches any
+    # characters and a backslash escapes * or backslash
+    parts = []
+    characters = iter(wildcard)
+    for character in characters:
+        if character == '\\':
+            parts.append(re.escape(next(characters, '\\')))
+        elif character == '*':
+            parts.append('.*')
+        else:
+            parts.append(re.escape(character))
+    return re.compile(''.join(parts), re.DOTALL)
+
+def eventEntrySize(entry):
+    size = len(entry['Source'].encode('utf-8')) + len(entry['DetailType'].encode('utf-8'))
+    if entry.get('Detail'):
+        size += len(entry['Detail'].encode('utf-8'))
+    if entry.get('Time'):
+        size += 14
+    for resource in entry.get('Resources', []):
+        size += len(resource.encode('utf-8'))
+    return size
+
+class LocalEventsClient:
+    # Stand-in for the EventBridge client. Accepted events are passed to the deliver
+    # callback (bus name, event) which routes them to rule targets
+
+    def __init__(self, apiStats, deliver, clock, failureRate=0.0, seed=0):
+        self.apiStats = apiStats
+        self.deliver = deliver
+        self.clock = clock
+        self.failureRate = failureRate
+        self.random = random.Random(seed)
+        self.nextEventId = 0
+
+    def put_events(self, Entries, **kwargs):
+        self.apiStats.record('events', 'PutEvents')
+        if len(Entries) > putEventsMaxEntries:
+            raise clientError('ValidationException', 'PutEvents', 'Too many entries')
+        if sum(eventEntrySize(entry) for entry in Entries) > putEventsMaxBytes:
+            raise clientError('ValidationException', 'PutEvents', 'Total size of the entries in the request is over the limit')
+
+        results = []
+        for entry in Entries:
+            if self.failureRate and self.random.random() < self.failureRate:
+                results.append({'ErrorCode': 'ThrottlingException', 'ErrorMessage': 'Rate exceeded'})
+                continue
+            try:
+                detail = json.loads(entry['Detail'])
+            except ValueError:
+                results.append({'ErrorCode': 'MalformedDetail', 'ErrorMessage': 'Detail is malformed.'})
+                continue
+            self.nextEventId += 1
+            eventId = 'local-event-' + str(self.nextEventId)
+            self.deliver(entry.get('EventBusName', 'default'), {
+                'version': '0',
+                'id': eventId,
+                'detail-type': entry['DetailType'],
+                'source': entry['Source'],
+                'account': '000000000000',
+                'time': isoTime(self.clock.time()),
+                'region': 'local',
+                'resources': entry.get('Resources', []),
+                'detail': detail
+            })
+            results.append({'EventId': eventId})
+        return {'FailedEntryCount': sum(1 for result in results if 'ErrorCode' in result), 'Entries': results}
+
+#-----------------------------------------------------------------------------------
+# AWS Step Functions
+#-----------------------------------------------------------------------------------
+
+class LocalSfnClient:
+    # Stand-in for the Step Functions client. Task tokens are registered by the state
+    # machine stand-in, which is called back when an execution is resumed
+
+    def __init__(self, apiStats, startExecution):
+        self.apiStats = apiStats
+        self.startExecution = startExecution
+        self.taskTokens = {}
+        self.executionNames = set()
+        self.lock = threading.Lock()
+
+    def registerTaskToken(self, taskToken, onSuccess):
+        with self.lock:
+            self.taskTokens[taskToken] = onSuccess
+
+    def expireTaskToken(self, taskToken):
+        with self.lock:
+            return self.taskTokens.pop(taskToken, None) is not None
+
+    def send_task_success(self, taskToken, output):
+        self.apiStats.record('states', 'SendTaskSuccess')
+        with self.lock:
+            onSuccess = self.taskTokens.pop(taskToken, None)
+        if onSuccess is None:
+            raise clientError('TaskTimedOut', 'SendTaskSuccess', 'Task Timed Out')
+        onSuccess(json.loads(output))
+        return {}
+
+    def start_execution(self, stateMachineArn, input, name=None, **kwargs):
+        self.apiStats.record('states', 'StartExecution')
+        with self.lock:
+            if name is not None and name in self.executionNames:
+                raise clientError('ExecutionAlreadyExists', 'StartExecution', 'Execution Already Exists: ' + name)
+            if name is not None:
+                self.executionNames.add(name)
+        executionArn = self.startExecution(stateMachineArn, json.loads(input), name)
+        return {'executionArn': executionArn, 'startDate': None}
+
+#-----------------------------------------------------------------------------------
+# Simulated time
+#-----------------------------------------------------------------------------------
+
+def isoTime(epochSeconds):
+    # ISO 8601 timestamp with milliseconds, as used by EventBridge and Step Functions
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(epochSeconds)) + '.%03dZ' % int((epochSeconds % 1) * 1000)
+
+class VirtualClock:
+    # Simulated wall clock. Exposes time() and sleep() so it can replace the time
+    # module in the functions under test (sleeps advance the clock instead of blocking)
+    # while every other attribute is taken from the real time module
+
+    def __init__(self, start):
+        self.now = start
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
@@ -0,0 +1,795 @@
+#!/usr/bin/env python3
+#===================================================================================
+# FILE: pipeline_simulator.py
+#
+# USAGE: pipeline_simulator.py
+#        [workload options, see synthetic_events.py]
+#        [--api-latency-ms simulated latency added to every API call]
+#        [--failure-rate fraction of batch entries returned as unprocessed]
+#        [--progress-poll-seconds simulated seconds between set progress requests]
+#        [--progress-pollers number of dashboards requesting set progress]
+#        [--context key=value cdk context value override, may be repeated]
+#        [--json print the report as JSON]
+#
+# DESCRIPTION: Runs the whole file upload notification processing pipeline locally,
+# without deploying to AWS. The functions in lambda-code are loaded and wired as in
+# storage_gateway_event_processing.py (using the modes and settings in
+# cdk.context.json), with the AWS services replaced by the in-memory stand-ins in
+# local_aws.py - the default and custom EventBridge buses and their rules, the SQS
+# queues and event source mappings, the DynamoDB table, the S3 bucket and the
+# "reconcile file uploads" Step Functions state machine. Time is simulated, so waits
+# and upload windows take no wall time, while each function invocation runs (and is
+# timed) for real. The workload of upload events is generated by synthetic_events.py.
+# Reports throughput in events per second, latency percentiles for each stage, a
+# latency histogram for each hop of the traced upload events, API calls per file, the
+# totals of the metrics each function published, the time taken to reconcile each
+# set, the reconcile reports of the keys that differ and the set progress requests
+# made by simulated dashboards polling every set uploaded so far.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import argparse
+import collections
+import contextlib
+import copy
+import hashlib
+import heapq
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+import local_aws
+import synthetic_events
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoDir)
+from storage_gateway_file_upload_notification_processing.vault_job_rules import loadVaultJobRules, objectKeyFilters
+
+lambdaCodeDir = os.path.join(repoDir, 'lambda-code')
+contextFile = os.path.join(repoDir, 'cdk.context.json')
+
+# Names given to the simulated resources
+eventBusName = 'localEventBus'
+tableName = 'localFileUploadEventTable'
+bucketName = 'local-file-upload-bucket'
+summaryBucketName = 'local-set-summary-bucket'
+reportBucketName = 'local-reconcile-report-bucket'
+indexBucketName = 'local-expected-key-index-bucket'
+stateMachineArn = 'arn:aws:states:local:000000000000:stateMachine:reconcileStateMachine'
+
+# Suffix of the partitions holding the running aggregates and callback items of each
+# logical dataset, see file_upload_event_table.py
+setItemPartitionSuffix = '#set'
+
+# Metrics holding the latency of each hop of a traced upload event, in the order of the
+# hops, then from the upload to the file being recorded and reconciled, see
+# upload_trace.py
+hopMetricNames = ['GatewayDeliveryLatency', 'QueueWaitLatency', 'ClassifyLatency', 'PublishLatency', 'BusDeliveryLatency',
+    'WriterDeliveryLatency', 'WriteLatency', 'ReconcileLatency', 'UploadToWrittenLatency', 'UploadToReconciledLatency']
+
+# Upper bounds (milliseconds) of the buckets of the hop latency histograms, the last
+# bucket holds every longer latency
+hopHistogramBoundsMs = [10, 100, 1000, 10000, 60000, 600000]
+
+# Simulated time at which the simulation starts (epoch seconds)
+simulationStartTime = 1600000000.0
+
+# Timeouts of the file upload notification writers, see storage_gateway_event_processing.py.
+# In the index reconcile mode the state machine waits for the writers to load the index
+writerTimeoutSeconds = 30
+batchWriterTimeoutSeconds = 30
+
+# Lambda defaults for settings the stack does not override
+defaultMemorySizeMb = 128
+defaultSqsBatchSize = 10
+defaultVisibilityTimeoutSeconds = 30
+asyncInvokeRetryDelaysSeconds = (60, 120)
+
+# SQS event source mappings start with 5 concurrent pollers, each receiving one batch
+# at a time. A receive returns the messages visible when SQS serves it, a round trip
+# after it is made
+sqsPollerCount = 5
+sqsReceiveSeconds = 0.02
+
+# Maximum number of logical datasets per set progress request, see set-progress.py
+progressRequestMaxSets = 50
+
+def readContext(overrides):
+    # Read cdk.context.json and apply key=value overrides, as with "cdk -c"
+    with open(contextFile) as contextJson:
+        context = json.load(contextJson)
+    for override in overrides:
+        key, _, value = override.partition('=')
+        context[key] = value
+    return context
+
+def percentile(values, fraction):
+    # Nearest rank percentile of a list of values
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+@contextlib.contextmanager
+def patchedEnvironment(environment):
+    # Set the function environment variables for the duration of a load or invocation
+    saved = {key: os.environ.get(key) for key in environment}
+    os.environ.update(environment)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+class LocalFunction:
+    # A function from lambda-code, loaded in isolation so that (as in separate Lambda
+    # functions) the shared modules and any state they keep between invocations are
+    # not shared with other functions. Module level AWS clients are replaced by the
+    # local stand-ins and the time module by the simulated clock. A function can be given
+    # several execution environments, each loaded separately so that state such as the
+    # recent upload events of upload_dedup.py is not shared between them, which are
+    # invoked in turn. S3 is seen with the s3:ListBucket grants the function has in the
+    # stack, on none of the buckets unless given
+
+    def __init__(self, simulation, functionName, handlerFile, environment, executionEnvironments=1, memorySizeMb=defaultMemorySizeMb, listBuckets=()):
+        self.simulation = simulation
+        self.functionName = functionName
+        self.memorySizeMb = memorySizeMb
+        self.s3Client = simulation.s3Client.withListBucket(listBuckets)
+        self.tmpDir = tempfile.mkdtemp(prefix=functionName + '-')
+        self.environment = dict(environment, **{
+            'AWS_DEFAULT_REGION': 'eu-west-1',
+            'AWS_LAMBDA_FUNCTION_NAME': functionName,
+            'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': str(memorySizeMb),
+            'metricsNamespace': simulation.context.get('metricsNamespace', 'StorageGatewayFileUploadNotifications')
+        })
+        self.handlers = [self.load(handlerFile)[0].lambda_handler for _ in range(max(1, executionEnvironments))]
+        self.invocations = 0
+
+    def load(self, handlerFile):
+        sharedModules = [fileName[:-3] for fileName in os.listdir(lambdaCodeDir) if fileName.endswith('.py') and '-' not in fileName]
+        for name in sharedModules:
+            sys.modules.pop(name, None)
+        if lambdaCodeDir not in sys.path:
+            sys.path.insert(0, lambdaCodeDir)
+        with patchedEnvironment(self.environment):
+            spec = importlib.util.spec_from_file_location(handlerFile.replace('-', '_'), os.path.join(lambdaCodeDir, handlerFile + '.py'))
+            handlerModule = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(handlerModule)
+        modules = [handlerModule] + [sys.modules.pop(name) for name in sharedModules if name in sys.modules]
+
+        clients = dict(self.simulation.clients, s3Client=self.s3Client)
+        serviceClients = dict(self.simulation.serviceClients, s3=self.s3Client)
+        for module in modules:
+            for attributeName, client in clients.items():
+                # Clients created on first use are left in place, so calls are measured
+                if hasattr(module, attributeName) and type(getattr(module, attributeName)).__name__ != 'LazyClient':
+                    setattr(module, attributeName, client)
+            # Shared clients created on first use (see aws_clients.py)
+            if isinstance(getattr(module, 'clients', None), dict) and hasattr(module, 'getClient'):
+                module.clients.update(serviceClients)
+            if getattr(module, 'time', None) is time:
+                module.time = self.simulation.clock
+            # Each function has its own /tmp
+            if hasattr(module, 'diskCacheDir'):
+                module.diskCacheDir = os.path.join(self.tmpDir, os.path.basename(module.diskCacheDir))
+        return modules
+
+    def invoke(self, event):
+        # Invoke the handler, timing it and capturing what it logs. Exceptions are
+        # recorded and raised to the caller, which applies the retry behaviour of the
+        # invoking service
+        stats = self.simulation.stageStats[self.functionName]
+        context = types.SimpleNamespace(
+            function_name=self.functionName,
+            memory_limit_in_mb=self.memorySizeMb,
+            aws_request_id=str(uuid.uuid4()),
+            get_remaining_time_in_millis=lambda: 900000
+        )
+        output = io.StringIO()
+        handler = self.handlers[self.invocations % len(self.handlers)]
+        self.invocations += 1
+        self.simulation.lastActivityTime = self.simulation.clock.time()
+        started = time.perf_counter()
+        try:
+            with patchedEnvironment(self.environment), contextlib.redirect_stdout(output):
+                return handler(event, context)
+        except Exception:
+            stats['errors'] += 1
+            raise
+        finally:
+            stats['durations'].append(time.perf_counter() - started)
+            stats['records'] += len(event.get('Records', [])) or 1
+            stats['logBytes'] += len(output.getvalue().encode('utf-8'))
+            recordMetrics(stats['metrics'], stats['hopLatencies'], output.getvalue())
+
+def recordMetrics(totals, hopLatencies, logOutput):
+    # Add up the metrics a function logged in the Embedded Metric Format (see
+    # embedded_metrics.py), as CloudWatch would extract them. Latencies and percentages
+    # are left out, their totals mean nothing, but the latencies of the hops of traced
+    # upload events are kept
+    for line in logOutput.splitlines():
+        if not line.startswith('{') or '"_aws"' not in line:
+            continue
+        document = json.loads(line)
+        for directive in document['_aws']['CloudWatchMetrics']:
+            for metric in directive['Metrics']:
+                value = document[metric['Name']]
+                if metric['Name'] in hopMetricNames:
+                    hopLatencies[metric['Name']].extend(value if isinstance(value, list) else [value])
+                if metric['Unit'] in ('Milliseconds', 'Percent'):
+                    continue
+                totals[metric['Name']] += sum(value) if isinstance(value, list) else value
+
+class QueuePoller:
+    # Stand-in for a Lambda SQS event source mapping. Each of its pollers receives a
+    # batch once a full batch is available, or when the batching window ends, and is
+    # busy until the function has processed it - for as long as the invocation took.
+    # Messages arriving meanwhile wait for a free poller, so batches fill up as the
+    # function falls behind. Messages reported as batch item failures are made visible
+    # again after the visibility timeout
+
+    def __init__(self, simulation, queue, function, batchSize, windowSeconds, pollerCount=sqsPollerCount):
+        self.simulation = simulation
+        self.queue = queue
+        self.function = function
+        self.batchSize = batchSize
+        self.windowSeconds = windowSeconds
+        self.pollerFreeTimes = [0.0] * pollerCount
+        self.pollTime = None
+
+    def notify(self):
+        now = self.simulation.clock.time()
+        pollTime = now if len(self.queue.visible) >= self.batchSize else now + self.windowSeconds
+        pollTime = max(pollTime, min(self.pollerFreeTimes)) + sqsReceiveSeconds
+        if self.pollTime is None or pollTime < self.pollTime:
+            self.pollTime = pollTime
+            self.simulation.schedule(pollTime, self.poll)
+
+    def poll(self):
+        now = self.simulation.clock.time()
+        if self.pollTime is None or now < self.pollTime:
+            return
+        self.pollTime = None
+        poller = self.pollerFreeTimes.index(min(self.pollerFreeTimes))
+        if self.pollerFreeTimes[poller] > now:
+            # Every poller is still busy with an earlier batch
+            self.notify()
+            return
+        batch = self.queue.receive(self.batchSize)
+        if not batch:
+            return
+        started = time.perf_counter()
+        try:
+            response = self.function.invoke({'Records': [local_aws.sqsRecord(message, self.queue.name) for message in batch]})
+            failedIds = set(failure['itemIdentifier'] for failure in (response or {}).get('batchItemFailures', []))
+        except Exception as error:
+            self.simulation.errors.append(self.function.functionName + ': ' + repr(error))
+            failedIds = set(message['messageId'] for message in batch)
+        self.pollerFreeTimes[poller] = now + time.perf_counter() - started
+        for message in batch:
+            if message['messageId'] in failedIds:
+                self.simulation.schedule(self.simulation.clock.time() + self.queue.visibilityTimeoutSeconds, lambda message=message: self.redeliver(message))
+        if self.queue.visible:
+            self.notify()
+
+    def redeliver(self, message):
+        if self.queue.release(message):
+            self.notify()
+
+class ReconcileExecution:
+    # An execution of the "reconcile file uploads" state machine, following the states
+    # defined in storage_gateway_event_processing.py
+
+    def __init__(self, simulation, executionInput, name):
+        self.simulation = simulation
+        self.state = copy.deepcopy(executionInput)
+        self.name = name or str(uuid.uuid4())
+        self.startTime = simulation.clock.time()
+        self.setId = executionInput['detail']['set-id']
+        self.checks = 0
+        self.status = 'Running'
+        self.taskToken = None
+
+    def start(self):
+        reconcileMode = self.simulation.context.get('reconcileMode')
+        if reconcileMode == 'index':
+            self.buildKeyIndex()
+        elif reconcileMode == 'callback':
+            self.waitForUploads()
+        else:
+            self.configureSchedule()
+
+    def buildKeyIndex(self):
+        # Build the expected key index, then wait for the writers to load it
+        if self.invoke('reconcileBuildIndexLambda', self.state) is None:
+            return
+        context = self.simulation.context
+        writerTimeout = batchWriterTimeoutSeconds if context.get('fileUploadIngestMode') == 'buffered' else writerTimeoutSeconds
+        self.simulation.schedule(self.simulation.clock.time() + int(context.get('expectedKeyIndexCacheSeconds', '10')) + writerTimeout, self.waitForUploads)
+
+    def invoke(self, functionName, payload):
+        try:
+            return self.simulation.functions[functionName].invoke(copy.deepcopy(payload))
+        except Exception as error:
+            self.simulation.errors.append(functionName + ': ' + repr(error))
+            self.status = 'Failed'
+            return None
+
+    def waitForUploads(self):
+        # Wait for a task token, with a timeout of the reconciliation time budget
+        self.taskToken = str(uuid.uuid4())
+        self.simulation.sfnClient.registerTaskToken(self.taskToken, self.resume)
+        self.simulation.schedule(self.startTime + int(self.simulation.context['reconcileTimeoutSeconds']), self.waitForUploadsTimeout)
+        self.invoke('reconcileRegisterCallbackLambda', {'taskToken': self.taskToken, 'detail': self.state['detail']})
+
+    def resume(self, output):
+        def resumed():
+            self.state['callback'] = output
+            self.configureSchedule()
+        self.simulation.schedule(self.simulation.clock.time(), resumed)
+
+    def waitForUploadsTimeout(self):
+        if self.status == 'Running' and self.simulation.sfnClient.expireTaskToken(self.taskToken):
+            self.state['callback'] = {'Error': 'States.Timeout', 'Cause': None}
+            self.configureSchedule()
+
+    def configureSchedule(self):
+        if self.status != 'Running':
+            return
+        payload = self.state.setdefault('reconcilecheck', {}).setdefault('Payload', {})
+        payload['schedule'] = {'startTime': local_aws.isoTime(self.startTime)}
+        self.reconcileCheck()
+
+    def reconcileCheck(self):
+        self.checks += 1
+        result = self.invoke('reconcileCheckLambda', self.state)
+        if result is None:
+            return
+        self.state['reconcilecheck'] = {'Payload': result, 'StatusCode': 200}
+        if result['reconcileDone'] is True or result['schedule']['timedOut'] is True:
+            self.notify()
+        else:
+            self.simulation.schedule(self.simulation.clock.time() + result['schedule']['waitSeconds'], self.reconcileCheck)
+
+    def notify(self):
+        reconcileDone = self.state['reconcilecheck']['Payload']['reconcileDone']
+        if self.invoke('reconcileNotifyLambda', self.state) is not None:
+            self.status = 'Successful' if reconcileDone is True else 'Timeout'
+        self.endTime = self.simulation.clock.time()
+
+class PipelineSimulation:
+    # The simulated deployment - resources, rules, functions and a queue of timed
+    # actions processed in order of simulated time
+
+    def __init__(self, context, apiLatencySeconds=0.0, failureRate=0.0, seed=0, progressPollSeconds=0, progressPollers=1, executionEnvironments=1, lostResponseRate=0.0):
+        self.context = context
+        self.executionEnvironments = executionEnvironments
+        self.progressPollSeconds = progressPollSeconds
+        self.progressPollers = progressPollers
+        self.progressRequests = 0
+        self.pendingPolls = 0
+        self.lastProgress = {}
+        self.clock = local_aws.VirtualClock(simulationStartTime)
+        self.lastActivityTime = simulationStartTime
+        self.actions = []
+        self.actionSequence = 0
+        self.actionLock = threading.Lock()
+        self.errors = []
+        self.logGroups = collections.defaultdict(list)
+        self.executions = []
+        self.uploadEvents = 0
+        self.lastUploadTimes = {}
+        self.stageStats = collections.defaultdict(lambda: {'durations': [], 'records': 0, 'errors': 0, 'logBytes': 0, 'metrics': collections.Counter(),
+            'hopLatencies': collections.defaultdict(list)})
+
+        self.apiStats = local_aws.ApiStats(apiLatencySeconds)
+        self.dynamoDbClient = local_aws.LocalDynamoDbClient(self.apiStats, failureRate, seed, lostResponseRate)
+        self.s3Client = local_aws.LocalS3Client(self.apiStats)
+        self.eventBusClient = local_aws.LocalEventsClient(self.apiStats, self.deliver, self.clock, failureRate, seed)
+        self.sfnClient = local_aws.LocalSfnClient(self.apiStats, self.startExecution)
+        self.clients = {
+            'dynamoDbClient': self.dynamoDbClient,
+            's3Client': self.s3Client,
+            'eventBusClient': self.eventBusClient,
+            'sfnClient': self.sfnClient
+        }
+        self.serviceClients = {
+            'dynamodb': self.dynamoDbClient,
+            's3': self.s3Client,
+            'events': self.eventBusClient,
+            'stepfunctions': self.sfnClient
+        }
+        self.rules = []
+        self.buildStack()
+
+    def schedule(self, at, action):
+        with self.actionLock:
+            self.actionSequence += 1
+            heapq.heappush(self.actions, (at, self.actionSequence, action))
+
+    def run(self):
+        while self.actions:
+            with self.actionLock:
+                at, sequence, action = heapq.heappop(self.actions)
+            self.clock.now = max(self.clock.now, at)
+            action()
+
+    def addRule(self, busName, pattern, targets):
+        self.rules.append((busName, pattern, targets))
+
+    def deliver(self, busName, event):
+        # Route an event put to a bus to the targets of every matching rule
+        for ruleBusName, pattern, targets in self.rules:
+            if ruleBusName == busName and local_aws.patternMatches(pattern, event):
+                for target in targets:
+                    target(event)
+
+    def queueTarget(self, queue, poller):
+        def target(event):
+            queue.send(json.dumps(event), self.clock.time())
+            poller.notify()
+        return target
+
+    def functionTarget(self, functionName):
+        # Asynchronous invocation, retried twice on error
+        def invokeAsync(event, attempt=0):
+            try:
+                self.functions[functionName].invoke(copy.deepcopy(event))
+            except Exception as error:
+                self.errors.append(functionName + ': ' + repr(error))
+                if attempt < len(asyncInvokeRetryDelaysSeconds):
+                    self.schedule(self.clock.time() + asyncInvokeRetryDelaysSeconds[attempt], lambda: invokeAsync(event, attempt + 1))
+        return lambda event: self.schedule(self.clock.time(), lambda: invokeAsync(event))
+
+    def logGroupTarget(self, logGroupName):
+        def target(event):
+            self.logGroups[logGroupName].append((self.clock.time(), event))
+        return target
+
+    def startExecution(self, arn, executionInput, name):
+        execution = ReconcileExecution(self, executionInput, name)
+        self.executions.append(execution)
+        self.schedule(self.clock.time(), execution.start)
+        return arn.replace(':stateMachine:', ':execution:') + ':' + execution.name
+
+    def buildStack(self):
+        # Functions, queues and rules as defined in storage_gateway_event_processing.py
+        context = self.context
+        vaultJobRules = loadVaultJobRules(types.SimpleNamespace(try_get_context=context.get))
+        tableEnvironment = {
+            'dynamoDbTableName': tableName,
+            'fileUploadTableShardCount': context.get('fileUploadTableShardCount', '8'),
+            'fileUploadTableItemFormat': context.get('fileUploadTableItemFormat', 'compact')
+        }
+        reconcileEnvironment = dict(tableEnvironment, **{
+            'reconcileRangeCount': context.get('reconcileRangeCount', '1'),
+            'reconcileTimeoutSeconds': context['reconcileTimeoutSeconds'],
+            'reconcileWaitMinSeconds': context['reconcileWaitMinSeconds'],
+            'reconcileWaitMaxSeconds': context['reconcileWaitMaxSeconds'],
+            'reconcileReportBucketName': reportBucketName
+        })
+        reconcileMemorySizeMb = int(context.get('reconcileFunctionMemoryMb') or '1024')
+        self.functions = {
+            'checkFileUploadTypeLambda': LocalFunction(self, 'checkFileUploadTypeLambda', 'check-file-notification-type', {
+                'eventBusName': eventBusName,
+                'vaultJobRules': json.dumps(vaultJobRules),
+                'uploadTracing': context.get('uploadTracing', 'enabled')
+            }, self.executionEnvironments),
+            'reconcileCheckLambda': LocalFunction(self, 'reconcileCheckLambda', 'reconcile-check', reconcileEnvironment, memorySizeMb=reconcileMemorySizeMb),
+            'reconcileNotifyLambda': LocalFunction(self, 'reconcileNotifyLambda', 'reconcile-notify', dict(tableEnvironment, eventBusName=eventBusName)),
+            'reconcileStartLambda': LocalFunction(self, 'reconcileStartLambda', 'reconcile-start', {'stateMachineArn': stateMachineArn})
+        }
+        indexEnvironment = {}
+        if context.get('reconcileMode') == 'index':
+            indexEnvironment = {
+                'expectedKeyIndexBucketName': indexBucketName,
+                'expectedKeyIndexCacheSeconds': context.get('expectedKeyIndexCacheSeconds', '10')
+            }
+            self.functions['reconcileBuildIndexLambda'] = LocalFunction(self, 'reconcileBuildIndexLambda', 'reconcile-build-index', dict({
+                'dynamoDbTableName': tableName
+            }, **indexEnvironment), memorySizeMb=reconcileMemorySizeMb)
+        if context.get('reconcileMode') in ('callback', 'index'):
+            self.functions['reconcileRegisterCallbackLambda'] = LocalFunction(self, 'reconcileRegisterCallbackLambda', 'reconcile-register-callback', dict(tableEnvironment, **indexEnvironment),
+                memorySizeMb=reconcileMemorySizeMb)
+
+        # Messages received the configured number of times are moved to the dead letter list
+        # of their queue, as to the dead-letter queues of the stack
+        maxReceiveCount = int(context.get('deadLetterMaxReceiveCount', '5'))
+        self.fileUploadEventSqsQueue = local_aws.LocalSqsQueue('fileUploadEventSqsQueue', defaultVisibilityTimeoutSeconds, maxReceiveCount)
+        fileUploadEventPoller = QueuePoller(self, self.fileUploadEventSqsQueue, self.functions['checkFileUploadTypeLambda'], defaultSqsBatchSize, 0)
+        self.addRule('default', {
+            'source': ['aws.storagegateway'],
+            'detail-type': ['Storage Gateway Object Upload Event'],
+            'detail': {'object-key': objectKeyFilters(vaultJobRules)}
+        }, [
+            self.queueTarget(self.fileUploadEventSqsQueue, fileUploadEventPoller)
+        ])
+
+        writerEnvironment = dict(tableEnvironment, **indexEnvironment)
+        if context.get('reconcileMode') in ('callback', 'index'):
+            writerEnvironment['reconcileCallbacks'] = 'enabled'
+        self.fileUploadEventBufferSqsQueue = None
+        if context.get('fileUploadIngestMode') == 'buffered':
+            self.functions['fileUploadEventBatchWriterLambda'] = LocalFunction(self, 'fileUploadEventBatchWriterLambda', 'file-upload-event-batch-writer', writerEnvironment,
+                self.executionEnvironments)
+            self.fileUploadEventBufferSqsQueue = local_aws.LocalSqsQueue('fileUploadEventBufferSqsQueue', 180, maxReceiveCount)
+            bufferPoller = QueuePoller(self, self.fileUploadEventBufferSqsQueue, self.functions['fileUploadEventBatchWriterLambda'],
+                int(context['fileUploadBufferBatchSize']), int(context['fileUploadBufferWindowSeconds']))
+            fileUploadEventWriterTarget = self.queueTarget(self.fileUploadEventBufferSqsQueue, bufferPoller)
+        else:
+            self.functions['fileUploadEventWriterLambda'] = LocalFunction(self, 'fileUploadEventWriterLambda', 'file-upload-event-writer', writerEnvironment,
+                self.executionEnvironments)
+            fileUploadEventWriterTarget = self.functionTarget('fileUploadEventWriterLambda')
+
+        self.addRule(eventBusName, {'source': ['vault.application'], 'detail-type': ['Data File Upload Event']}, [
+            fileUploadEventWriterTarget,
+            self.logGroupTarget('dataFileUploadEventLogGroup')
+        ])
+        self.addRule(eventBusName, {'source': ['vault.application'], 'detail-type': ['Manifest File Upload Event']}, [
+            fileUploadEventWriterTarget,
+            self.logGroupTarget('manifestFileUploadEventLogGroup'),
+            self.functionTarget('reconcileStartLambda')
+        ])
+        reconcileSuccessfulTargets = [self.logGroupTarget('reconcileNotifySuccessfulLogGroup')]
+        if context.get('reconciledSetCompaction', 'enabled') == 'enabled':
+            self.functions['setCompactionLambda'] = LocalFunction(self, 'setCompactionLambda', 'set-compaction', dict(tableEnvironment, **{
+                'setSummaryBucketName': summaryBucketName
+            }), listBuckets=[summaryBucketName])
+            reconcileSuccessfulTargets.append(self.functionTarget('setCompactionLambda'))
+        self.functions['setProgressLambda'] = LocalFunction(self, 'setProgressLambda', 'set-progress', dict(tableEnvironment, **{
+            'setProgressCacheSeconds': context.get('setProgressCacheSeconds', '5')
+        }, **({'setSummaryBucketName': summaryBucketName} if 'setCompactionLambda' in self.functions else {})), listBuckets=[summaryBucketName])
+        self.addRule(eventBusName, {'source': ['vault.application'], 'detail-type': ['File Upload Reconciliation Successful']}, reconcileSuccessfulTargets)
+        self.addRule(eventBusName, {'source': ['vault.application'], 'detail-type': ['File Upload Reconciliation Timeout']}, [
+            self.logGroupTarget('reconcileNotifyTimeoutLogGroup')
+        ])
+
+    def feed(self, workload):
+        # Deliver the events of a workload (see synthetic_events.py) at their delivery
+        # times. Events are taken from the stream one at a time so a workload of any size
+        # uses constant memory
+        workload = iter(workload)
+        def deliverNext():
+            workloadEvent = next(workload, None)
+            if workloadEvent is not None:
+                self.schedule(workloadEvent.deliveryTime, lambda: self.uploadObject(workloadEvent, deliverNext))
+        deliverNext()
+
+    def startProgressPolling(self):
+        # Dashboards requesting the progress of every set uploaded so far, each at the
+        # poll interval (started a second apart), while anything else is still to happen
+        if self.progressPollSeconds > 0:
+            for poller in range(self.progressPollers):
+                self.pendingPolls += 1
+                self.schedule(simulationStartTime + self.progressPollSeconds + poller, self.pollProgress)
+
+    def pollProgress(self):
+        self.pendingPolls -= 1
+        if len(self.actions) <= self.pendingPolls:
+            return
+        self.requestProgress()
+        self.pendingPolls += 1
+        self.schedule(self.clock.time() + self.progressPollSeconds, self.pollProgress)
+
+    def requestProgress(self):
+        # Request the progress of every set uploaded so far, keeping the last seen
+        setIds = sorted(self.lastUploadTimes)
+        for start in range(0, len(setIds), progressRequestMaxSets):
+            self.progressRequests += 1
+            try:
+                response = self.functions['setProgressLambda'].invoke({
+                    'queryStringParameters': {'setId': ','.join(setIds[start:start + progressRequestMaxSets])}
+                })
+            except Exception as error:
+                self.errors.append('setProgressLambda: ' + repr(error))
+                continue
+            for progress in json.loads(response['body'])['sets']:
+                self.lastProgress[progress['setId']] = progress
+
+    def uploadObject(self, workloadEvent, deliverNext):
+        # An object written through the file gateway - stored in the bucket (only
+        # manifest contents are kept) and notified on the default event bus
+        if workloadEvent.manifestSet is not None:
+            body = synthetic_events.manifestBody(workloadEvent.manifestSet)
+            self.s3Client.objects[(bucketName, workloadEvent.event['detail']['object-key'])] = (body, '"' + hashlib.md5(body).hexdigest() + '"', {})
+        self.uploadEvents += 1
+        if workloadEvent.setId is not None:
+            self.lastUploadTimes[workloadEvent.setId] = self.clock.time()
+        self.deliver('default', workloadEvent.event)
+        deliverNext()
+
+    def cleanup(self):
+        for function in self.functions.values():
+            shutil.rmtree(function.tmpDir, ignore_errors=True)
+
+def buildReport(simulation, fileCount, wallSeconds):
+    # Summarise throughput, stage latencies, API calls and reconcile outcomes
+    stages = {}
+    for functionName, stats in sorted(simulation.stageStats.items()):
+        durations = stats['durations']
+        stages[functionName] = {
+            'invocations': len(durations),
+            'records': stats['records'],
+            'averageBatchSize': round(stats['records'] / len(durations), 2) if durations else 0.0,
+            'errors': stats['errors'],
+            'p50Ms': round(percentile(durations, 0.50) * 1000, 3),
+            'p90Ms': round(percentile(durations, 0.90) * 1000, 3),
+            'p99Ms': round(percentile(durations, 0.99) * 1000, 3),
+            'maxMs': round(max(durations) * 1000, 3) if durations else 0.0,
+            'totalSeconds': round(sum(durations), 3),
+            'logBytesPerFile': round(stats['logBytes'] / fileCount, 1),
+            'metrics': dict(sorted(stats['metrics'].items()))
+        }
+
+    # Latency histogram of each hop of the traced upload events, over every function
+    hops = {}
+    for metricName in hopMetricNames:
+        latencies = [latency for stats in simulation.stageStats.values() for latency in stats['hopLatencies'].get(metricName, [])]
+        if not latencies:
+            continue
+        buckets = [0] * (len(hopHistogramBoundsMs) + 1)
+        for latency in latencies:
+            buckets[next((index for index, bound in enumerate(hopHistogramBoundsMs) if latency < bound), len(hopHistogramBoundsMs))] += 1
+        hops[metricName] = {
+            'samples': len(latencies),
+            'p50Ms': percentile(latencies, 0.50),
+            'p90Ms': percentile(latencies, 0.90),
+            'p99Ms': percentile(latencies, 0.99),
+            'maxMs': max(latencies),
+            'histogram': buckets
+        }
+
+    partitionWriteUnits = simulation.dynamoDbClient.partitionWriteUnits
+    eventItemSizes = [size for key, size in simulation.dynamoDbClient.itemSizes[tableName].items() if not key[0].endswith(setItemPartitionSuffix)]
+    tableItems = simulation.dynamoDbClient.tables[tableName]
+    reconcileSeconds = [execution.endTime - simulation.lastUploadTimes[execution.setId] for execution in simulation.executions if execution.status == 'Successful']
+    outcomes = collections.Counter(execution.status for execution in simulation.executions)
+    progressMetrics = simulation.stageStats['setProgressLambda']['metrics']
+    return {
+        'context': {key: simulation.context[key] for key in ('fileUploadIngestMode', 'reconcileMode', 'fileUploadTableShardCount', 'fileUploadTableItemFormat', 'reconcileRangeCount', 'reconciledSetCompaction', 'uploadTracing') if key in simulation.context},
+        'files': fileCount,
+        'uploadEvents': simulation.uploadEvents,
+        'wallSeconds': round(wallSeconds, 3),
+        'eventsPerSecond': round(simulation.uploadEvents / wallSeconds, 1) if wallSeconds else 0.0,
+        'simulatedSeconds': round(simulation.lastActivityTime - simulationStartTime, 1),
+        'stages': stages,
+        'hops': hops,
+        'apiCallsPerFile': {operation: round(calls / fileCount, 4) for operation, calls in sorted(simulation.apiStats.calls.items())},
+        'dynamoDbCapacityPerFile': {
+            'readUnits': round(simulation.dynamoDbClient.consumedReadUnits / fileCount, 3),
+            'writeUnits': round(simulation.dynamoDbClient.consumedWriteUnits / fileCount, 3),
+            'hottestPartitionWriteShare': round(max(partitionWriteUnits.values(), default=0) / max(sum(partitionWriteUnits.values()), 1), 3),
+            'eventItemBytes': round(sum(eventItemSizes) / max(len(eventItemSizes), 1), 1)
+        },
+        'compaction': {
+            'summaryObjects': sum(1 for bucket, key in simulation.s3Client.objects if bucket == summaryBucketName),
+            'summaryBytesPerFile': round(sum(len(data) for (bucket, key), (data, etag, extra) in simulation.s3Client.objects.items() if bucket == summaryBucketName) / fileCount, 1),
+            'eventItemsRemaining': sum(1 for key in tableItems if not key[0].endswith(setItemPartitionSuffix)),
+            'setItemsRemaining': sum(1 for key, item in tableItems.items() if key[0].endswith(setItemPartitionSuffix) and 'compactedTime' not in item),
+            'compactedAggregates': sum(1 for key, item in tableItems.items() if key[0].endswith(setItemPartitionSuffix) and 'compactedTime' in item)
+        },
+        'reconcile': {
+            'executions': len(simulation.executions),
+            'outcomes': dict(outcomes),
+            'checksPerExecution': round(sum(execution.checks for execution in simulation.executions) / max(len(simulation.executions), 1), 2),
+            'secondsAfterLastUploadP50': round(percentile(reconcileSeconds, 0.50), 1),
+            'secondsAfterLastUploadP90': round(percentile(reconcileSeconds, 0.90), 1),
+            'secondsAfterLastUploadMax': round(max(reconcileSeconds), 1) if reconcileSeconds else 0.0,
+            'diffReports': sum(1 for bucket, key in simulation.s3Client.objects if bucket == reportBucketName),
+            'diffReportBytes': sum(len(data) for (bucket, key), (data, etag, extra) in simulation.s3Client.objects.items() if bucket == reportBucketName)
+        },
+        'progress': {
+            'requests': simulation.progressRequests,
+            'cacheHitRate': round(progressMetrics['CacheHits'] / max(progressMetrics['CacheHits'] + progressMetrics['CacheMisses'], 1), 3),
+            'finalStatuses': dict(collections.Counter(progress['status'] for progress in simulation.lastProgress.values()))
+        },
+        'deadLetters': len(simulation.fileUploadEventSqsQueue.deadLetters) + (len(simulation.fileUploadEventBufferSqsQueue.deadLetters) if simulation.fileUploadEventBufferSqsQueue else 0),
+        'errors': simulation.errors[:10],
+        'lostResponses': simulation.dynamoDbClient.lostResponses,
+        'errorCount': len(simulation.errors)
+    }
+
+def formatMs(milliseconds):
+    # Short label for a histogram bucket bound
+    if milliseconds >= 60000:
+        return str(milliseconds // 60000) + 'm'
+    if milliseconds >= 1000:
+        return str(milliseconds // 1000) + 's'
+    return str(milliseconds) + 'ms'
+
+def printReport(report):
+    print('Files: ' + str(report['files']) + '  Upload events: ' + str(report['uploadEvents']) + '  ' + json.dumps(report['context']))
+    print('Wall time: ' + str(report['wallSeconds']) + ' s  Throughput: ' + str(report['eventsPerSecond']) + ' events/s  Simulated time: ' + str(report['simulatedSeconds']) + ' s')
+    print()
+    print('%-34s %8s %8s %6s %6s %9s %9s %9s %9s %10s' % ('Stage', 'Invokes', 'Records', 'Batch', 'Errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'Log B/file'))
+    for functionName, stage in report['stages'].items():
+        print('%-34s %8d %8d %6.1f %6d %9.3f %9.3f %9.3f %9.3f %10.1f' % (functionName, stage['invocations'], stage['records'], stage['averageBatchSize'], stage['errors'],
+            stage['p50Ms'], stage['p90Ms'], stage['p99Ms'], stage['maxMs'], stage['logBytesPerFile']))
+    print()
+    print('Published metrics (totals)')
+    for functionName, stage in report['stages'].items():
+        print('  ' + functionName + ': ' + ', '.join(name + ' ' + str(round(total, 1)) for name, total in stage['metrics'].items()))
+    print()
+    if report['hops']:
+        bucketLabels = ['<' + formatMs(bound) for bound in hopHistogramBoundsMs] + ['>=' + formatMs(hopHistogramBoundsMs[-1])]
+        print(('%-26s %8s %9s %9s %9s %9s' + ' %7s' * len(bucketLabels)) % (('Hop latency', 'Samples', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms') + tuple(bucketLabels)))
+        for metricName, hop in report['hops'].items():
+            print(('%-26s %8d %9d %9d %9d %9d' + ' %7d' * len(bucketLabels)) % ((metricName[:-len('Latency')], hop['samples'],
+                hop['p50Ms'], hop['p90Ms'], hop['p99Ms'], hop['maxMs']) + tuple(hop['histogram'])))
+        print()
+    print('%-34s %10s' % ('API call', 'Per file'))
+    for operation, perFile in report['apiCallsPerFile'].items():
+        print('%-34s %10.4f' % (operation, perFile))
+    print('%-34s %10.3f' % ('DynamoDB read units', report['dynamoDbCapacityPerFile']['readUnits']))
+    print('%-34s %10.3f' % ('DynamoDB write units', report['dynamoDbCapacityPerFile']['writeUnits']))
+    print('%-34s %10.3f' % ('Hottest partition write share', report['dynamoDbCapacityPerFile']['hottestPartitionWriteShare']))
+    print('%-34s %10.1f' % ('Event item bytes (average)', report['dynamoDbCapacityPerFile']['eventItemBytes']))
+    print()
+    reconcile = report['reconcile']
+    print('Reconcile executions: ' + str(reconcile['executions']) + ' ' + json.dumps(reconcile['outcomes']) + '  Checks per execution: ' + str(reconcile['checksPerExecution']))
+    print('Seconds from last upload to success: p50 ' + str(reconcile['secondsAfterLastUploadP50']) + '  p90 ' + str(reconcile['secondsAfterLastUploadP90']) + '  max ' + str(reconcile['secondsAfterLastUploadMax']))
+    print('Reconcile diff reports: ' + str(reconcile['diffReports']) + ' (' + str(reconcile['diffReportBytes']) + ' B)')
+    progress = report['progress']
+    print('Set progress requests: ' + str(progress['requests']) + '  Cache hit rate: ' + str(progress['cacheHitRate']) + '  Final statuses: ' + json.dumps(progress['finalStatuses']))
+    compaction = report['compaction']
+    print('Set summaries: ' + str(compaction['summaryObjects']) + ' (' + str(compaction['summaryBytesPerFile']) + ' B/file)  Items left in table: ' +
+        str(compaction['eventItemsRemaining']) + ' events, ' + str(compaction['setItemsRemaining']) + ' aggregates, ' + str(compaction['compactedAggregates']) + ' compacted aggregates')
+    if report['errorCount'] or report['deadLetters'] or report['lostResponses']:
+        print('Errors: ' + str(report['errorCount']) + '  Dead letters: ' + str(report['deadLetters']) + '  Lost write responses: ' + str(report['lostResponses']))
+        for error in report['errors']:
+            print('  ' + error)
+
+def main():
+    argParser = argparse.ArgumentParser(description='Run the file upload notification processing pipeline locally and report its throughput.')
+    synthetic_events.addWorkloadArguments(argParser)
+    argParser.add_argument('--api-latency-ms', type=float, default=0, help='simulated latency added to every API call')
+    argParser.add_argument('--failure-rate', type=float, default=0, help='fraction of batch entries returned as unprocessed or failed')
+    argParser.add_argument('--lost-response-rate', type=float, default=0, help='fraction of file upload event transactions written whose response is lost')
+    argParser.add_argument('--execution-environments', type=int, default=4, help='execution environments of the ingest and writer functions, invoked in turn')
+    argParser.add_argument('--progress-poll-seconds', type=float, default=60, help='simulated seconds between set progress requests of each dashboard, 0 for none')
+    argParser.add_argument('--progress-pollers', type=int, default=3, help='number of dashboards requesting set progress')
+    argParser.add_argument('--context', '-c', action='append', default=[], metavar='KEY=VALUE', help='cdk context value override, may be repeated')
+    argParser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = argParser.parse_args()
+
+    context = readContext(args.context)
+    vaultJobRule = loadVaultJobRules(types.SimpleNamespace(try_get_context=context.get))[0]
+    config = synthetic_events.configFromArguments(args,
+        startTime=simulationStartTime,
+        bucketName=bucketName,
+        jobDirPrefix=vaultJobRule['jobDirPrefix'],
+        jobDirSuffix=vaultJobRule['jobDirSuffix'],
+        manifestSuffix=vaultJobRule['manifestSuffix'])
+    simulation = PipelineSimulation(context, args.api_latency_ms / 1000, args.failure_rate, args.seed, args.progress_poll_seconds, args.progress_pollers,
+        args.execution_environments, args.lost_response_rate)
+    try:
+        simulation.feed(synthetic_events.generateWorkload(config))
+        simulation.startProgressPolling()
+        started = time.perf_counter()
+        simulation.run()
+        wallSeconds = time.perf_counter() - started
+        simulation.requestProgress()
+    finally:
+        simulation.cleanup()
+
+    report = buildReport(simulation, config.sets * (config.filesPerSet + 1), wallSeconds)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        printReport(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#===================================================================================
+# FILE: reconcile_schedule_check.py
+#
+# USAGE: reconcile_schedule_check.py
+#        [--timeout-seconds reconciliation time budget, default from cdk.context.json]
+#        [--wait-min-seconds minimum wait, default from cdk.context.json]
+#        [--wait-max-seconds maximum wait, default from cdk.context.json]
+#        [--check-seconds duration of each reconcile check]
+#        [--json print the report as JSON]
+#
+# DESCRIPTION: Checks that a reconcile state machine execution always times out before
+# its history reaches the Step Functions limit of 25,000 events. Runs the schedule of
+# lambda-code/reconcile_schedule.py over the whole time budget for the dataset
+# progress that gives the shortest waits - files still arriving when none are left
+# to arrive, as when files not listed in the manifest file keep being uploaded - and
+# for an idle and a steadily progressing dataset. Counts the history events of each
+# execution as the state machine records them and exits with status 1 if any
+# execution could exceed the limit.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import argparse
+import json
+import os
+import sys
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repoDir, 'lambda-code'))
+import reconcile_schedule
+
+# Step Functions execution history limit
+executionHistoryMaxEvents = 25000
+
+# History events of the reconcile state machine - the execution start, the configure
+# schedule state and the execution end, then for each iteration the reconcile check
+# task (5) and the choice state (2), then the wait state (2) for every iteration but
+# the last, and the notify task (5)
+executionEvents = 2 + 2 + 1
+taskEvents = 5
+choiceEvents = 2
+waitEvents = 2
+
+startTime = '2021-06-01T00:00:00.000Z'
+
+def runExecution(progress, manifestCount, checkSeconds):
+    # Run the schedule until the execution times out. progress(iteration) gives the
+    # file count observed by each check. Returns the iterations, the history events and
+    # the shortest wait
+    now = reconcile_schedule.parseStartTime(startTime)
+    schedule = {'startTime': startTime}
+    iterations = 0
+    shortestWait = None
+    while True:
+        iterations += 1
+        now += checkSeconds
+        schedule = reconcile_schedule.nextSchedule(schedule, progress(iterations), manifestCount, now)
+        if schedule['timedOut']:
+            break
+        shortestWait = schedule['waitSeconds'] if shortestWait is None else min(shortestWait, schedule['waitSeconds'])
+        now += schedule['waitSeconds']
+    historyEvents = executionEvents + iterations * (taskEvents + choiceEvents) + (iterations - 1) * waitEvents + taskEvents
+    return iterations, historyEvents, shortestWait
+
+def main():
+    with open(os.path.join(repoDir, 'cdk.context.json')) as contextJson:
+        context = json.load(contextJson)
+    argParser = argparse.ArgumentParser(description='Check that reconcile state machine executions stay within the Step Functions history limit.')
+    argParser.add_argument('--timeout-seconds', type=int, default=int(context['reconcileTimeoutSeconds']), help='reconciliation time budget')
+    argParser.add_argument('--wait-min-seconds', type=int, default=int(context['reconcileWaitMinSeconds']), help='minimum wait between iterations')
+    argParser.add_argument('--wait-max-seconds', type=int, default=int(context['reconcileWaitMaxSeconds']), help='maximum wait between iterations')
+    argParser.add_argument('--check-seconds', type=float, default=0, help='duration of each reconcile check')
+    argParser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = argParser.parse_args()
+    reconcile_schedule.reconcileTimeoutSeconds = args.timeout_seconds
+    reconcile_schedule.reconcileWaitMinSeconds = args.wait_min_seconds
+    reconcile_schedule.reconcileWaitMaxSeconds = args.wait_max_seconds
+
+    # File counts observed by each check, for a manifest of 1000 files
+    manifestCount = 1000
+    scenarios = {
+        'arriving-none-left': lambda iteration: manifestCount + iteration,
+        'idle': lambda iteration: manifestCount // 2,
+        'steady': lambda iteration: min(iteration, manifestCount - 1)
+    }
+    report = []
+    for name, progress in scenarios.items():
+        iterations, historyEvents, shortestWait = runExecution(progress, manifestCount, args.check_seconds)
+        report.append({
+            'scenario': name,
+            'iterations': iterations,
+            'historyEvents': historyEvents,
+            'shortestWaitSeconds': shortestWait,
+            'withinLimit': historyEvents <= executionHistoryMaxEvents
+        })
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print('%-20s %10s %14s %14s' % ('Scenario', 'Iterations', 'History events', 'Shortest wait'))
+        for row in report:
+            print(('%-20s %10d %14d %14s %s' % (row['scenario'], row['iterations'], row['historyEvents'], row['shortestWaitSeconds'],
+                '' if row['withinLimit'] else 'EXCEEDS ' + str(executionHistoryMaxEvents))).rstrip())
+    if not all(row['withinLimit'] for row in report):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
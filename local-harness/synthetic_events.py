@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+#===================================================================================
+# FILE: synthetic_events.py
+#
+# USAGE: synthetic_events.py
+#        [--sets number of vault job sets]
+#        [--files-per-set number of data files in each set]
+#        [--seed random seed]
+#        [--output JSONL file to write the events to, default standard output]
+#        [--manifest-dir directory to write the manifest files to]
+#        [-h print usage syntax, including the distribution options]
+#
+# DESCRIPTION: Generates "Storage Gateway Object Upload Event" payloads, and the
+# matching "manifest" files, for any number of vault job sets without creating any
+# data. Events are produced as a stream in delivery order, so millions of files use
+# constant memory. Object sizes and arrival times follow configurable distributions,
+# and duplicate and out of order deliveries, as well as uploads outside vault job
+# directories, files listed in the manifest that are never notified, and files
+# notified with a different size than listed in the manifest, can be injected.
+# Manifests are written in the plain or extended format (listing the size of each
+# file), optionally gzip or Zstandard compressed, see lambda-code/manifest_format.py.
+# The same seed always produces the same workload. Use
+# generateWorkload() from Python (as the local pipeline simulator does) or run the
+# script to write the events as JSON lines.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import argparse
+import collections
+import gzip
+import hashlib
+import heapq
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Defaults, matching the vault scripts in example-scripts and the lower file size
+# limits used by generate-test-data.sh
+defaultJobDirSuffix = '-vaultjob'
+defaultManifestSuffix = '.manifest'
+defaultBucketName = 'file-upload-bucket'
+defaultAccountId = '000000000000'
+defaultRegion = 'eu-west-1'
+
+# Header line of manifests in the extended format and the suffixes of compressed
+# manifests, see lambda-code/manifest_format.py
+extendedManifestHeader = '#manifest-format:extended'
+compressionSuffixes = {
+    'none': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+WorkloadConfig = collections.namedtuple('WorkloadConfig', [
+    'sets',                      # number of vault job sets
+    'filesPerSet',               # number of data files in each set
+    'seed',                      # random seed, the same seed gives the same workload
+    'startTime',                 # epoch seconds of the first upload
+    'setIntervalSeconds',        # time between the start of each set
+    'uploadSeconds',             # time over which the files of a set are uploaded
+    'arrival',                   # "uniform" or "poisson" upload times within a set
+    'burstSeconds',              # if set, uploads are grouped into bursts at this interval
+    'sizeDistribution',          # "uniform", "lognormal" or "fixed" object sizes
+    'minSizeMb',                 # smallest object size (and the fixed size)
+    'maxSizeMb',                 # largest object size
+    'medianSizeMb',              # median of the lognormal size distribution
+    'sizeSigma',                 # sigma of the lognormal size distribution
+    'dirsPerSet',                # directories the files of a set are spread across
+    'manifestPosition',          # "last", "first" or "random" manifest upload time
+    'manifestDelaySeconds',      # delay between the last file and a "last" manifest
+    'duplicateRate',             # fraction of uploads delivered a second time
+    'duplicateMaxDelaySeconds',  # maximum delay of a duplicate delivery
+    'outOfOrderRate',            # fraction of uploads delivered late
+    'outOfOrderMaxDelaySeconds', # maximum delay of a late delivery
+    'nonVaultRate',              # uploads outside a vault job directory per data file
+    'lostRate',                  # fraction of data files in the manifest never notified
+    'resizedRate',               # fraction of data files notified with a different size than in the manifest
+    'manifestFormat',            # "plain" or "extended" (key name, size) manifest lines
+    'manifestCompression',       # "none", "gzip" or "zstd" compressed manifest files
+    'bucketName',
+    'jobDirPrefix',
+    'jobDirSuffix',
+    'manifestSuffix',
+])
+
+def workloadConfig(**settings):
+    # WorkloadConfig with defaults for any setting not given
+    defaults = {
+        'sets': 4,
+        'filesPerSet': 2500,
+        'seed': 1,
+        'startTime': 1600000000.0,
+        'setIntervalSeconds': 60.0,
+        'uploadSeconds': 600.0,
+        'arrival': 'uniform',
+        'burstSeconds': 0.0,
+        'sizeDistribution': 'uniform',
+        'minSizeMb': 10.0,
+        'maxSizeMb': 1000.0,
+        'medianSizeMb': 100.0,
+        'sizeSigma': 1.0,
+        'dirsPerSet': 30,
+        'manifestPosition': 'last',
+        'manifestDelaySeconds': 1.0,
+        'duplicateRate': 0.0,
+        'duplicateMaxDelaySeconds': 60.0,
+        'outOfOrderRate': 0.0,
+        'outOfOrderMaxDelaySeconds': 30.0,
+        'nonVaultRate': 0.0,
+        'lostRate': 0.0,
+        'resizedRate': 0.0,
+        'manifestFormat': 'plain',
+        'manifestCompression': 'none',
+        'bucketName': defaultBucketName,
+        'jobDirPrefix': '',
+        'jobDirSuffix': defaultJobDirSuffix,
+        'manifestSuffix': defaultManifestSuffix,
+    }
+    defaults.update(settings)
+    return WorkloadConfig(**defaults)
+
+# A single delivery of an upload event. deliveryTime is when the event reaches the
+# default event bus, which for late and duplicate deliveries is after the event time.
+# For the manifest upload, manifestSet is the SetSpec to build the manifest from. For
+# uploads outside a vault job directory setId is None
+WorkloadEvent = collections.namedtuple('WorkloadEvent', ['deliveryTime', 'setId', 'event', 'manifestSet'])
+
+# The deterministic layout of a set - its id, job directory, number of files and the
+# workload config it belongs to
+SetSpec = collections.namedtuple('SetSpec', ['setId', 'jobDir', 'filesPerSet', 'dirsPerSet', 'manifestKey', 'config'])
+
+def setSpec(config, setNumber):
+    setId = str(1000 + setNumber)
+    jobDir = config.jobDirPrefix + setId + config.jobDirSuffix
+    manifestKey = jobDir + '/' + setId + config.manifestSuffix + compressionSuffixes[config.manifestCompression]
+    return SetSpec(setId, jobDir, config.filesPerSet, config.dirsPerSet, manifestKey, config)
+
+def fileKey(spec, fileNumber):
+    # Object key of a data file. Key names only depend on the file number so that the
+    # manifest can be produced at any time without holding the keys in memory
+    return spec.jobDir + '/dir' + str(fileNumber % spec.dirsPerSet).zfill(3) + '/file' + str(fileNumber).zfill(8) + '.dat'
+
+def fileSize(spec, fileNumber):
+    # Object size of a data file, drawn from the configured distribution with a random
+    # value that only depends on the file number, so the sizes listed in the manifest
+    # can be produced at any time
+    digest = hashlib.blake2b((str(spec.config.seed) + '/' + spec.setId + '/' + str(fileNumber)).encode('utf-8'), digest_size=8).digest()
+    return objectSize(spec.config, (int.from_bytes(digest, 'big') + 0.5) / 2**64)
+
+def manifestLines(spec):
+    # Lines of the manifest file for a set - every file, including the manifest itself.
+    # In the extended format each line also lists the size of the file, left empty for
+    # the manifest file
+    if spec.config.manifestFormat == 'plain':
+        for fileNumber in range(spec.filesPerSet):
+            yield fileKey(spec, fileNumber) + '\n'
+        yield spec.manifestKey + '\n'
+        return
+    yield extendedManifestHeader + '\n'
+    for fileNumber in range(spec.filesPerSet):
+        yield fileKey(spec, fileNumber) + '\t' + str(fileSize(spec, fileNumber)) + '\n'
+    yield spec.manifestKey + '\t\n'
+
+def manifestBody(spec):
+    # Contents of the manifest file for a set, compressed as configured
+    body = ''.join(manifestLines(spec)).encode('utf-8')
+    if spec.config.manifestCompression == 'gzip':
+        return gzip.compress(body, mtime=0)
+    if spec.config.manifestCompression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Zstandard compressed manifests need the zstandard module')
+        return zstandard.ZstdCompressor().compress(body)
+    return body
+
+def isoTime(epochSeconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(epochSeconds)) + '.%03dZ' % int((epochSeconds % 1) * 1000)
+
+def objectSize(config, uniform):
+    # Object size in bytes drawn from the configured distribution, given a random value
+    # between 0 and 1
+    if config.sizeDistribution == 'fixed':
+        sizeMb = config.minSizeMb
+    elif config.sizeDistribution == 'lognormal':
+        sizeMb = min(max(math.exp(math.log(config.medianSizeMb) + config.sizeSigma * statistics.NormalDist().inv_cdf(uniform)), config.minSizeMb), config.maxSizeMb)
+    elif config.sizeDistribution == 'uniform':
+        sizeMb = config.minSizeMb + uniform * (config.maxSizeMb - config.minSizeMb)
+    else:
+        raise ValueError('Unknown size distribution ' + config.sizeDistribution)
+    return int(sizeMb * 1024 * 1024)
+
+def uploadTimes(config, rng, setStart):
+    # Upload times of the files of a set in ascending order, generated one at a time.
+    # "uniform" spreads the files over the upload window (the next of k remaining
+    # sorted uniform values is drawn directly), "poisson" uploads them at a constant
+    # average rate with exponential gaps
+    now = setStart
+    end = setStart + config.uploadSeconds
+    for remaining in range(config.filesPerSet, 0, -1):
+        if config.arrival == 'uniform':
+            now += (end - now) * (1 - rng.random() ** (1.0 / remaining))
+        elif config.arrival == 'poisson':
+            now += rng.expovariate(config.filesPerSet / config.uploadSeconds) if config.uploadSeconds > 0 else 0
+        else:
+            raise ValueError('Unknown arrival distribution ' + config.arrival)
+        if config.burstSeconds:
+            yield math.ceil((now - setStart) / config.burstSeconds) * config.burstSeconds + setStart
+        else:
+            yield now
+
+def uploadEvent(config, rng, eventTime, objectKey, size):
+    # "Storage Gateway Object Upload Event" as delivered to the default event bus. The
+    # event time has second precision, as in events generated by AWS services
+    timestamp = isoTime(eventTime)
+    return {
+        'version': '0',
+        'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+        'detail-type': 'Storage Gateway Object Upload Event',
+        'source': 'aws.storagegateway',
+        'account': defaultAccountId,
+        'time': timestamp[:19] + 'Z',
+        'region': defaultRegion,
+        'resources': [
+            'arn:aws:storagegateway:' + defaultRegion + ':' + defaultAccountId + ':share/share-00000000',
+            'arn:aws:storagegateway:' + defaultRegion + ':' + defaultAccountId + ':gateway/sgw-00000000'
+        ],
+        'detail': {
+            'bucket-name': config.bucketName,
+            'object-key': objectKey,
+            'object-size': size,
+            'modification-time': timestamp,
+            'prefix': objectKey.rsplit('/', 1)[0] + '/',
+            'event-type': 'object-upload-complete'
+        }
+    }
+
+def generateSet(config, setNumber):
+    # Deliveries for a single set in delivery order. Late and duplicate deliveries are
+    # held in a heap until no earlier delivery can follow them, which only needs as
+    # much memory as the deliveries within the maximum delay
+    rng = random.Random(str(config.seed) + '/' + str(setNumber))
+    spec = setSpec(config, setNumber)
+    setStart = config.startTime + setNumber * config.setIntervalSeconds
+    pending = []
+    sequence = 0
+
+    manifestTime = None
+    if config.manifestPosition == 'first':
+        manifestTime = setStart
+    elif config.manifestPosition == 'random':
+        manifestTime = setStart + rng.uniform(0, config.uploadSeconds)
+    elif config.manifestPosition != 'last':
+        raise ValueError('Unknown manifest position ' + config.manifestPosition)
+
+    def deliveries(eventTime, objectKey, size, isManifest):
+        # Push the delivery of an upload, and any duplicate, to the heap
+        nonlocal sequence
+        event = uploadEvent(config, rng, eventTime, objectKey, size)
+        manifestSet = spec if isManifest else None
+        deliveryTime = eventTime
+        if rng.random() < config.outOfOrderRate:
+            deliveryTime += rng.uniform(0, config.outOfOrderMaxDelaySeconds)
+        sequence += 1
+        heapq.heappush(pending, (deliveryTime, sequence, WorkloadEvent(deliveryTime, spec.setId, event, manifestSet)))
+        if rng.random() < config.duplicateRate:
+            duplicateTime = deliveryTime + rng.uniform(0, config.duplicateMaxDelaySeconds)
+            sequence += 1
+            heapq.heappush(pending, (duplicateTime, sequence, WorkloadEvent(duplicateTime, spec.setId, event, manifestSet)))
+
+    if config.manifestCompression == 'none':
+        manifestSize = sum(len(line.encode('utf-8')) for line in manifestLines(spec))
+    else:
+        manifestSize = len(manifestBody(spec))
+    lastTime = setStart
+    for fileNumber, eventTime in enumerate(uploadTimes(config, rng, setStart)):
+        if manifestTime is not None and manifestTime <= eventTime:
+            deliveries(manifestTime, spec.manifestKey, manifestSize, True)
+            manifestTime = None
+        if not (config.lostRate and rng.random() < config.lostRate):
+            size = fileSize(spec, fileNumber)
+            if config.resizedRate and rng.random() < config.resizedRate:
+                size //= 2
+            deliveries(eventTime, fileKey(spec, fileNumber), size, False)
+        if config.nonVaultRate and rng.random() < config.nonVaultRate:
+            sequence += 1
+            otherKey = 'shared/' + spec.setId + '/other' + str(fileNumber).zfill(8) + '.dat'
+            heapq.heappush(pending, (eventTime, sequence, WorkloadEvent(eventTime, None, uploadEvent(config, rng, eventTime, otherKey, objectSize(config, rng.random())), None)))
+        lastTime = eventTime
+        while pending and pending[0][0] <= eventTime:
+            yield heapq.heappop(pending)[2]
+
+    if manifestTime is None and config.manifestPosition == 'last':
+        manifestTime = lastTime + config.manifestDelaySeconds
+    if manifestTime is not None:
+        deliveries(manifestTime, spec.manifestKey, manifestSize, True)
+    while pending:
+        yield heapq.heappop(pending)[2]
+
+def generateWorkload(config):
+    # Deliveries for every set, merged into a single stream in delivery order
+    return heapq.merge(*[generateSet(config, setNumber) for setNumber in range(config.sets)], key=lambda workloadEvent: workloadEvent.deliveryTime)
+
+def addWorkloadArguments(argParser):
+    # Command line options for every WorkloadConfig setting (shared with the simulator)
+    defaults = workloadConfig()
+    argParser.add_argument('--sets', type=int, default=defaults.sets, help='number of vault job sets')
+    argParser.add_argument('--files-per-set', type=int, default=defaults.filesPerSet, help='number of data files in each set')
+    argParser.add_argument('--seed', type=int, default=defaults.seed, help='random seed, the same seed gives the same workload')
+    argParser.add_argument('--set-interval-seconds', type=float, default=defaults.setIntervalSeconds, help='time between the start of each set')
+    argParser.add_argument('--upload-seconds', type=float, default=defaults.uploadSeconds, help='time over which the files of a set are uploaded')
+    argParser.add_argument('--arrival', choices=['uniform', 'poisson'], default=defaults.arrival, help='distribution of upload times within a set')
+    argParser.add_argument('--burst-seconds', type=float, default=defaults.burstSeconds, help='group uploads into bursts at this interval')
+    argParser.add_argument('--size-distribution', choices=['uniform', 'lognormal', 'fixed'], default=defaults.sizeDistribution, help='distribution of object sizes')
+    argParser.add_argument('--min-size-mb', type=float, default=defaults.minSizeMb, help='smallest object size, and the fixed object size')
+    argParser.add_argument('--max-size-mb', type=float, default=defaults.maxSizeMb, help='largest object size')
+    argParser.add_argument('--median-size-mb', type=float, default=defaults.medianSizeMb, help='median object size of the lognormal distribution')
+    argParser.add_argument('--size-sigma', type=float, default=defaults.sizeSigma, help='sigma of the lognormal distribution')
+    argParser.add_argument('--dirs-per-set', type=int, default=defaults.dirsPerSet, help='directories the files of a set are spread across')
+    argParser.add_argument('--manifest-position', choices=['last', 'first', 'random'], default=defaults.manifestPosition, help='when the manifest is uploaded')
+    argParser.add_argument('--duplicate-rate', type=float, default=defaults.duplicateRate, help='fraction of uploads delivered twice')
+    argParser.add_argument('--duplicate-max-delay-seconds', type=float, default=defaults.duplicateMaxDelaySeconds, help='maximum delay of a duplicate delivery')
+    argParser.add_argument('--out-of-order-rate', type=float, default=defaults.outOfOrderRate, help='fraction of uploads delivered late')
+    argParser.add_argument('--out-of-order-max-delay-seconds', type=float, default=defaults.outOfOrderMaxDelaySeconds, help='maximum delay of a late delivery')
+    argParser.add_argument('--non-vault-rate', type=float, default=defaults.nonVaultRate, help='uploads outside a vault job directory per data file')
+    argParser.add_argument('--lost-rate', type=float, default=defaults.lostRate, help='fraction of data files listed in the manifest but never notified')
+    argParser.add_argument('--resized-rate', type=float, default=defaults.resizedRate, help='fraction of data files notified with half the size listed in the manifest')
+    argParser.add_argument('--manifest-format', choices=['plain', 'extended'], default=defaults.manifestFormat, help='manifest lines of key names only, or key names and sizes')
+    argParser.add_argument('--manifest-compression', choices=sorted(compressionSuffixes), default=defaults.manifestCompression, help='compression of the manifest files')
+
+def configFromArguments(args, **settings):
+    return workloadConfig(
+        sets=args.sets,
+        filesPerSet=args.files_per_set,
+        seed=args.seed,
+        setIntervalSeconds=args.set_interval_seconds,
+        uploadSeconds=args.upload_seconds,
+        arrival=args.arrival,
+        burstSeconds=args.burst_seconds,
+        sizeDistribution=args.size_distribution,
+        minSizeMb=args.min_size_mb,
+        maxSizeMb=args.max_size_mb,
+        medianSizeMb=args.median_size_mb,
+        sizeSigma=args.size_sigma,
+        dirsPerSet=args.dirs_per_set,
+        manifestPosition=args.manifest_position,
+        duplicateRate=args.duplicate_rate,
+        duplicateMaxDelaySeconds=args.duplicate_max_delay_seconds,
+        outOfOrderRate=args.out_of_order_rate,
+        outOfOrderMaxDelaySeconds=args.out_of_order_max_delay_seconds,
+        nonVaultRate=args.non_vault_rate,
+        lostRate=args.lost_rate,
+        resizedRate=args.resized_rate,
+        manifestFormat=args.manifest_format,
+        manifestCompression=args.manifest_compression,
+        **settings
+    )
+
+def main():
+    argParser = argparse.ArgumentParser(description='Generate synthetic Storage Gateway file upload events and manifest files.')
+    addWorkloadArguments(argParser)
+    argParser.add_argument('--bucket-name', default=defaultBucketName, help='bucket name in the events')
+    argParser.add_argument('--output', help='JSONL file to write the events to, default standard output')
+    argParser.add_argument('--manifest-dir', help='directory to write the manifest files to')
+    args = argParser.parse_args()
+    config = configFromArguments(args, bucketName=args.bucket_name)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for workloadEvent in generateWorkload(config):
+            output.write(json.dumps(workloadEvent.event, separators=(',', ':')) + '\n')
+            if workloadEvent.manifestSet is not None and args.manifest_dir:
+                manifestPath = os.path.join(args.manifest_dir, workloadEvent.manifestSet.manifestKey)
+                os.makedirs(os.path.dirname(manifestPath), exist_ok=True)
+                with open(manifestPath, 'wb') as manifestFile:
+                    manifestFile.write(manifestBody(workloadEvent.manifestSet))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main()
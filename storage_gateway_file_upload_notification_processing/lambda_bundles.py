@@ -0,0 +1,46 @@
+#===================================================================================
+# FILE: lambda_bundles.py
+#
+# DESCRIPTION: Works out the minimal set of files from the lambda-code directory
+# needed by each AWS Lambda function - its handler file and the shared modules it
+# imports, directly or through other shared modules - so each function is deployed
+# with only its own code. Imports are found by parsing the handler file, so the
+# bundles stay correct as modules are added.
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import ast
+import os
+
+lambdaCodeDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambda-code")
+
+def importedModules(fileName):
+    # Names of the top level modules imported by a file in lambda-code
+    with open(os.path.join(lambdaCodeDir, fileName)) as sourceFile:
+        tree = ast.parse(sourceFile.read(), fileName)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                yield alias.name.split(".")[0]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            yield node.module.split(".")[0]
+
+def bundleFiles(handlerFile):
+    # The handler file and every lambda-code module it imports, directly or indirectly
+    files = set()
+    pending = [handlerFile]
+    while pending:
+        fileName = pending.pop()
+        if fileName in files:
+            continue
+        files.add(fileName)
+        for moduleName in importedModules(fileName):
+            if os.path.isfile(os.path.join(lambdaCodeDir, moduleName + ".py")):
+                pending.append(moduleName + ".py")
+    return sorted(files)
+
+def bundleExcludes(handlerFile):
+    # Asset exclude patterns that leave only the bundle files of a handler
+    return ["*"] + ["!" + fileName for fileName in bundleFiles(handlerFile)]
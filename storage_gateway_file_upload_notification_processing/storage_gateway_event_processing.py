@@ -8,6 +8,7 @@
 # for further information on the application architecture. 
 #===================================================================================
 
+import json
 from aws_cdk import (
     core,
     aws_s3 as s3,
@@ -21,8 +22,27 @@ from aws_cdk import (
     aws_logs as logs,
     aws_stepfunctions as sfn,
     aws_stepfunctions_tasks as tasks,
-    aws_ssm as ssm
+    aws_ssm as ssm,
+    aws_cloudwatch as cloudwatch
 )
+from storage_gateway_file_upload_notification_processing.lambda_bundles import bundleExcludes
+from storage_gateway_file_upload_notification_processing.vault_job_rules import loadVaultJobRules, objectKeyFilters
+
+def handlerCode(handlerFile):
+    # Lambda code asset holding only a handler file and the lambda-code modules it imports, 
+    # so each function deploys (and loads) only its own code
+    return _lambda.Code.from_asset("lambda-code", exclude=bundleExcludes(handlerFile))
+
+def functionMetric(namespace, function, metricName, statistic="Sum"):
+    # Amazon CloudWatch metric published by an AWS Lambda function in the Embedded Metric Format, 
+    # see lambda-code/embedded_metrics.py. Every metric has the function name as its dimension
+    return cloudwatch.Metric(
+        namespace=namespace,
+        metric_name=metricName,
+        dimensions_map={"FunctionName": function.function_name},
+        statistic=statistic,
+        period=core.Duration.minutes(1)
+    )
 
 class EventProcessing(core.Stack):
     def __init__(self, scope: core.Construct, construct_id: str, **kwargs) -> None:
@@ -34,6 +54,11 @@ class EventProcessing(core.Stack):
         accountId = core.Aws.ACCOUNT_ID
         regionName = core.Aws.REGION
 
+        # Vault job routing rules identifying the job directories and manifest files of logical 
+        # datasets. Used both for the EventBridge rule filter and by the "check file upload type" 
+        # AWS Lambda function
+        vaultJobRules = loadVaultJobRules(self.node)
+
         # Amazon DynamoDB table to store file upload notification events. NOTE: removal policy set 
         # to destroy, hence this table will be deleted with the CDK stack
         fileUploadEventTable = dynamodb.Table(
@@ -44,6 +69,47 @@ class EventProcessing(core.Stack):
             sort_key=dynamodb.Attribute(name="objectKey", type=dynamodb.AttributeType.STRING),
             removal_policy=core.RemovalPolicy.DESTROY
         )
+
+        # Number of shards (partitions) the items of each logical dataset are spread over in the 
+        # table, passed to every AWS Lambda function that reads or writes them. The aggregates of 
+        # all shards are read in a single BatchGetItem request, which allows at most 100 keys. 
+        # Every file recorded updates the running aggregates item of its shard in the same 
+        # transaction, so concurrent writers of one shard conflict - 8 shards keep conflicts rare 
+        # at the concurrency of the direct ingest mode for a few extra keys read per reconcile check
+        fileUploadTableShardCount = str(self.node.try_get_context("fileUploadTableShardCount") or "8")
+        if not fileUploadTableShardCount.isdigit() or not 1 <= int(fileUploadTableShardCount) <= 100:
+            raise ValueError("fileUploadTableShardCount must be a whole number from 1 to 100")
+
+        # Format of the file upload event items written to the table, passed to every AWS Lambda 
+        # function that writes or queries them. Items of either format are always read
+        fileUploadTableItemFormat = self.node.try_get_context("fileUploadTableItemFormat") or "compact"
+        if fileUploadTableItemFormat not in ("compact", "full"):
+            raise ValueError("fileUploadTableItemFormat must be compact or full")
+
+        # Amazon CloudWatch namespace of the metrics every AWS Lambda function publishes in the 
+        # Embedded Metric Format (see lambda-code/embedded_metrics.py), shown on the stack dashboard
+        metricsNamespace = self.node.try_get_context("metricsNamespace") or "StorageGatewayFileUploadNotifications"
+
+        # Upload tracing, enabled unless the context value is "disabled". The "check file upload 
+        # type" AWS Lambda function starts a trace for each file upload event, stamped by every 
+        # later stage, and each stage publishes the latency of its hops (see lambda-code/upload_trace.py)
+        uploadTracing = self.node.try_get_context("uploadTracing") or "enabled"
+        if uploadTracing not in ("enabled", "disabled"):
+            raise ValueError("uploadTracing must be enabled or disabled")
+
+        # Reconcile mode of the "reconcile file uploads" state machine. The index reconcile mode 
+        # is the callback reconcile mode with an expected key index of each logical dataset built 
+        # as soon as its manifest file arrives, which the file upload notification writer checks 
+        # every file against on arrival (see lambda-code/expected_key_index.py). Writers cache 
+        # the index of each dataset for the configured number of seconds
+        reconcileMode = self.node.try_get_context("reconcileMode") or "poll"
+        if reconcileMode not in ("poll", "callback", "index"):
+            raise ValueError("reconcileMode must be poll, callback or index")
+        callbackReconcileMode = reconcileMode in ("callback", "index")
+        indexReconcileMode = reconcileMode == "index"
+        expectedKeyIndexCacheSeconds = str(self.node.try_get_context("expectedKeyIndexCacheSeconds") or "10")
+        if not expectedKeyIndexCacheSeconds.isdigit() or not 1 <= int(expectedKeyIndexCacheSeconds) <= 300:
+            raise ValueError("expectedKeyIndexCacheSeconds must be a whole number from 1 to 300")
         
         # Amazon S3 bucket to store file uploads from AWS Storage Gateway. NOTE: removal policy set 
         # to destroy, hence this bucket should be emptied prior to destroying the CDK stack (buckets
@@ -88,12 +154,13 @@ class EventProcessing(core.Stack):
             self, 
             "checkFileUploadTypeLambda",
             runtime=_lambda.Runtime.PYTHON_3_8,
-            code=_lambda.Code.asset("lambda-code"),
+            code=handlerCode("check-file-notification-type.py"),
             handler='check-file-notification-type.lambda_handler',
             environment={
                 "eventBusName": customEventBus.event_bus_name,
-                "manifestSuffixName": self.node.try_get_context("manifestSuffixName"),
-                "jobDirSuffixName": self.node.try_get_context("jobDirSuffixName")
+                "vaultJobRules": json.dumps(vaultJobRules),
+                "uploadTracing": uploadTracing,
+                "metricsNamespace": metricsNamespace
             },
             role=checkFileUploadTypeLambdaIamRole
         )
@@ -107,31 +174,95 @@ class EventProcessing(core.Stack):
         )
         checkFileUploadTypeLambdaIamPolicy.add_statements(checkFileUploadTypeLambdaIamPolicyStatementWriteLogs)
 
+        # Amazon SQS dead-letter queues. Messages received the configured number of times without 
+        # being processed are moved from the Amazon SQS queues to a dead-letter queue of their own, 
+        # which also receives the events EventBridge could not deliver to the queue. Events that 
+        # could not be delivered to the other targets of the custom event bus (or, for AWS Lambda 
+        # function targets, that failed every asynchronous invocation attempt) are sent to the 
+        # event target dead-letter queue. Messages are kept for the configured number of days, 
+        # so they can be replayed with example-scripts/redrive_dead_letters.py once the cause of 
+        # the failures has been fixed
+        deadLetterMaxReceiveCount = str(self.node.try_get_context("deadLetterMaxReceiveCount") or "5")
+        if not deadLetterMaxReceiveCount.isdigit() or not 1 <= int(deadLetterMaxReceiveCount) <= 1000:
+            raise ValueError("deadLetterMaxReceiveCount must be a whole number from 1 to 1000")
+        deadLetterRetentionDays = str(self.node.try_get_context("deadLetterRetentionDays") or "14")
+        if not deadLetterRetentionDays.isdigit() or not 1 <= int(deadLetterRetentionDays) <= 14:
+            raise ValueError("deadLetterRetentionDays must be a whole number from 1 to 14")
+        fileUploadEventDeadLetterQueue = sqs.Queue(
+            self,
+            "fileUploadEventDeadLetterQueue",
+            retention_period=core.Duration.days(int(deadLetterRetentionDays))
+        )
+        eventTargetDeadLetterQueue = sqs.Queue(
+            self,
+            "eventTargetDeadLetterQueue",
+            retention_period=core.Duration.days(int(deadLetterRetentionDays))
+        )
+
         # Amazon SQS queue
         fileUploadEventSqsQueue = sqs.Queue(
             self,
-            "fileUploadEventSqsQueue"
+            "fileUploadEventSqsQueue",
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=int(deadLetterMaxReceiveCount),
+                queue=fileUploadEventDeadLetterQueue
+            )
         )
 
         # Add the Amazon SQS queue as the event source for the "check file upload type" AWS 
-        # Lambda function
-        checkFileUploadTypeLambda.add_event_source(sources.SqsEventSource(fileUploadEventSqsQueue))
+        # Lambda function. The function reports partial batch failures so that only the
+        # messages it could not process are returned to the queue
+        checkFileUploadTypeLambda.add_event_source(sources.SqsEventSource(
+            fileUploadEventSqsQueue,
+            report_batch_item_failures=True
+        ))
 
         # Amazon EventBridge rule with an associated target that routes file upload notification 
-        # events to the Amazon SQS queue
-        
+        # events to the Amazon SQS queue. Only uploads within vault job directories are matched, 
+        # so other uploads through the same gateway never reach the queue
         fileNotificationPattern = events.EventPattern(
             source=["aws.storagegateway"],
-            detail_type=["Storage Gateway Object Upload Event"]
+            detail_type=["Storage Gateway Object Upload Event"],
+            detail={
+                "object-key": objectKeyFilters(vaultJobRules)
+            }
         )
         fileNotificationRule = events.Rule(
             self,
             "fileNotificationRule",
             event_pattern=fileNotificationPattern
         )
-        fileNotificationRule.add_target(targets.SqsQueue(fileUploadEventSqsQueue))
+        fileNotificationRule.add_target(targets.SqsQueue(fileUploadEventSqsQueue, dead_letter_queue=fileUploadEventDeadLetterQueue))
 
-        # "File upload notification writer" AWS Lambda function with required IAM policy and role
+        # Amazon S3 bucket to store the expected key index of each logical dataset in the index 
+        # reconcile mode, passed to the functions that build and check it. Indexes are only needed 
+        # while the dataset is reconciled, so they expire a day after the reconciliation time 
+        # budget. NOTE: removal policy set to destroy, hence this bucket should be emptied prior 
+        # to destroying the CDK stack
+        expectedKeyIndexEnvironment = {}
+        if indexReconcileMode:
+            expectedKeyIndexBucket = s3.Bucket(
+                self,
+                "expectedKeyIndexBucket",
+                lifecycle_rules=[s3.LifecycleRule(expiration=core.Duration.days(int(self.node.try_get_context("reconcileTimeoutSeconds")) // 86400 + 2))],
+                removal_policy=core.RemovalPolicy.DESTROY
+            )
+            expectedKeyIndexEnvironment = {
+                "expectedKeyIndexBucketName": expectedKeyIndexBucket.bucket_name,
+                "expectedKeyIndexCacheSeconds": expectedKeyIndexCacheSeconds
+            }
+
+        # "File upload notification writer" AWS Lambda function with required IAM policy and role.
+        # In the buffered ingest mode, events from the custom EventBridge bus are routed to an
+        # Amazon SQS buffer queue instead and written to the DynamoDB table in batches by a
+        # "file upload notification batch writer" AWS Lambda function that uses the same role.
+        # Only in the callback and index reconcile modes do the writers check whether a waiting
+        # execution can be resumed (see lambda-code/reconcile_callback.py). Both writers have a 
+        # 30 second timeout - besides the index and callback reads, recording an event can take 
+        # 6 transaction attempts with up to 3.1 seconds of backoff between them (see 
+        # lambda-code/upload_event_recorder.py), each call also retried by the SDK when throttled
+        writerEnvironment = dict(expectedKeyIndexEnvironment, **({"reconcileCallbacks": "enabled"} if callbackReconcileMode else {}))
+        bufferedIngestMode = self.node.try_get_context("fileUploadIngestMode") == "buffered"
         fileUploadEventWriterLambdaIamRole = iam.Role(
             self,
             "fileUploadEventWriterLambdaIamRole",
@@ -142,20 +273,69 @@ class EventProcessing(core.Stack):
             "fileUploadEventWriterLambdaIamPolicy",
             roles=[fileUploadEventWriterLambdaIamRole]
         )
-        fileUploadEventWriterLambda = _lambda.Function(
-            self,
-            "fileUploadEventWriterLambda",
-            runtime=_lambda.Runtime.PYTHON_3_8,
-            code=_lambda.Code.asset("lambda-code"),
-            handler='file-upload-event-writer.lambda_handler',
-            environment={
-                "dynamoDbTableName": fileUploadEventTable.table_name
-            },
-            role=fileUploadEventWriterLambdaIamRole
-        )
+        if bufferedIngestMode:
+            fileUploadEventWriterLambda = _lambda.Function(
+                self,
+                "fileUploadEventBatchWriterLambda",
+                runtime=_lambda.Runtime.PYTHON_3_8,
+                code=handlerCode("file-upload-event-batch-writer.py"),
+                handler='file-upload-event-batch-writer.lambda_handler',
+                environment=dict({
+                    "dynamoDbTableName": fileUploadEventTable.table_name,
+                    "fileUploadTableShardCount": fileUploadTableShardCount,
+                    "fileUploadTableItemFormat": fileUploadTableItemFormat,
+                    "metricsNamespace": metricsNamespace
+                }, **writerEnvironment),
+                timeout=core.Duration.seconds(30),
+                role=fileUploadEventWriterLambdaIamRole
+            )
+            fileUploadEventBufferDeadLetterQueue = sqs.Queue(
+                self,
+                "fileUploadEventBufferDeadLetterQueue",
+                retention_period=core.Duration.days(int(deadLetterRetentionDays))
+            )
+            fileUploadEventBufferSqsQueue = sqs.Queue(
+                self,
+                "fileUploadEventBufferSqsQueue",
+                visibility_timeout=core.Duration.seconds(180),
+                dead_letter_queue=sqs.DeadLetterQueue(
+                    max_receive_count=int(deadLetterMaxReceiveCount),
+                    queue=fileUploadEventBufferDeadLetterQueue
+                )
+            )
+            fileUploadEventWriterLambda.add_event_source(sources.SqsEventSource(
+                fileUploadEventBufferSqsQueue,
+                batch_size=int(self.node.try_get_context("fileUploadBufferBatchSize")),
+                max_batching_window=core.Duration.seconds(int(self.node.try_get_context("fileUploadBufferWindowSeconds"))),
+                report_batch_item_failures=True
+            ))
+            fileUploadEventWriterTarget = targets.SqsQueue(fileUploadEventBufferSqsQueue, dead_letter_queue=fileUploadEventBufferDeadLetterQueue)
+            fileUploadEventWriterTimeoutSeconds = 30
+        else:
+            fileUploadEventWriterLambda = _lambda.Function(
+                self,
+                "fileUploadEventWriterLambda",
+                runtime=_lambda.Runtime.PYTHON_3_8,
+                code=handlerCode("file-upload-event-writer.py"),
+                handler='file-upload-event-writer.lambda_handler',
+                environment=dict({
+                    "dynamoDbTableName": fileUploadEventTable.table_name,
+                    "fileUploadTableShardCount": fileUploadTableShardCount,
+                    "fileUploadTableItemFormat": fileUploadTableItemFormat,
+                    "metricsNamespace": metricsNamespace
+                }, **writerEnvironment),
+                timeout=core.Duration.seconds(30),
+                dead_letter_queue=eventTargetDeadLetterQueue,
+                role=fileUploadEventWriterLambdaIamRole
+            )
+            fileUploadEventWriterTarget = targets.LambdaFunction(fileUploadEventWriterLambda, dead_letter_queue=eventTargetDeadLetterQueue)
+            fileUploadEventWriterTimeoutSeconds = 30
         fileUploadEventWriterLambdaIamPolicyStatementDynamoDb = iam.PolicyStatement(
             actions=[
-                "dynamodb:PutItem"
+                "dynamodb:GetItem",
+                "dynamodb:PutItem",
+                "dynamodb:UpdateItem",
+                "dynamodb:DeleteItem"
             ],
             effect=iam.Effect('ALLOW'),
             resources=[
@@ -173,6 +353,17 @@ class EventProcessing(core.Stack):
         )
         fileUploadEventWriterLambdaIamPolicy.add_statements(fileUploadEventWriterLambdaIamPolicyStatementDynamoDb)
         fileUploadEventWriterLambdaIamPolicy.add_statements(fileUploadEventWriterLambdaIamPolicyStatementLogs)
+        if indexReconcileMode:
+            fileUploadEventWriterLambdaIamPolicyStatementIndex = iam.PolicyStatement(
+                actions=[
+                    "s3:GetObject"
+                ],
+                effect=iam.Effect('ALLOW'),
+                resources=[
+                    expectedKeyIndexBucket.bucket_arn + "/*"
+                ]
+            )
+            fileUploadEventWriterLambdaIamPolicy.add_statements(fileUploadEventWriterLambdaIamPolicyStatementIndex)
 
         # Amazon CloudWatch log groups for events created by the "check file upload type" AWS 
         # Lambda function
@@ -211,46 +402,58 @@ class EventProcessing(core.Stack):
             event_bus=customEventBus,
             event_pattern=manifestFileUploadEventPattern
         )
-        dataFileUploadEventRule.add_target(targets.LambdaFunction(fileUploadEventWriterLambda))
-        dataFileUploadEventRule.add_target(targets.CloudWatchLogGroup(dataFileUploadEventLogGroup))
-        manifestFileUploadEventRule.add_target(targets.LambdaFunction(fileUploadEventWriterLambda))
-        manifestFileUploadEventRule.add_target(targets.CloudWatchLogGroup(manifestFileUploadEventLogGroup))
-    
-        # AWS Lambda function used by the Step Functions "reconcile file uploads" state machine 
-        # that provides a simple iterator. Created with required IAM policy and role
-        reconcileIteratorLambdaIamRole = iam.Role(
-            self,
-            "reconcileIteratorLambdaIamRole",
-            assumed_by=iam.ServicePrincipal('lambda.amazonaws.com')
-        )
-        reconcileIteratorLambda = _lambda.Function(
-            self,
-            "reconcileIteratorLambda",
-            runtime=_lambda.Runtime.PYTHON_3_8,
-            code=_lambda.Code.asset("lambda-code"),
-            handler='reconcile-iterator.lambda_handler',
-            role=reconcileIteratorLambdaIamRole
-        )
-        reconcileIteratorLambdaIamPolicyStatementWriteLogs = iam.PolicyStatement(
-            actions=[
-                "logs:CreateLogStream",
-                "logs:PutLogEvents"
-            ],
-            effect=iam.Effect('ALLOW'),
-            resources=[reconcileIteratorLambda.log_group.log_group_arn]           
-        )
-        reconcileIteratorLambdaIamPolicy = iam.Policy(
+        dataFileUploadEventRule.add_target(fileUploadEventWriterTarget)
+        dataFileUploadEventRule.add_target(targets.CloudWatchLogGroup(dataFileUploadEventLogGroup, dead_letter_queue=eventTargetDeadLetterQueue))
+        manifestFileUploadEventRule.add_target(fileUploadEventWriterTarget)
+        manifestFileUploadEventRule.add_target(targets.CloudWatchLogGroup(manifestFileUploadEventLogGroup, dead_letter_queue=eventTargetDeadLetterQueue))
+
+        # Memory, timeout and optional NumPy and Zstandard layers of the AWS Lambda functions that 
+        # read manifest files. Their memory use grows with the number of files in a logical dataset, 
+        # see local-harness/key_compare_benchmark.py. With NumPy the key names of large logical 
+        # datasets are compared much faster (see lambda-code/hashed_key_set.py). The zstandard 
+        # module is only needed to read Zstandard compressed manifest files (see 
+        # lambda-code/manifest_format.py). The defaults, 1024 MB and 5 minutes, compare a logical 
+        # dataset of several million files with NumPy, and give the manifest file cache (a quarter 
+        # of the memory, see lambda-code/manifest_cache.py) room for manifest files of that size
+        reconcileFunctionMemoryMb = int(self.node.try_get_context("reconcileFunctionMemoryMb") or "1024")
+        reconcileFunctionTimeout = core.Duration.seconds(int(self.node.try_get_context("reconcileFunctionTimeoutSeconds") or "300"))
+        reconcileLayers = []
+        if self.node.try_get_context("reconcileNumpyLayerArn"):
+            reconcileLayers.append(_lambda.LayerVersion.from_layer_version_arn(
+                self,
+                "reconcileNumpyLayer",
+                self.node.try_get_context("reconcileNumpyLayerArn")
+            ))
+        if self.node.try_get_context("reconcileZstdLayerArn"):
+            reconcileLayers.append(_lambda.LayerVersion.from_layer_version_arn(
+                self,
+                "reconcileZstdLayer",
+                self.node.try_get_context("reconcileZstdLayerArn")
+            ))
+
+        # Maximum number of key ranges the reconcile check function splits a large manifest 
+        # file into. Each range of each shard is read and compared in parallel
+        reconcileRangeCount = str(self.node.try_get_context("reconcileRangeCount") or "1")
+        if not reconcileRangeCount.isdigit() or not 1 <= int(reconcileRangeCount) <= 100:
+            raise ValueError("reconcileRangeCount must be a whole number from 1 to 100")
+
+        # Amazon S3 bucket to store the reports of the keys that differ between a manifest file and
+        # the file upload events recorded for its logical dataset, written by the reconcile check 
+        # function. Reports expire after the configured number of days. NOTE: removal policy set to 
+        # destroy, hence this bucket should be emptied prior to destroying the CDK stack
+        reconcileReportRetentionDays = str(self.node.try_get_context("reconcileReportRetentionDays") or "30")
+        if not reconcileReportRetentionDays.isdigit() or int(reconcileReportRetentionDays) < 1:
+            raise ValueError("reconcileReportRetentionDays must be a whole number of at least 1")
+        reconcileReportBucket = s3.Bucket(
             self,
-            "reconcileIteratorLambdaIamPolicy",
-            statements=[
-                reconcileIteratorLambdaIamPolicyStatementWriteLogs
-            ],
-            roles=[reconcileIteratorLambdaIamRole]
+            "reconcileReportBucket",
+            lifecycle_rules=[s3.LifecycleRule(expiration=core.Duration.days(int(reconcileReportRetentionDays)))],
+            removal_policy=core.RemovalPolicy.DESTROY
         )
-
+    
         # AWS Lambda function used by the Step Functions "reconcile file uploads" state machine that 
-        # reconciles data between Amazon S3 and Amazon DynamoDB. Created with required IAM policy 
-        # and role
+        # reconciles data between Amazon S3 and Amazon DynamoDB, and chooses the wait before the next 
+        # iteration based on progress. Created with required IAM policy and role
         reconcileCheckLambdaIamRole = iam.Role(
             self,
             "reconcileCheckLambdaIamRole",
@@ -265,16 +468,30 @@ class EventProcessing(core.Stack):
             self,
             "reconcileCheckLambda",
             runtime=_lambda.Runtime.PYTHON_3_8,
-            code=_lambda.Code.asset("lambda-code"),
+            code=handlerCode("reconcile-check.py"),
             handler='reconcile-check.lambda_handler',
             environment={
-                "dynamoDbTableName": fileUploadEventTable.table_name
+                "dynamoDbTableName": fileUploadEventTable.table_name,
+                "fileUploadTableShardCount": fileUploadTableShardCount,
+                "fileUploadTableItemFormat": fileUploadTableItemFormat,
+                "reconcileRangeCount": reconcileRangeCount,
+                "reconcileTimeoutSeconds": self.node.try_get_context("reconcileTimeoutSeconds"),
+                "reconcileWaitMinSeconds": self.node.try_get_context("reconcileWaitMinSeconds"),
+                "reconcileWaitMaxSeconds": self.node.try_get_context("reconcileWaitMaxSeconds"),
+                "reconcileReportBucketName": reconcileReportBucket.bucket_name,
+                "metricsNamespace": metricsNamespace
             },
+            memory_size=reconcileFunctionMemoryMb,
+            timeout=reconcileFunctionTimeout,
+            layers=reconcileLayers,
             role=reconcileCheckLambdaIamRole
         )
         reconcileCheckLambdaIamPolicyStatementDdb = iam.PolicyStatement(
             actions=[
-                "dynamodb:Query"
+                "dynamodb:GetItem",
+                "dynamodb:BatchGetItem",
+                "dynamodb:Query",
+                "dynamodb:UpdateItem"
             ],
             effect=iam.Effect('ALLOW'),
             resources=[
@@ -290,6 +507,15 @@ class EventProcessing(core.Stack):
                 fileUploadBucket.bucket_arn + "/*"
             ]                 
         )
+        reconcileCheckLambdaIamPolicyStatementReport = iam.PolicyStatement(
+            actions=[
+                "s3:PutObject"
+            ],
+            effect=iam.Effect('ALLOW'),
+            resources=[
+                reconcileReportBucket.bucket_arn + "/*"
+            ]
+        )
         reconcileCheckLambdaIamPolicyStatementWriteLogs = iam.PolicyStatement(
             actions=[
                 "logs:CreateLogStream",
@@ -300,6 +526,7 @@ class EventProcessing(core.Stack):
         )
         reconcileCheckLambdaIamPolicy.add_statements(reconcileCheckLambdaIamPolicyStatementDdb)
         reconcileCheckLambdaIamPolicy.add_statements(reconcileCheckLambdaIamPolicyStatementS3)
+        reconcileCheckLambdaIamPolicy.add_statements(reconcileCheckLambdaIamPolicyStatementReport)
         reconcileCheckLambdaIamPolicy.add_statements(reconcileCheckLambdaIamPolicyStatementWriteLogs)
 
         # AWS Lambda function used by the Step Functions "reconcile file uploads" state machine that 
@@ -322,13 +549,24 @@ class EventProcessing(core.Stack):
             self,
             "reconcileNotifyLambda",
             runtime=_lambda.Runtime.PYTHON_3_8,
-            code=_lambda.Code.asset("lambda-code"),
+            code=handlerCode("reconcile-notify.py"),
             handler='reconcile-notify.lambda_handler',
             environment={
-                "eventBusName": customEventBus.event_bus_name                
+                "eventBusName": customEventBus.event_bus_name,
+                "dynamoDbTableName": fileUploadEventTable.table_name,
+                "metricsNamespace": metricsNamespace
             },
             role=reconcileNotifyLambdaIamRole            
         )
+        reconcileNotifyLambdaIamPolicyStatementDdb = iam.PolicyStatement(
+            actions=[
+                "dynamodb:UpdateItem"
+            ],
+            effect=iam.Effect('ALLOW'),
+            resources=[
+                fileUploadEventTable.table_arn
+            ]
+        )
         reconcileNotifyLambdaIamPolicyStatementWriteLogs = iam.PolicyStatement(
             actions=[
                 "logs:CreateLogStream",
@@ -337,24 +575,145 @@ class EventProcessing(core.Stack):
             effect=iam.Effect('ALLOW'),
             resources=[reconcileNotifyLambda.log_group.log_group_arn]
         )
+        reconcileNotifyLambdaIamPolicy.add_statements(reconcileNotifyLambdaIamPolicyStatementDdb)
         reconcileNotifyLambdaIamPolicy.add_statements(reconcileNotifyLambdaIamPolicyStatementWriteLogs)
 
-        # "Reconcile file uploads" Step Functions state machine
-        passObjectState = {
-            "count": int(self.node.try_get_context("reconcileCountIterations")),
-            "ticker": 0
-        }
-        configureCountState = sfn.Pass(
-            self,
-            "configureCountState",
-            result=sfn.Result.from_object(passObjectState),
-            result_path="$.iterator.Payload"
-        )
-        iteratorState = tasks.LambdaInvoke(
+        # AWS Lambda function used by the Step Functions "reconcile file uploads" state machine, in
+        # the callback and index reconcile modes, that stores the task token of the execution so 
+        # that it can be resumed once all files in the manifest have been recorded. Created with 
+        # required IAM policy and role
+        if callbackReconcileMode:
+            reconcileRegisterCallbackLambdaIamRole = iam.Role(
+                self,
+                "reconcileRegisterCallbackLambdaIamRole",
+                assumed_by=iam.ServicePrincipal('lambda.amazonaws.com')
+            )
+            reconcileRegisterCallbackLambdaIamPolicy = iam.Policy(
+                self,
+                "reconcileRegisterCallbackLambdaIamPolicy",
+                roles=[reconcileRegisterCallbackLambdaIamRole]
+            )
+            reconcileRegisterCallbackLambda = _lambda.Function(
+                self,
+                "reconcileRegisterCallbackLambda",
+                runtime=_lambda.Runtime.PYTHON_3_8,
+                code=handlerCode("reconcile-register-callback.py"),
+                handler='reconcile-register-callback.lambda_handler',
+                environment=dict({
+                    "dynamoDbTableName": fileUploadEventTable.table_name,
+                    "fileUploadTableShardCount": fileUploadTableShardCount,
+                    "metricsNamespace": metricsNamespace
+                }, **expectedKeyIndexEnvironment),
+                memory_size=reconcileFunctionMemoryMb,
+                timeout=reconcileFunctionTimeout,
+                layers=reconcileLayers,
+                role=reconcileRegisterCallbackLambdaIamRole
+            )
+            reconcileRegisterCallbackLambdaIamPolicyStatementDdb = iam.PolicyStatement(
+                actions=[
+                    "dynamodb:GetItem",
+                    "dynamodb:Query",
+                    "dynamodb:PutItem",
+                    "dynamodb:UpdateItem",
+                    "dynamodb:DeleteItem"
+                ],
+                effect=iam.Effect('ALLOW'),
+                resources=[
+                    fileUploadEventTable.table_arn
+                ]
+            )
+            reconcileRegisterCallbackLambdaIamPolicyStatementWriteLogs = iam.PolicyStatement(
+                actions=[
+                    "logs:CreateLogStream",
+                    "logs:PutLogEvents"
+                ],
+                effect=iam.Effect('ALLOW'),
+                resources=[reconcileRegisterCallbackLambda.log_group.log_group_arn]
+            )
+            reconcileRegisterCallbackLambdaIamPolicy.add_statements(reconcileRegisterCallbackLambdaIamPolicyStatementDdb)
+            reconcileRegisterCallbackLambdaIamPolicy.add_statements(reconcileCheckLambdaIamPolicyStatementS3)
+            reconcileRegisterCallbackLambdaIamPolicy.add_statements(reconcileRegisterCallbackLambdaIamPolicyStatementWriteLogs)
+
+        # AWS Lambda function used by the Step Functions "reconcile file uploads" state machine, in
+        # the index reconcile mode, that builds the expected key index of the logical dataset from
+        # its manifest file as soon as it arrives. Created with required IAM policy and role
+        if indexReconcileMode:
+            reconcileBuildIndexLambdaIamRole = iam.Role(
+                self,
+                "reconcileBuildIndexLambdaIamRole",
+                assumed_by=iam.ServicePrincipal('lambda.amazonaws.com')
+            )
+            reconcileBuildIndexLambdaIamPolicy = iam.Policy(
+                self,
+                "reconcileBuildIndexLambdaIamPolicy",
+                roles=[reconcileBuildIndexLambdaIamRole]
+            )
+            reconcileBuildIndexLambda = _lambda.Function(
+                self,
+                "reconcileBuildIndexLambda",
+                runtime=_lambda.Runtime.PYTHON_3_8,
+                code=handlerCode("reconcile-build-index.py"),
+                handler='reconcile-build-index.lambda_handler',
+                environment=dict({
+                    "dynamoDbTableName": fileUploadEventTable.table_name,
+                    "metricsNamespace": metricsNamespace
+                }, **expectedKeyIndexEnvironment),
+                memory_size=reconcileFunctionMemoryMb,
+                timeout=reconcileFunctionTimeout,
+                layers=reconcileLayers,
+                role=reconcileBuildIndexLambdaIamRole
+            )
+            reconcileBuildIndexLambdaIamPolicyStatementDdb = iam.PolicyStatement(
+                actions=[
+                    "dynamodb:PutItem"
+                ],
+                effect=iam.Effect('ALLOW'),
+                resources=[
+                    fileUploadEventTable.table_arn
+                ]
+            )
+            reconcileBuildIndexLambdaIamPolicyStatementIndex = iam.PolicyStatement(
+                actions=[
+                    "s3:PutObject"
+                ],
+                effect=iam.Effect('ALLOW'),
+                resources=[
+                    expectedKeyIndexBucket.bucket_arn + "/*"
+                ]
+            )
+            reconcileBuildIndexLambdaIamPolicyStatementWriteLogs = iam.PolicyStatement(
+                actions=[
+                    "logs:CreateLogStream",
+                    "logs:PutLogEvents"
+                ],
+                effect=iam.Effect('ALLOW'),
+                resources=[reconcileBuildIndexLambda.log_group.log_group_arn]
+            )
+            reconcileBuildIndexLambdaIamPolicy.add_statements(reconcileBuildIndexLambdaIamPolicyStatementDdb)
+            reconcileBuildIndexLambdaIamPolicy.add_statements(reconcileCheckLambdaIamPolicyStatementS3)
+            reconcileBuildIndexLambdaIamPolicy.add_statements(reconcileBuildIndexLambdaIamPolicyStatementIndex)
+            reconcileBuildIndexLambdaIamPolicy.add_statements(reconcileBuildIndexLambdaIamPolicyStatementWriteLogs)
+            reconcileRegisterCallbackLambdaIamPolicyStatementIndex = iam.PolicyStatement(
+                actions=[
+                    "s3:GetObject"
+                ],
+                effect=iam.Effect('ALLOW'),
+                resources=[
+                    expectedKeyIndexBucket.bucket_arn + "/*"
+                ]
+            )
+            reconcileRegisterCallbackLambdaIamPolicy.add_statements(reconcileRegisterCallbackLambdaIamPolicyStatementIndex)
+
+        # "Reconcile file uploads" Step Functions state machine. The reconciliation time budget is 
+        # measured from the start of the execution, which is passed to the reconcile check along 
+        # with the wait and file count of the previous iteration
+        configureScheduleState = sfn.Pass(
             self,
-            "iteratorState",
-            lambda_function=reconcileIteratorLambda,
-            result_path="$.iterator"
+            "configureScheduleState",
+            parameters={
+                "startTime.$": "$$.Execution.StartTime"
+            },
+            result_path="$.reconcilecheck.Payload.schedule"
         )
         reconcileCheckState = tasks.LambdaInvoke(
             self,
@@ -367,10 +726,6 @@ class EventProcessing(core.Stack):
             "reconcileNotifyState",
             lambda_function=reconcileNotifyLambda
         )
-        isCountReachedState = sfn.Choice(
-            self,
-            "isCountReachedState"
-        )
         isReconcileCompleteState = sfn.Choice(
             self,
             "isReconcileCompleteState"
@@ -378,30 +733,114 @@ class EventProcessing(core.Stack):
         waitBetweenIterationsState = sfn.Wait(
             self,
             "waitBetweenIterationsState",
-            time=sfn.WaitTime.duration(core.Duration.seconds(int(self.node.try_get_context("reconcileWaitIterations"))))
+            time=sfn.WaitTime.seconds_path("$.reconcilecheck.Payload.schedule.waitSeconds")
         )
         doneState = sfn.Pass(
             self,
             "doneState"
         )
-        reconcileStateMachineDefinition = configureCountState \
-            .next(iteratorState) \
-            .next(isCountReachedState
-                .when(sfn.Condition.boolean_equals("$.iterator.Payload.continue",True), reconcileCheckState \
-                    .next(isReconcileCompleteState \
-                        .when(sfn.Condition.boolean_equals("$.reconcilecheck.Payload.reconcileDone", True), reconcileNotifyState.next(doneState)) \
-                        .otherwise(waitBetweenIterationsState \
-                            .next(iteratorState)))) \
-                .otherwise(reconcileNotifyState))
+        reconcileStateMachineDefinition = configureScheduleState \
+            .next(reconcileCheckState) \
+            .next(isReconcileCompleteState
+                .when(sfn.Condition.boolean_equals("$.reconcilecheck.Payload.reconcileDone", True), reconcileNotifyState.next(doneState)) \
+                .when(sfn.Condition.boolean_equals("$.reconcilecheck.Payload.schedule.timedOut", True), reconcileNotifyState) \
+                .otherwise(waitBetweenIterationsState \
+                    .next(reconcileCheckState)))
+
+        # In the callback reconcile mode the state machine first waits, without polling, until
+        # the file upload notification writer resumes it once all files in the manifest have 
+        # been recorded. The reconcile loop above then confirms the result. If the wait times out 
+        # the reconcile check runs once more, with the time budget used up, so the timeout
+        # notification reports the keys that differ
+        if callbackReconcileMode:
+            waitForUploadsState = tasks.LambdaInvoke(
+                self,
+                "waitForUploadsState",
+                lambda_function=reconcileRegisterCallbackLambda,
+                integration_pattern=sfn.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+                payload=sfn.TaskInput.from_object({
+                    "taskToken": sfn.JsonPath.task_token,
+                    "detail": sfn.JsonPath.string_at("$.detail")
+                }),
+                timeout=core.Duration.seconds(int(self.node.try_get_context("reconcileTimeoutSeconds"))),
+                result_path="$.callback"
+            )
+            waitForUploadsState.add_catch(
+                configureScheduleState,
+                errors=["States.Timeout"],
+                result_path="$.callback"
+            )
+            reconcileStateMachineDefinition = waitForUploadsState.next(reconcileStateMachineDefinition)
+
+        # In the index reconcile mode the expected key index is built first. The state machine 
+        # then waits until every file upload notification writer has loaded it - the time writers 
+        # cache a dataset without an index, plus the longest write already under way - so files 
+        # recorded without being checked can be counted once before waiting for the uploads
+        if indexReconcileMode:
+            buildKeyIndexState = tasks.LambdaInvoke(
+                self,
+                "buildKeyIndexState",
+                lambda_function=reconcileBuildIndexLambda,
+                result_path=sfn.JsonPath.DISCARD
+            )
+            waitForIndexLoadState = sfn.Wait(
+                self,
+                "waitForIndexLoadState",
+                time=sfn.WaitTime.duration(core.Duration.seconds(int(expectedKeyIndexCacheSeconds) + fileUploadEventWriterTimeoutSeconds))
+            )
+            reconcileStateMachineDefinition = buildKeyIndexState.next(waitForIndexLoadState).next(reconcileStateMachineDefinition)
+
         reconcileStateMachine = sfn.StateMachine(
             self,
             "reconcileStateMachine",
             definition=reconcileStateMachineDefinition
         )
+
+        # Allow the file upload notification writer and callback registration functions to resume 
+        # executions waiting in the callback reconcile mode
+        if callbackReconcileMode:
+            reconcileStateMachine.grant_task_response(fileUploadEventWriterLambdaIamRole)
+            reconcileStateMachine.grant_task_response(reconcileRegisterCallbackLambdaIamRole)
         
-        # Add Step Functions "reconcile file uploads" state machine as another target for the 
-        # "manifest" file upload Amazon EventBridge rule
-        manifestFileUploadEventRule.add_target(targets.SfnStateMachine(reconcileStateMachine))
+        # "Reconcile start" AWS Lambda function, added as another target for the "manifest" file
+        # upload Amazon EventBridge rule, that starts the Step Functions "reconcile file uploads"
+        # state machine. Executions are named after the manifest file upload event, so duplicate
+        # deliveries of the event do not start a second execution. Created with required IAM
+        # policy and role
+        reconcileStartLambdaIamRole = iam.Role(
+            self,
+            "reconcileStartLambdaIamRole",
+            assumed_by=iam.ServicePrincipal('lambda.amazonaws.com')
+        )
+        reconcileStartLambdaIamPolicy = iam.Policy(
+            self,
+            "reconcileStartLambdaIamPolicy",
+            roles=[reconcileStartLambdaIamRole]
+        )
+        reconcileStartLambda = _lambda.Function(
+            self,
+            "reconcileStartLambda",
+            runtime=_lambda.Runtime.PYTHON_3_8,
+            code=handlerCode("reconcile-start.py"),
+            handler='reconcile-start.lambda_handler',
+            environment={
+                "stateMachineArn": reconcileStateMachine.state_machine_arn,
+                "metricsNamespace": metricsNamespace
+            },
+            dead_letter_queue=eventTargetDeadLetterQueue,
+            role=reconcileStartLambdaIamRole
+        )
+        reconcileStartLambdaIamPolicyStatementWriteLogs = iam.PolicyStatement(
+            actions=[
+                "logs:CreateLogStream",
+                "logs:PutLogEvents"
+            ],
+            effect=iam.Effect('ALLOW'),
+            resources=[reconcileStartLambda.log_group.log_group_arn]
+        )
+        reconcileStartLambdaIamPolicy.add_statements(reconcileStartLambdaIamPolicyStatementWriteLogs)
+        reconcileStateMachine.grant_start_execution(reconcileStartLambdaIamRole)
+        manifestFileUploadEventRule.add_target(targets.LambdaFunction(reconcileStartLambda, dead_letter_queue=eventTargetDeadLetterQueue))
 
         # Amazon CloudWatch log groups for the notification events generated by the "reconcile file 
         # uploads" Step Functions state machine
@@ -439,8 +878,466 @@ class EventProcessing(core.Stack):
             event_bus=customEventBus,
             event_pattern=reconcileNotifyTimeoutEventPattern
         )
-        reconcileNotifySuccessfulEventRule.add_target(targets.CloudWatchLogGroup(reconcileNotifySuccessfulLogGroup))
-        reconcileNotifyTimeoutEventRule.add_target(targets.CloudWatchLogGroup(reconcileNotifyTimeoutLogGroup))
+        reconcileNotifySuccessfulEventRule.add_target(targets.CloudWatchLogGroup(reconcileNotifySuccessfulLogGroup, dead_letter_queue=eventTargetDeadLetterQueue))
+        reconcileNotifyTimeoutEventRule.add_target(targets.CloudWatchLogGroup(reconcileNotifyTimeoutLogGroup, dead_letter_queue=eventTargetDeadLetterQueue))
+
+        # Set compaction, enabled unless the context value is "disabled". Once a logical dataset is
+        # reconciled, the "set compaction" AWS Lambda function, another target of the reconciliation
+        # successful rule, writes a compressed summary of its file upload events to the set summary
+        # Amazon S3 bucket and deletes its items from the table, so the table only holds logical
+        # datasets in progress. NOTE: removal policy set to destroy, hence this bucket should be
+        # emptied prior to destroying the CDK stack
+        reconciledSetCompaction = self.node.try_get_context("reconciledSetCompaction") or "enabled"
+        if reconciledSetCompaction not in ("enabled", "disabled"):
+            raise ValueError("reconciledSetCompaction must be enabled or disabled")
+        if reconciledSetCompaction == "enabled":
+            setSummaryBucket = s3.Bucket(
+                self,
+                "setSummaryBucket",
+                removal_policy=core.RemovalPolicy.DESTROY
+            )
+            setCompactionLambdaIamRole = iam.Role(
+                self,
+                "setCompactionLambdaIamRole",
+                assumed_by=iam.ServicePrincipal('lambda.amazonaws.com')
+            )
+            setCompactionLambdaIamPolicy = iam.Policy(
+                self,
+                "setCompactionLambdaIamPolicy",
+                roles=[setCompactionLambdaIamRole]
+            )
+
+            # The items of a large logical dataset are deleted in parallel, which takes the longest.
+            # If the function times out, the retried invocation resumes the deletes
+            setCompactionLambda = _lambda.Function(
+                self,
+                "setCompactionLambda",
+                runtime=_lambda.Runtime.PYTHON_3_8,
+                code=handlerCode("set-compaction.py"),
+                handler='set-compaction.lambda_handler',
+                environment={
+                    "dynamoDbTableName": fileUploadEventTable.table_name,
+                    "fileUploadTableShardCount": fileUploadTableShardCount,
+                    "fileUploadTableItemFormat": fileUploadTableItemFormat,
+                    "setSummaryBucketName": setSummaryBucket.bucket_name,
+                    "metricsNamespace": metricsNamespace
+                },
+                memory_size=512,
+                timeout=core.Duration.minutes(15),
+                dead_letter_queue=eventTargetDeadLetterQueue,
+                role=setCompactionLambdaIamRole
+            )
+            setCompactionLambdaIamPolicyStatementDdb = iam.PolicyStatement(
+                actions=[
+                    "dynamodb:Query",
+                    "dynamodb:UpdateItem",
+                    "dynamodb:BatchWriteItem"
+                ],
+                effect=iam.Effect('ALLOW'),
+                resources=[
+                    fileUploadEventTable.table_arn
+                ]
+            )
+            setCompactionLambdaIamPolicyStatementS3 = iam.PolicyStatement(
+                actions=[
+                    "s3:GetObject",
+                    "s3:PutObject",
+                    "s3:ListBucket"
+                ],
+                effect=iam.Effect('ALLOW'),
+                resources=[
+                    setSummaryBucket.bucket_arn,
+                    setSummaryBucket.bucket_arn + "/*"
+                ]
+            )
+            setCompactionLambdaIamPolicyStatementWriteLogs = iam.PolicyStatement(
+                actions=[
+                    "logs:CreateLogStream",
+                    "logs:PutLogEvents"
+                ],
+                effect=iam.Effect('ALLOW'),
+                resources=[setCompactionLambda.log_group.log_group_arn]
+            )
+            setCompactionLambdaIamPolicy.add_statements(setCompactionLambdaIamPolicyStatementDdb)
+            setCompactionLambdaIamPolicy.add_statements(setCompactionLambdaIamPolicyStatementS3)
+            setCompactionLambdaIamPolicy.add_statements(setCompactionLambdaIamPolicyStatementWriteLogs)
+            reconcileNotifySuccessfulEventRule.add_target(targets.LambdaFunction(setCompactionLambda, dead_letter_queue=eventTargetDeadLetterQueue))
+
+            # Stack CloudFormation output providing the set summary Amazon S3 bucket name
+            setSummaryBucketName = core.CfnOutput(
+                self,
+                "setSummaryBucketName",
+                value=setSummaryBucket.bucket_name,
+                description="Compressed summaries of the file upload events of reconciled \
+                logical datasets. Empty this bucket before destroying this stack."
+            )
+
+        # "Set progress" AWS Lambda function serving the progress of logical datasets (files and bytes 
+        # arrived, manifest size, percent complete, arrival rate and ETA) through a function URL, from 
+        # the running aggregates kept in the table rather than the file upload events. Requests are 
+        # signed with AWS credentials (see example-scripts/set_progress_client.py), and responses are 
+        # cached for the configured number of seconds. Created with required IAM policy and role
+        setProgressCacheSeconds = str(self.node.try_get_context("setProgressCacheSeconds") or "5")
+        if not setProgressCacheSeconds.isdigit() or not 0 <= int(setProgressCacheSeconds) <= 300:
+            raise ValueError("setProgressCacheSeconds must be a whole number from 0 to 300")
+        setProgressLambdaIamRole = iam.Role(
+            self,
+            "setProgressLambdaIamRole",
+            assumed_by=iam.ServicePrincipal('lambda.amazonaws.com')
+        )
+        setProgressLambdaIamPolicy = iam.Policy(
+            self,
+            "setProgressLambdaIamPolicy",
+            roles=[setProgressLambdaIamRole]
+        )
+        setProgressEnvironment = {
+            "dynamoDbTableName": fileUploadEventTable.table_name,
+            "fileUploadTableShardCount": fileUploadTableShardCount,
+            "setProgressCacheSeconds": setProgressCacheSeconds,
+            "metricsNamespace": metricsNamespace
+        }
+        if reconciledSetCompaction == "enabled":
+            setProgressEnvironment["setSummaryBucketName"] = setSummaryBucket.bucket_name
+        setProgressLambda = _lambda.Function(
+            self,
+            "setProgressLambda",
+            runtime=_lambda.Runtime.PYTHON_3_8,
+            code=handlerCode("set-progress.py"),
+            handler='set-progress.lambda_handler',
+            environment=setProgressEnvironment,
+            role=setProgressLambdaIamRole
+        )
+        setProgressLambdaIamPolicyStatementDdb = iam.PolicyStatement(
+            actions=[
+                "dynamodb:BatchGetItem"
+            ],
+            effect=iam.Effect('ALLOW'),
+            resources=[
+                fileUploadEventTable.table_arn
+            ]
+        )
+        setProgressLambdaIamPolicyStatementWriteLogs = iam.PolicyStatement(
+            actions=[
+                "logs:CreateLogStream",
+                "logs:PutLogEvents"
+            ],
+            effect=iam.Effect('ALLOW'),
+            resources=[setProgressLambda.log_group.log_group_arn]
+        )
+        setProgressLambdaIamPolicy.add_statements(setProgressLambdaIamPolicyStatementDdb)
+        setProgressLambdaIamPolicy.add_statements(setProgressLambdaIamPolicyStatementWriteLogs)
+        if reconciledSetCompaction == "enabled":
+            # s3:ListBucket lets the function tell a logical dataset without a set summary 
+            # object (404) from one it may not read (403)
+            setProgressLambdaIamPolicyStatementS3 = iam.PolicyStatement(
+                actions=[
+                    "s3:GetObject",
+                    "s3:ListBucket"
+                ],
+                effect=iam.Effect('ALLOW'),
+                resources=[
+                    setSummaryBucket.bucket_arn,
+                    setSummaryBucket.bucket_arn + "/*"
+                ]
+            )
+            setProgressLambdaIamPolicy.add_statements(setProgressLambdaIamPolicyStatementS3)
+        setProgressFunctionUrl = setProgressLambda.add_function_url(
+            auth_type=_lambda.FunctionUrlAuthType.AWS_IAM
+        )
+
+        # Stack CloudFormation output providing the set progress function URL
+        setProgressUrl = core.CfnOutput(
+            self,
+            "setProgressUrl",
+            value=setProgressFunctionUrl.url,
+            description="Request the progress of logical datasets from this URL, \
+            with the setId query string parameter."
+        )
+
+        # Amazon CloudWatch dashboard of the metrics published by the AWS Lambda functions, one row
+        # for each stage of the pipeline - ingest, write, reconcile, the latency of each hop of the 
+        # traced file upload events, progress requests and (if enabled) compaction
+        pipelineDashboard = cloudwatch.Dashboard(
+            self,
+            "pipelineDashboard"
+        )
+        pipelineDashboard.add_widgets(
+            cloudwatch.GraphWidget(
+                title="Ingest - events",
+                left=[
+                    functionMetric(metricsNamespace, checkFileUploadTypeLambda, "EventsSent"),
+                    functionMetric(metricsNamespace, checkFileUploadTypeLambda, "IgnoredObjects"),
+                    functionMetric(metricsNamespace, checkFileUploadTypeLambda, "DuplicatesDropped")
+                ]
+            ),
+            cloudwatch.GraphWidget(
+                title="Ingest - batch size and latency",
+                left=[functionMetric(metricsNamespace, checkFileUploadTypeLambda, "BatchSize", "Average")],
+                right=[functionMetric(metricsNamespace, checkFileUploadTypeLambda, "PutEventsLatency", "p99")]
+            ),
+            cloudwatch.GraphWidget(
+                title="Ingest - failures",
+                left=[
+                    functionMetric(metricsNamespace, checkFileUploadTypeLambda, "FailedMessages"),
+                    functionMetric(metricsNamespace, checkFileUploadTypeLambda, "Retries"),
+                    checkFileUploadTypeLambda.metric_errors()
+                ]
+            )
+        )
+        pipelineDashboard.add_widgets(
+            cloudwatch.GraphWidget(
+                title="Write - files recorded",
+                left=[
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "FilesRecorded"),
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "DuplicatesDropped"),
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "LateEventsDropped"),
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "UnexpectedFiles")
+                ],
+                right=[functionMetric(metricsNamespace, fileUploadEventWriterLambda, "UploadBytes")]
+            ),
+            cloudwatch.GraphWidget(
+                title="Write - latency and capacity",
+                left=[
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "TransactWriteItemsLatency", "p99"),
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "GetItemLatency", "p99")
+                ],
+                right=[functionMetric(metricsNamespace, fileUploadEventWriterLambda, "WriteCapacityUnits")]
+            ),
+            cloudwatch.GraphWidget(
+                title="Write - throttles and failures",
+                left=[
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "Throttles"),
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "Retries"),
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "TransactionConflicts"),
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "FailedMessages"),
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "FailedResumes"),
+                    fileUploadEventWriterLambda.metric_errors()
+                ]
+            )
+        )
+        pipelineDashboard.add_widgets(
+            cloudwatch.GraphWidget(
+                title="Reconcile - progress",
+                left=[functionMetric(metricsNamespace, reconcileCheckLambda, "ReconcileMatchPercent", "Average")],
+                right=[
+                    functionMetric(metricsNamespace, reconcileNotifyLambda, "ReconcileSuccessful"),
+                    functionMetric(metricsNamespace, reconcileNotifyLambda, "ReconcileTimeout"),
+                    functionMetric(metricsNamespace, reconcileStartLambda, "ExecutionsStarted")
+                ]
+            ),
+            cloudwatch.GraphWidget(
+                title="Reconcile - latency and capacity",
+                left=[
+                    functionMetric(metricsNamespace, reconcileCheckLambda, "QueryLatency", "p99"),
+                    functionMetric(metricsNamespace, reconcileCheckLambda, "GetObjectLatency", "p99")
+                ],
+                right=[functionMetric(metricsNamespace, reconcileCheckLambda, "ReadCapacityUnits")]
+            ),
+            cloudwatch.GraphWidget(
+                title="Reconcile - state machine",
+                left=[
+                    reconcileStateMachine.metric_started(),
+                    reconcileStateMachine.metric_succeeded(),
+                    reconcileStateMachine.metric_failed()
+                ]
+            )
+        )
+        writerHops = ["BusDeliveryLatency"] if bufferedIngestMode else []
+        pipelineDashboard.add_widgets(
+            cloudwatch.GraphWidget(
+                title="Upload latency by hop (p90)",
+                left=[functionMetric(metricsNamespace, checkFileUploadTypeLambda, metricName, "p90") for metricName in
+                    ["GatewayDeliveryLatency", "QueueWaitLatency", "ClassifyLatency", "PublishLatency"]] +
+                    [functionMetric(metricsNamespace, fileUploadEventWriterLambda, metricName, "p90") for metricName in
+                    writerHops + ["WriterDeliveryLatency", "WriteLatency"]] +
+                    [functionMetric(metricsNamespace, reconcileNotifyLambda, "ReconcileLatency", "p90")],
+                width=12
+            ),
+            cloudwatch.GraphWidget(
+                title="Upload to written and reconciled",
+                left=[
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "UploadToWrittenLatency", "p50"),
+                    functionMetric(metricsNamespace, fileUploadEventWriterLambda, "UploadToWrittenLatency", "p99")
+                ],
+                right=[
+                    functionMetric(metricsNamespace, reconcileNotifyLambda, "UploadToReconciledLatency", "p50"),
+                    functionMetric(metricsNamespace, reconcileNotifyLambda, "UploadToReconciledLatency", "p99")
+                ],
+                width=12
+            )
+        )
+        pipelineDashboard.add_widgets(
+            cloudwatch.GraphWidget(
+                title="Progress - requests and cache",
+                left=[
+                    functionMetric(metricsNamespace, setProgressLambda, "CacheHits"),
+                    functionMetric(metricsNamespace, setProgressLambda, "CacheMisses")
+                ],
+                right=[functionMetric(metricsNamespace, setProgressLambda, "ReadCapacityUnits")]
+            ),
+            cloudwatch.GraphWidget(
+                title="Progress - latency",
+                left=[functionMetric(metricsNamespace, setProgressLambda, "BatchGetItemLatency", "p99")],
+                right=[setProgressLambda.metric_errors()]
+            )
+        )
+        if reconciledSetCompaction == "enabled":
+            pipelineDashboard.add_widgets(
+                cloudwatch.GraphWidget(
+                    title="Compaction - items",
+                    left=[
+                        functionMetric(metricsNamespace, setCompactionLambda, "ItemsSummarised"),
+                        functionMetric(metricsNamespace, setCompactionLambda, "ItemsDeleted"),
+                        functionMetric(metricsNamespace, setCompactionLambda, "UnprocessedItems")
+                    ],
+                    right=[functionMetric(metricsNamespace, setCompactionLambda, "SummaryBytes")]
+                ),
+                cloudwatch.GraphWidget(
+                    title="Compaction - capacity",
+                    left=[functionMetric(metricsNamespace, setCompactionLambda, "WriteCapacityUnits")],
+                    right=[functionMetric(metricsNamespace, setCompactionLambda, "ReadCapacityUnits")]
+                )
+            )
+
+        # Amazon CloudWatch alarms on reconciliation timeouts, file upload events that could not be
+        # sent or written (returned to the queue by the batch writer, or failed invocations of the 
+        # writer retried by EventBridge), messages in any dead-letter queue, throttling of the 
+        # table writes, and the share of the transactions recording file upload events that were 
+        # cancelled by a conflicting write to the same running aggregates item. Periods without 
+        # data (no uploads) are not treated as breaching
+        deadLetterQueues = [fileUploadEventDeadLetterQueue, eventTargetDeadLetterQueue]
+        if bufferedIngestMode:
+            deadLetterQueues.append(fileUploadEventBufferDeadLetterQueue)
+        pipelineAlarms = [
+            cloudwatch.Alarm(
+                self,
+                "reconcileTimeoutAlarm",
+                metric=functionMetric(metricsNamespace, reconcileNotifyLambda, "ReconcileTimeout"),
+                threshold=1,
+                evaluation_periods=1,
+                comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+                treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+                alarm_description="A logical dataset was not reconciled within its time budget"
+            ),
+            cloudwatch.Alarm(
+                self,
+                "checkFileUploadTypeFailedAlarm",
+                metric=functionMetric(metricsNamespace, checkFileUploadTypeLambda, "FailedMessages"),
+                threshold=1,
+                evaluation_periods=1,
+                comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+                treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+                alarm_description="File upload notifications could not be sent to the custom event bus and were returned to the queue"
+            ),
+            cloudwatch.Alarm(
+                self,
+                "fileUploadEventWriterFailedAlarm",
+                metric=functionMetric(metricsNamespace, fileUploadEventWriterLambda, "FailedMessages") if bufferedIngestMode \
+                    else fileUploadEventWriterLambda.metric_errors(),
+                threshold=1,
+                evaluation_periods=1,
+                comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+                treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+                alarm_description="File upload events could not be written to the table"
+            ),
+            cloudwatch.Alarm(
+                self,
+                "fileUploadEventWriterThrottlesAlarm",
+                metric=functionMetric(metricsNamespace, fileUploadEventWriterLambda, "Throttles"),
+                threshold=10,
+                evaluation_periods=3,
+                comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+                treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+                alarm_description="Writes to the file upload event table are being throttled, consider more shards"
+            ),
+            cloudwatch.Alarm(
+                self,
+                "fileUploadEventWriterConflictsAlarm",
+                metric=cloudwatch.MathExpression(
+                    expression="100 * conflicts / transactions",
+                    using_metrics={
+                        "conflicts": functionMetric(metricsNamespace, fileUploadEventWriterLambda, "TransactionConflicts"),
+                        "transactions": functionMetric(metricsNamespace, fileUploadEventWriterLambda, "TransactWriteItemsLatency", "SampleCount")
+                    },
+                    period=core.Duration.minutes(5)
+                ),
+                threshold=5,
+                evaluation_periods=3,
+                comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+                treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+                alarm_description="At least 5% of file upload event transactions conflict on the running aggregates of a shard, consider more shards or the buffered ingest mode"
+            )
+        ] + [
+            cloudwatch.Alarm(
+                self,
+                deadLetterQueue.node.id + "Alarm",
+                metric=deadLetterQueue.metric_approximate_number_of_messages_visible(statistic="Maximum"),
+                threshold=1,
+                evaluation_periods=1,
+                comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+                treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+                alarm_description="Messages are waiting in a dead-letter queue, replay them with redrive_dead_letters.py once the cause is fixed"
+            )
+            for deadLetterQueue in deadLetterQueues
+        ]
+        pipelineDashboard.add_widgets(cloudwatch.AlarmStatusWidget(
+            title="Alarms",
+            alarms=pipelineAlarms,
+            width=24
+        ))
+
+        # Stack CloudFormation output providing the reconcile report Amazon S3 bucket name
+        reconcileReportBucketName = core.CfnOutput(
+            self,
+            "reconcileReportBucketName",
+            value=reconcileReportBucket.bucket_name,
+            description="Reports of the keys that differ between manifest files and \
+            the file upload events recorded. Empty this bucket before destroying \
+            this stack."
+        )
+
+        # Stack CloudFormation outputs providing the dead-letter queue URLs, and where to redrive
+        # their messages to
+        fileUploadEventDeadLetterQueueUrl = core.CfnOutput(
+            self,
+            "fileUploadEventDeadLetterQueueUrl",
+            value=fileUploadEventDeadLetterQueue.queue_url,
+            description="File upload notifications that could not be processed. Redrive \
+            them to the fileUploadEventSqsQueueUrl queue."
+        )
+        fileUploadEventSqsQueueUrl = core.CfnOutput(
+            self,
+            "fileUploadEventSqsQueueUrl",
+            value=fileUploadEventSqsQueue.queue_url,
+            description="Queue of the file upload notifications sent by the File Gateway."
+        )
+        eventTargetDeadLetterQueueUrl = core.CfnOutput(
+            self,
+            "eventTargetDeadLetterQueueUrl",
+            value=eventTargetDeadLetterQueue.queue_url,
+            description="Events of the custom event bus that could not be delivered to \
+            a target. Redrive them to the customEventBusName event bus."
+        )
+        customEventBusName = core.CfnOutput(
+            self,
+            "customEventBusName",
+            value=customEventBus.event_bus_name,
+            description="Custom event bus of the file upload and reconciliation events."
+        )
+        if bufferedIngestMode:
+            fileUploadEventBufferDeadLetterQueueUrl = core.CfnOutput(
+                self,
+                "fileUploadEventBufferDeadLetterQueueUrl",
+                value=fileUploadEventBufferDeadLetterQueue.queue_url,
+                description="File upload events that could not be written to the table. \
+                Redrive them to the fileUploadEventBufferSqsQueueUrl queue."
+            )
+            fileUploadEventBufferSqsQueueUrl = core.CfnOutput(
+                self,
+                "fileUploadEventBufferSqsQueueUrl",
+                value=fileUploadEventBufferSqsQueue.queue_url,
+                description="Buffer queue of the file upload events written in batches."
+            )
 
         # Stack CloudFormation output providing the file upload Amazon S3 bucket name
         fileUploadBucketName = core.CfnOutput(
@@ -0,0 +1,73 @@
+#===================================================================================
+# FILE: vault_job_rules.py
+#
+# DESCRIPTION: Reads and validates the vault job routing rules from the CDK context
+# and compiles them into the Amazon EventBridge content filter on the object key of
+# Storage Gateway file upload events, so that uploads outside a vault job directory
+# never reach the Amazon SQS queue. The same rules are passed to the "check file
+# upload type" AWS Lambda function, which compiles them into a matcher (see
+# lambda-code/vault_job_matcher.py).
+#
+# NOTES: Part of an AWS CDK application. View the README.md file in this repository
+# for further information on the application architecture.
+#===================================================================================
+
+import json
+
+ruleKeys = ('jobDirPrefix', 'jobDirSuffix', 'manifestSuffix', 'setIdSeparator')
+
+def loadVaultJobRules(node):
+    # Return the list of vault job routing rules from the "vaultJobRoutingRules" context
+    # value (a JSON list when passed on the command line). If it is not set, a single
+    # rule is built from the "jobDirSuffixName" and "manifestSuffixName" context values
+    rules = node.try_get_context("vaultJobRoutingRules")
+    if rules is None:
+        rules = [{
+            "jobDirSuffix": node.try_get_context("jobDirSuffixName"),
+            "manifestSuffix": node.try_get_context("manifestSuffixName")
+        }]
+    elif isinstance(rules, str):
+        rules = json.loads(rules)
+    return validateVaultJobRules(rules)
+
+def validateVaultJobRules(rules):
+    # Check each rule identifies a job directory by a prefix and/or suffix of its name
+    # and has a manifest suffix. Returns the rules with a missing setIdSeparator set to
+    # "-", the separator the logical dataset ID has always been split from the rest of
+    # the directory name at, and other missing keys set to ""
+    if not isinstance(rules, list) or not rules:
+        raise ValueError("vaultJobRoutingRules must be a non-empty list of rules")
+    validRules = []
+    for rule in rules:
+        if not isinstance(rule, dict) or set(rule) - set(ruleKeys):
+            raise ValueError("Invalid vault job routing rule " + json.dumps(rule) + ", allowed keys are " + ", ".join(ruleKeys))
+        rule = dict({key: rule.get(key) or "" for key in ruleKeys}, setIdSeparator=rule.get("setIdSeparator", "-"))
+        if not all(isinstance(rule[key], str) for key in ruleKeys):
+            raise ValueError("Invalid vault job routing rule " + json.dumps(rule) + ", values must be strings")
+        if not rule["jobDirPrefix"] and not rule["jobDirSuffix"]:
+            raise ValueError("Vault job routing rule " + json.dumps(rule) + " must have a jobDirPrefix or jobDirSuffix")
+        if "/" in rule["jobDirPrefix"] + rule["jobDirSuffix"] + rule["setIdSeparator"]:
+            raise ValueError("Vault job routing rule " + json.dumps(rule) + " must not contain / in jobDirPrefix, jobDirSuffix or setIdSeparator")
+        if not rule["manifestSuffix"]:
+            raise ValueError("Vault job routing rule " + json.dumps(rule) + " must have a manifestSuffix")
+        validRules.append(rule)
+    return validRules
+
+def escapeWildcard(value):
+    return value.replace("\\", "\\\\").replace("*", "\\*")
+
+def objectKeyFilters(rules):
+    # EventBridge content filters matching the object keys within the job directories
+    # of any rule. A job directory identified only by its prefix is matched with a
+    # prefix filter, one with a suffix with a wildcard filter on the first path
+    # component. A wildcard can also match deeper paths, which the Lambda function
+    # then ignores
+    filters = []
+    for rule in rules:
+        if rule["jobDirSuffix"]:
+            keyFilter = {"wildcard": escapeWildcard(rule["jobDirPrefix"]) + "*" + escapeWildcard(rule["jobDirSuffix"]) + "/*"}
+        else:
+            keyFilter = {"prefix": rule["jobDirPrefix"]}
+        if keyFilter not in filters:
+            filters.append(keyFilter)
+    return filters